@@ -7,3 +7,101 @@ ROOT_DATA_DIR: Path = Path("USERS_DATA")
 ALLOWED_ID_PATTERN = r"^[a-zA-Z0-9._-]+$"
 
 STORAGE_MODE = "shared"
+
+# Backend dei documenti JSON (override via env ENAC_STORAGE_BACKEND):
+#   "fs"     → un file per oggetto sotto ROOT_DATA_DIR (default)
+#   "sqlite" → stessa gerarchia logica in un DB SQLite embedded (blob sempre su FS)
+STORAGE_BACKEND = "fs"
+SQLITE_PATH: Path = ROOT_DATA_DIR / "omnia8.sqlite3"
+
+# Cache LRU in-process dei JSON letti da read_json (0 = disabilitata)
+READ_CACHE_MAX_ENTRIES = 4096
+READ_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Durabilità di atomic_write_json (override via env ENAC_WRITE_DURABILITY):
+#   "none"     → solo os.replace (nessuna fsync)
+#   "file"     → fsync del file prima del rename
+#   "file+dir" → fsync del file + fsync della cartella dopo il rename
+WRITE_DURABILITY = "none"
+# Group commit: le fsync di richieste concorrenti arrivate entro questa finestra
+# vengono eseguite insieme (0 = disattivo; override via env ENAC_GROUP_COMMIT_MS)
+GROUP_COMMIT_WINDOW_MS = 0
+
+# Codec JSON su disco (override via env ENAC_JSON_CODEC):
+#   "compact" → nessuna indentazione, separatori minimi
+#   "pretty"  → indent=2 (formato storico)
+JSON_CODEC = "compact"
+# Usa orjson per encode/decode quando è installato (stesso output logico)
+JSON_FAST = True
+
+# GET di entità/contratti/titoli/viste: restituisce i byte salvati così come sono,
+# senza parse + validazione response_model + re-serializzazione (i dati sono già
+# validati in scrittura). Override via env ENAC_RAW_JSON_RESPONSES=1
+RAW_JSON_RESPONSES = False
+
+# Viste per entità (titles_index/claims_index): ogni scrittura aggiunge un delta
+# per riga accanto allo snapshot; la lettura li ripiega nello snapshot oltre
+# VIEW_COMPACT_DELTAS delta, le scritture solo oltre VIEW_MAX_DELTAS
+VIEW_COMPACT_DELTAS = 256
+VIEW_MAX_DELTAS = 4096
+
+# Numero massimo di elementi per le richieste batch (es. POST .../titles/batch)
+BATCH_MAX_ITEMS = 5000
+
+# Import massivo di entità/contratti (NDJSON/CSV, app/services/bulk_import.py):
+# record per lotto (validazione in un processo worker + una scrittura raggruppata)
+# e numero di processi di validazione (0 = numero di CPU)
+IMPORT_BATCH_SIZE = 500
+IMPORT_WORKERS = 0
+
+# Dettaglio aggregato del contratto (GET .../contracts/{id}/detail): thread che
+# leggono in parallelo titoli, sinistri, diari e metadati documento
+DETAIL_IO_WORKERS = 16
+
+# Upload in streaming dei documenti: dimensione dei blocchi scritti su disco
+# (la memoria per upload resta limitata a circa questo valore)
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Upload riprendibili a blocchi numerati (POST .../documents/uploads): dimensione
+# dei blocchi proposta al client e massima accettata, e durata di una sessione
+# dall'ultima attività (poi i dati parziali vengono eliminati)
+UPLOAD_SESSION_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_SESSION_MAX_CHUNK_SIZE = 64 * 1024 * 1024
+UPLOAD_SESSION_TTL_S = 24 * 3600
+# Pulizia periodica delle sessioni scadute in ogni processo server, indipendente
+# dal GC dei blob (0 = disattiva; env ENAC_UPLOAD_SESSION_SWEEP_S): tocca solo
+# sessioni oltre il TTL, quindi più processi possono eseguirla insieme
+UPLOAD_SESSION_SWEEP_S = 3600
+
+# Compressione trasparente dei blob (zlib, con header): MIME esatti o prefissi
+# che terminano con '/'; sotto BLOB_COMPRESS_MIN_SIZE byte si salva raw
+# (-1 = compressione disattivata). Se il compresso supera MAX_RATIO × originale
+# si conserva il raw (contenuto già compresso o MIME dichiarato male).
+BLOB_COMPRESS_MIME = (
+    "text/", "application/json", "application/xml", "application/xhtml+xml",
+    "application/csv", "application/rtf", "application/x-ndjson",
+    "image/tiff", "image/bmp", "image/svg+xml",
+)
+BLOB_COMPRESS_MIN_SIZE = 4096
+BLOB_COMPRESS_LEVEL = 6
+BLOB_COMPRESS_MAX_RATIO = 0.9
+
+# Pack file per i blob piccoli (env ENAC_BLOB_PACK_MODE): i blob salvati fino a
+# BLOB_PACK_MAX_SIZE byte vengono accodati a pack da ~BLOB_PACK_TARGET_SIZE con
+# indice degli offset; `manage blob-repack` impacchetta i piccoli sciolti e
+# riscrive i pack con più di BLOB_PACK_COMPACT_RATIO di spazio morto
+BLOB_PACK_MODE = False
+BLOB_PACK_MAX_SIZE = 64 * 1024
+BLOB_PACK_TARGET_SIZE = 256 * 1024 * 1024
+BLOB_PACK_COMPACT_RATIO = 0.3
+
+# GC dei blob (mark & sweep in background, app/services/blob_gc.py):
+#   intervallo fra due passate (0 = disattivo; env ENAC_BLOB_GC_INTERVAL_S),
+#   età minima di un blob non referenziato prima di eliminarlo, e limite di
+#   operazioni su file al secondo per non sottrarre I/O alle richieste.
+#   Disattivo di default: ogni processo server ne avvierebbe uno. Si esegue
+#   da cron con `python -m app.manage blob-gc` (un solo runner), oppure si
+#   attiva l'env su un unico processo
+BLOB_GC_INTERVAL_S = 0
+BLOB_GC_GRACE_S = 24 * 3600
+BLOB_GC_MAX_OPS_PER_S = 200
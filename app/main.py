@@ -1,15 +1,32 @@
 from __future__ import annotations
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
-from app.routers import entities, contracts, titles, claims, diary, documents, views
+from app.routers import entities, contracts, titles, claims, diary, documents, views, imports, batch
+from app.utils.utils import read_cache_stats, hold_server_lock, release_server_lock
+from app.services.blob_gc import start_blob_gc, stop_blob_gc, gc_status
+from app.services.batch_ops import recover_all_batches
+from app.services.upload_sessions import start_session_sweeper, stop_session_sweeper
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    hold_server_lock()  # i comandi a server fermo (blob-repack) rifiutano di partire
+    recover_all_batches()  # batch interrotti da un crash: roll-forward (solo fs)
+    start_blob_gc()  # GC blob in background solo se BLOB_GC_INTERVAL_S > 0 (default: cron)
+    start_session_sweeper()  # upload abbandonati: indipendente dal GC
+    yield
+    stop_session_sweeper()
+    stop_blob_gc()
+    release_server_lock()
 
 def create_app() -> FastAPI:
     app = FastAPI(
         title="Omnia8 File-API",
         description="Utenti → Entità → Contratti → (Titoli, Sinistri, Documenti) con storage filesystem.",
         version="1.0.1",
-        root_path="/enac-api"
+        root_path="/enac-api",
+        lifespan=lifespan,
     )
     app.add_middleware(
         CORSMiddleware,
@@ -26,10 +43,18 @@ def create_app() -> FastAPI:
     app.include_router(diary.router)
     app.include_router(documents.router)
     app.include_router(views.router)
+    app.include_router(imports.router)
+    app.include_router(batch.router)
 
     @app.get("/ping")
     def ping(): return {"status": "ok"}
 
+    @app.get("/stats/cache")
+    def cache_stats(): return read_cache_stats()
+
+    @app.get("/stats/gc")
+    def blob_gc_stats(): return gc_status()
+
     return app
 
 app = create_app()
@@ -0,0 +1,263 @@
+# app/manage.py
+"""
+Comandi di manutenzione offline.
+
+Esecuzione (dalla root del progetto):
+    python -m app.manage blob-refs --user-id <USER> [--verify]
+    python -m app.manage doc-owners --user-id <USER> --entity-id <ENTITY> [--contract-id <CONTRACT>]
+    python -m app.manage compact-json [--root USERS_DATA] [--codec compact|pretty] [--dry-run]
+    python -m app.manage blob-gc [--user-id <USER>] [--dry-run] [--grace-s N]
+    python -m app.manage blob-repack [--user-id <USER>]
+    python -m app.manage bulk-import --user-id <USER> --file <dati.ndjson|dati.csv> [--rejects scarti.ndjson]
+    python -m app.manage sqlite-import [--root USERS_DATA] [--db USERS_DATA/omnia8.sqlite3]
+    python -m app.manage sqlite-export [--root USERS_DATA] [--db USERS_DATA/omnia8.sqlite3]
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import sys
+
+
+def cmd_blob_refs(args: argparse.Namespace) -> int:
+    from app.services.indexes import rebuild_blob_refs
+    report = rebuild_blob_refs(args.user_id, verify_only=args.verify)
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    # in verifica: exit code 1 se la tabella non è allineata ai metadati
+    return 1 if args.verify and report["mismatches"] else 0
+
+
+def cmd_blob_gc(args: argparse.Namespace) -> int:
+    from app.services.blob_gc import collect_garbage, gc_user_ids
+    user_ids = [args.user_id] if args.user_id else gc_user_ids()
+    kw = {"dry_run": args.dry_run, "max_ops_per_s": args.max_ops_per_s}
+    if args.grace_s is not None:
+        kw["grace_s"] = args.grace_s
+    reports = [collect_garbage(uid, **kw) for uid in user_ids]
+    print(json.dumps(reports, indent=2, ensure_ascii=False))
+    return 0
+
+
+def cmd_blob_repack(args: argparse.Namespace) -> int:
+    from app.services.blob_gc import gc_user_ids
+    from app.services.blob_packs import repack_blobs
+    user_ids = [args.user_id] if args.user_id else gc_user_ids()
+    kw = {}
+    if args.max_size is not None:
+        kw["max_size"] = args.max_size
+    try:
+        reports = [repack_blobs(uid, **kw) for uid in user_ids]
+    except RuntimeError as e:
+        print(f"blob-repack: {e}", file=sys.stderr)
+        return 1
+    print(json.dumps(reports, indent=2, ensure_ascii=False))
+    return 0
+
+
+def cmd_doc_owners(args: argparse.Namespace) -> int:
+    from app.services.indexes import rebuild_doc_owners
+    from app.utils.utils import contracts_dir, list_dirs
+    if args.contract_id:
+        contract_ids = [args.contract_id]
+    else:
+        contract_ids = list_dirs(contracts_dir(args.user_id, args.entity_id))
+    for cid in contract_ids:
+        owners = rebuild_doc_owners(args.user_id, args.entity_id, cid)
+        n = sum(len(d) for kind in owners.values() for d in kind.values())
+        print(f"{cid}: {n} documenti indicizzati")
+    return 0
+
+
+def cmd_compact_json(args: argparse.Namespace) -> int:
+    """Riscrive tutti i .json dell'albero col codec scelto (a server fermo: verificato con offline_lock)."""
+    from pathlib import Path
+    from app.config import ROOT_DATA_DIR
+    from app.utils.utils import get_codec, offline_lock
+    codec = get_codec(args.codec)
+    root = Path(args.root or ROOT_DATA_DIR)
+    try:
+        with offline_lock(root):
+            return _compact_json(args, codec, root)
+    except RuntimeError as e:
+        print(f"compact-json: {e}", file=sys.stderr)
+        return 1
+
+
+def _compact_json(args: argparse.Namespace, codec, root) -> int:
+    from app.utils.utils import atomic_write_json, glob_json, read_json_bytes
+    files = rewritten = before = after = errors = 0
+    for f in glob_json(root, "**/*.json"):
+        if ".txn" in f.parts:
+            continue  # manifest e staging dei batch: li applica/scarta il recovery, non si toccano
+        files += 1
+        raw = read_json_bytes(f)
+        try:
+            obj = codec.loads(raw)
+        except ValueError:
+            errors += 1
+            print(f"JSON non valido, saltato: {f}", file=sys.stderr)
+            continue
+        data = codec.dumps(obj)
+        before += len(raw)
+        after += len(data)
+        if data != raw:
+            rewritten += 1
+            if not args.dry_run:
+                atomic_write_json(f, obj, codec=codec)
+    print(json.dumps({"root": str(root), "codec": codec.name, "files": files, "rewritten": rewritten,
+                      "bytes_before": before, "bytes_after": after, "errors": errors,
+                      "dry_run": args.dry_run}, indent=2))
+    return 1 if errors else 0
+
+
+# Con sqlite questi indici derivano dalle colonne indicizzate (o si ricostruiscono
+# al primo uso): una copia dal filesystem resterebbe subito disallineata.
+_SQLITE_SKIP_INDEXES = ("due", "blob_refs")
+
+def _sqlite_import_skip(parts: tuple) -> bool:
+    if ".txn" in parts or (parts and parts[-1] == "doc_owners.json"):
+        return True  # manifest dei batch in corso / indice owner → documenti
+    return any(a == "indexes" and b in _SQLITE_SKIP_INDEXES for a, b in zip(parts, parts[1:]))
+
+def cmd_sqlite_import(args: argparse.Namespace) -> int:
+    """Copia l'albero JSON su filesystem nel DB SQLite (stesse chiavi; i blob restano su FS)."""
+    from pathlib import Path
+    from app.config import ROOT_DATA_DIR, SQLITE_PATH
+    from app.utils.sqlite_store import SqliteStore
+    from app.utils.utils import get_codec
+    codec = get_codec()
+    root = Path(args.root or ROOT_DATA_DIR)
+    try:  # chiavi relative a ROOT_DATA_DIR come _key(): --root può solo restringere l'import
+        base = root.resolve().relative_to(Path(ROOT_DATA_DIR).resolve())
+    except ValueError:
+        print(f"sqlite-import: --root {root} non è sotto {ROOT_DATA_DIR}", file=sys.stderr)
+        return 1
+    store = SqliteStore(Path(args.db or SQLITE_PATH))
+    files = dirs = skipped = errors = 0
+    for p in sorted(root.rglob("*")):
+        rel = base / p.relative_to(root)
+        if _sqlite_import_skip(rel.parts):
+            skipped += p.is_file()
+            continue
+        key = rel.as_posix()
+        if p.is_dir():
+            store.mkdirs(key); dirs += 1
+        elif p.suffix == ".json":
+            raw = p.read_bytes()
+            try:
+                obj = codec.loads(raw)
+            except ValueError:
+                errors += 1
+                print(f"JSON non valido, saltato: {p}", file=sys.stderr)
+                continue
+            store.write(key, raw, obj); files += 1
+    print(json.dumps({"root": str(root), "db": str(store.db_path), "files": files,
+                      "dirs": dirs, "skipped": skipped, "errors": errors}, indent=2))
+    return 1 if errors else 0
+
+
+def cmd_sqlite_export(args: argparse.Namespace) -> int:
+    """Riscrive i documenti del DB SQLite come file sotto --root (ritorno al backend "fs")."""
+    from pathlib import Path
+    from app.config import ROOT_DATA_DIR, SQLITE_PATH
+    from app.utils.sqlite_store import SqliteStore
+    root = Path(args.root or ROOT_DATA_DIR)
+    store = SqliteStore(Path(args.db or SQLITE_PATH))
+    files = 0
+    for key, body in store.iter_all():
+        f = root / key
+        f.parent.mkdir(parents=True, exist_ok=True)
+        tmp = f.with_name(f.name + ".tmp")
+        tmp.write_bytes(body)
+        tmp.replace(f)
+        files += 1
+    print(json.dumps({"root": str(root), "db": str(store.db_path), "files": files}, indent=2))
+    return 0
+
+
+def cmd_bulk_import(args: argparse.Namespace) -> int:
+    from app.services.bulk_import import detect_format, run_import
+    fmt = args.format or detect_format(args.file)
+    kw = {}
+    if args.batch_size is not None:
+        kw["batch_size"] = args.batch_size
+    src = sys.stdin.buffer if args.file == "-" else open(args.file, "rb")
+    rejects = open(args.rejects, "w", encoding="utf-8") if args.rejects else None
+    last: dict = {}
+    try:
+        for ev in run_import(args.user_id, src, fmt, args.kind, args.skip_existing,
+                             workers=args.workers, rejects=rejects, **kw):
+            if ev["event"] == "progress":
+                print(f"letti {ev['read']}  entità {ev['entities']}  contratti {ev['contracts']}  "
+                      f"saltati {ev['skipped']}  scartati {ev['rejected']}  ({ev['elapsed_s']}s)", file=sys.stderr)
+            elif ev["event"] == "done":
+                last = ev
+    finally:
+        if src is not sys.stdin.buffer:
+            src.close()
+        if rejects is not None:
+            rejects.close()
+    print(json.dumps(last, indent=2, ensure_ascii=False))
+    return 1 if last.get("rejected") else 0
+
+
+def main(argv: list[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(prog="python -m app.manage", description="Manutenzione Omnia8 File-API")
+    sub = ap.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("blob-refs", help="Ricalcola (o verifica) il refcount dei blob dai metadati documento")
+    p.add_argument("--user-id", required=True, help="ID utente (in modalità 'shared' qualsiasi valore)")
+    p.add_argument("--verify", action="store_true", help="Solo verifica, non riscrive la tabella")
+    p.set_defaults(func=cmd_blob_refs)
+
+    p = sub.add_parser("blob-gc", help="Mark & sweep dei blob non referenziati (oltre il periodo di grazia)")
+    p.add_argument("--user-id", default=None, help="Solo questo utente/bucket (default: tutti)")
+    p.add_argument("--dry-run", action="store_true", help="Riporta cosa verrebbe eliminato senza eliminare")
+    p.add_argument("--grace-s", type=float, default=None, help="Età minima in secondi (default: BLOB_GC_GRACE_S)")
+    p.add_argument("--max-ops-per-s", type=float, default=0, help="Limite operazioni/s (default: nessuno, offline)")
+    p.set_defaults(func=cmd_blob_gc)
+
+    p = sub.add_parser("blob-repack", help="Sposta i blob piccoli nei pack e compatta i pack con spazio morto")
+    p.add_argument("--user-id", default=None, help="Solo questo utente/bucket (default: tutti)")
+    p.add_argument("--max-size", type=int, default=None, help="Soglia blob piccoli in byte (default: BLOB_PACK_MAX_SIZE)")
+    p.set_defaults(func=cmd_blob_repack)
+
+    p = sub.add_parser("doc-owners", help="Ricostruisce l'indice owner→documenti dei contratti di un'entità")
+    p.add_argument("--user-id", required=True)
+    p.add_argument("--entity-id", required=True)
+    p.add_argument("--contract-id", default=None, help="Solo questo contratto (default: tutti)")
+    p.set_defaults(func=cmd_doc_owners)
+
+    p = sub.add_parser("compact-json", help="Migra offline i JSON esistenti nel codec indicato")
+    p.add_argument("--root", default=None, help="Radice dati (default: ROOT_DATA_DIR)")
+    p.add_argument("--codec", default=None, help="compact | pretty (default: JSON_CODEC)")
+    p.add_argument("--dry-run", action="store_true", help="Calcola solo il risparmio, non scrive")
+    p.set_defaults(func=cmd_compact_json)
+
+    p = sub.add_parser("bulk-import", help="Import massivo di entità e contratti da NDJSON o CSV")
+    p.add_argument("--user-id", required=True)
+    p.add_argument("--file", required=True, help="File NDJSON/CSV ('-' = stdin)")
+    p.add_argument("--format", choices=("ndjson", "csv"), default=None, help="Default: dall'estensione del file")
+    p.add_argument("--kind", choices=("entity", "contract"), default=None, help="Tipo dei record senza campo 'type'")
+    p.add_argument("--rejects", default=None, help="File NDJSON delle righe scartate (riga, errori, record)")
+    p.add_argument("--skip-existing", action="store_true", help="Non sovrascrive entità/contratti già presenti")
+    p.add_argument("--workers", type=int, default=None, help="Processi di validazione (default: IMPORT_WORKERS)")
+    p.add_argument("--batch-size", type=int, default=None, help="Record per lotto (default: IMPORT_BATCH_SIZE)")
+    p.set_defaults(func=cmd_bulk_import)
+
+    p = sub.add_parser("sqlite-import", help="Importa l'albero JSON su filesystem nel DB SQLite")
+    p.add_argument("--root", default=None, help="Sottoalbero da importare, sotto ROOT_DATA_DIR (default: ROOT_DATA_DIR)")
+    p.add_argument("--db", default=None, help="File SQLite (default: SQLITE_PATH)")
+    p.set_defaults(func=cmd_sqlite_import)
+
+    p = sub.add_parser("sqlite-export", help="Esporta i documenti del DB SQLite come file JSON")
+    p.add_argument("--root", default=None, help="Radice dati (default: ROOT_DATA_DIR)")
+    p.add_argument("--db", default=None, help="File SQLite (default: SQLITE_PATH)")
+    p.set_defaults(func=cmd_sqlite_export)
+
+    args = ap.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
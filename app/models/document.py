@@ -22,3 +22,12 @@ class CreateResponse(BaseModel):
 class DeleteResponse(BaseModel):
     deleted: bool = Field(True)
     id: str
+
+class UploadSession(BaseModel):
+    upload_id: str = Field(...)
+    size: int = Field(..., description="Dimensione totale dichiarata")
+    chunk_size: int = Field(..., description="Byte per blocco (l'ultimo può essere più corto)")
+    offset: int = Field(..., description="Byte ricevuti (blocchi interi)")
+    next_chunk: Optional[int] = Field(None, description="Prossimo blocco da inviare (None = tutti ricevuti)")
+    expires_at: str = Field(..., description="Scadenza se non arrivano altri blocchi (UTC)")
+    doc_id: Optional[str] = Field(None, description="Documento creato al completamento")
@@ -1,6 +1,42 @@
 from __future__ import annotations
+from typing import Any, Dict, List, Literal, Optional
 from pydantic import BaseModel, Field
 
 class DeleteResponse(BaseModel):
     deleted: bool = Field(True)
     id: str
+
+class BatchItemResult(BaseModel):
+    index: int = Field(..., description="Posizione nella lista inviata")
+    id: Optional[str] = Field(None, description="ID creato (assente se l'elemento è stato scartato)")
+    errors: Optional[List[Dict[str, Any]]] = Field(None, description="Errori di validazione dell'elemento")
+
+class BatchResponse(BaseModel):
+    created: int
+    failed: int
+    items: List[BatchItemResult]
+
+class BatchOperation(BaseModel):
+    op: Literal[
+        "contract.create", "contract.update",
+        "title.create", "title.update", "title.delete",
+        "claim.create", "claim.update", "diary.create", "document.create",
+    ] = Field(..., description="Operazione (stesse regole della rotta REST corrispondente)")
+    ref: Optional[str] = Field(None, description="Nome dell'ID creato, citabile dalle operazioni successive come \"$nome\"")
+    contract_id: Optional[str] = Field(None, description="ID o \"$ref\"")
+    claim_id: Optional[str] = Field(None, description="ID o \"$ref\"")
+    title_id: Optional[str] = Field(None, description="ID o \"$ref\"")
+    payload: Dict[str, Any] = Field(default_factory=dict, description="Body della rotta REST corrispondente")
+
+class BatchOperationsRequest(BaseModel):
+    operations: List[BatchOperation]
+
+class BatchOperationResult(BaseModel):
+    index: int
+    op: str
+    id: str = Field(..., description="ID creato o modificato")
+
+class BatchOperationsResponse(BaseModel):
+    committed: int
+    results: List[BatchOperationResult]
+    refs: Dict[str, str] = Field(default_factory=dict)
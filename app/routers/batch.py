@@ -0,0 +1,15 @@
+from __future__ import annotations
+from fastapi import APIRouter, Body, HTTPException
+from app.config import BATCH_MAX_ITEMS
+from app.models.responses import BatchOperationsRequest, BatchOperationsResponse
+from app.services.batch_ops import run_batch
+
+router = APIRouter(prefix="/users/{user_id}/entities/{entity_id}/batch", tags=["Batch"])
+
+@router.post("", response_model=BatchOperationsResponse, summary="Più operazioni sull'entità, tutte o nessuna")
+def run_operations(user_id: str, entity_id: str, payload: BatchOperationsRequest = Body(...)):
+    # eseguite in ordine sotto il lock dell'entità; "$ref" cita l'ID creato da
+    # un'operazione precedente. Errore → {index, op, error|errors}, nulla scritto
+    if len(payload.operations) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"Al massimo {BATCH_MAX_ITEMS} operazioni per richiesta.")
+    return run_batch(user_id, entity_id, payload.operations)
@@ -1,13 +1,14 @@
 # app/api/claims.py
 from __future__ import annotations
-from typing import List
+from typing import Any, Dict, List
 from fastapi import APIRouter, Body, HTTPException
 from app.models.claim import Sinistro
 from app.models.responses import DeleteResponse
-from app.utils.utils import claim_file, claims_dir, contract_file
-from app.utils.utils import atomic_write_json, read_json
-from app.services.indexes import rebuild_entity_views
-import uuid, shutil
+from app.utils.utils import claim_file, claim_dir, claims_dir, contract_file
+from app.utils.utils import atomic_write_json, read_json, path_exists, list_dirs, remove_tree
+from app.utils.utils import MERGE_PATCH_MEDIA_TYPE, merge_patch, validate_merged, same_as_stored
+from app.services.indexes import entity_lock, upsert_claim_view, remove_claim_view, release_blob_refs_under, doc_owner_drop_legacy
+import uuid
 
 router = APIRouter(
     prefix="/users/{user_id}/entities/{entity_id}/contracts/{contract_id}/claims",
@@ -17,7 +18,7 @@ router = APIRouter(
 @router.post("", response_model=dict)
 def create_claim(user_id: str, entity_id: str, contract_id: str, payload: Sinistro = Body(...)):
     cf = contract_file(user_id, entity_id, contract_id)
-    if not cf.exists():
+    if not path_exists(cf):
         raise HTTPException(status_code=404, detail="Contratto non trovato.")
 
     contract = read_json(cf)
@@ -28,18 +29,19 @@ def create_claim(user_id: str, entity_id: str, contract_id: str, payload: Sinist
 
     claim_id = uuid.uuid4().hex
     # 🔒 scrivi SEMPRE con nuove chiavi
-    atomic_write_json(claim_file(user_id, entity_id, contract_id, claim_id), payload.dict())
-    rebuild_entity_views(user_id, entity_id)
+    data = payload.dict()
+    atomic_write_json(claim_file(user_id, entity_id, contract_id, claim_id), data)
+    upsert_claim_view(user_id, entity_id, contract_id, claim_id, data)
     return {"claim_id": claim_id, "sinistro": payload.dict()}
 
 @router.get("", response_model=List[str])
 def list_claims(user_id: str, entity_id: str, contract_id: str):
-    return [p.name for p in claims_dir(user_id, entity_id, contract_id).iterdir() if p.is_dir()]
+    return [d for d in list_dirs(claims_dir(user_id, entity_id, contract_id)) if d != "documents"]
 
 @router.get("/{claim_id}", response_model=Sinistro)
 def get_claim(user_id: str, entity_id: str, contract_id: str, claim_id: str):
     cf = claim_file(user_id, entity_id, contract_id, claim_id)
-    if not cf.exists():
+    if not path_exists(cf):
         raise HTTPException(status_code=404, detail="Sinistro non trovato.")
     data = read_json(cf)
     # parsing con compat-layer; FastAPI serializza con campi del modello
@@ -48,18 +50,40 @@ def get_claim(user_id: str, entity_id: str, contract_id: str, claim_id: str):
 @router.put("/{claim_id}", response_model=Sinistro)
 def update_claim(user_id: str, entity_id: str, contract_id: str, claim_id: str, payload: Sinistro = Body(...)):
     cf = claim_file(user_id, entity_id, contract_id, claim_id)
-    if not cf.exists():
+    if not path_exists(cf):
         raise HTTPException(status_code=404, detail="Sinistro non trovato.")
     # 🔒 persisti con nuove chiavi
-    atomic_write_json(cf, payload.dict())
-    rebuild_entity_views(user_id, entity_id)
+    data = payload.dict()
+    atomic_write_json(cf, data)
+    upsert_claim_view(user_id, entity_id, contract_id, claim_id, data)
+    return payload
+
+@router.patch("/{claim_id}", response_model=Sinistro)
+def patch_claim(user_id: str, entity_id: str, contract_id: str, claim_id: str,
+                patch: Dict[str, Any] = Body(..., media_type=MERGE_PATCH_MEDIA_TYPE)):
+    cf = claim_file(user_id, entity_id, contract_id, claim_id)
+    with entity_lock(user_id, entity_id):
+        if not path_exists(cf):
+            raise HTTPException(status_code=404, detail="Sinistro non trovato.")
+        current = read_json(cf)
+        merged = merge_patch(current, patch)
+        if merged == current:  # patch senza effetto: niente scrittura né vista
+            return Sinistro(**current)
+        payload = validate_merged(Sinistro, merged)
+        # 🔒 persisti con nuove chiavi (un claim legacy viene migrato alla prima patch)
+        data = payload.dict()
+        if same_as_stored(data, current): return payload
+        atomic_write_json(cf, data)
+        upsert_claim_view(user_id, entity_id, contract_id, claim_id, data)
     return payload
 
 @router.delete("/{claim_id}", response_model=DeleteResponse)
 def delete_claim(user_id: str, entity_id: str, contract_id: str, claim_id: str):
-    cdir = claims_dir(user_id, entity_id, contract_id) / claim_id
-    if not cdir.exists():
+    cdir = claim_dir(user_id, entity_id, contract_id, claim_id)
+    if not path_exists(cdir):
         raise HTTPException(status_code=404, detail="Sinistro non trovato.")
-    shutil.rmtree(cdir)
-    rebuild_entity_views(user_id, entity_id)
+    release_blob_refs_under(user_id, cdir)  # documenti legacy claims/<claim_id>/documents/
+    remove_tree(cdir)
+    remove_claim_view(user_id, entity_id, contract_id, claim_id)
+    doc_owner_drop_legacy(user_id, entity_id, contract_id, claim_id)
     return DeleteResponse(id=claim_id)
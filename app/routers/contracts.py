@@ -1,49 +1,86 @@
 from __future__ import annotations
-from typing import List
-from fastapi import APIRouter, Body, HTTPException
+from typing import Any, Dict, List
+from fastapi import APIRouter, Body, HTTPException, Query
 from app.models.contract import ContrattoOmnia8
 from app.models.responses import DeleteResponse
 from app.utils.utils import contracts_dir, contract_dir, contract_file, entity_file
-from app.utils.utils import atomic_write_json, read_json
-from app.services.indexes import update_by_policy_index, rebuild_entity_views
-import uuid, shutil
+from app.utils.utils import atomic_write_json, read_json, path_exists, list_dirs, remove_tree
+from app.utils.utils import raw_json_responses, stored_json_response
+from app.utils.utils import MERGE_PATCH_MEDIA_TYPE, merge_patch, validate_merged, same_as_stored
+from app.services.indexes import (
+    entity_lock,
+    update_by_policy_index, refresh_contract_view, remove_contract_view,
+    upsert_contract_due, remove_contract_due, release_blob_refs_under
+)
+from app.services.contract_detail import DEFAULT_INCLUDE, INCLUDES, parse_include, contract_detail
+import uuid
 
 router = APIRouter(prefix="/users/{user_id}/entities/{entity_id}/contracts", tags=["Contracts"])
 
 @router.post("", response_model=dict)
 def create_contract(user_id: str, entity_id: str, payload: ContrattoOmnia8 = Body(...)):
-    if not entity_file(user_id, entity_id).exists():
+    if not path_exists(entity_file(user_id, entity_id)):
         raise HTTPException(status_code=404, detail="Entità non trovata.")
     contract_id = uuid.uuid4().hex
-    atomic_write_json(contract_file(user_id, entity_id, contract_id), payload.dict(by_alias=True))
+    data = payload.dict(by_alias=True)
+    atomic_write_json(contract_file(user_id, entity_id, contract_id), data)
     update_by_policy_index(user_id, payload.identificativi.numero_polizza, entity_id, contract_id)
-    rebuild_entity_views(user_id, entity_id)
+    upsert_contract_due(user_id, entity_id, contract_id, data)
     return {"contract_id": contract_id, "contratto": payload}
 
 @router.get("", response_model=List[str])
 def list_contracts(user_id: str, entity_id: str):
-    if not entity_file(user_id, entity_id).exists():
+    if not path_exists(entity_file(user_id, entity_id)):
         raise HTTPException(status_code=404, detail="Entità non trovata.")
-    return [p.name for p in contracts_dir(user_id, entity_id).iterdir() if p.is_dir()]
+    return list_dirs(contracts_dir(user_id, entity_id))
 
 @router.get("/{contract_id}", response_model=ContrattoOmnia8)
 def get_contract(user_id: str, entity_id: str, contract_id: str):
     cf = contract_file(user_id, entity_id, contract_id)
-    if not cf.exists(): raise HTTPException(status_code=404, detail="Contratto non trovato.")
+    if not path_exists(cf): raise HTTPException(status_code=404, detail="Contratto non trovato.")
+    if raw_json_responses(): return stored_json_response(cf)
     return read_json(cf)
 
+@router.get("/{contract_id}/detail", response_model=Dict[str, Any], summary="Contratto con titoli, sinistri e documenti in una richiesta")
+def get_contract_detail(user_id: str, entity_id: str, contract_id: str,
+                        include: str = Query(DEFAULT_INCLUDE, description=f"Sottoinsieme di: {','.join(INCLUDES)}")):
+    return contract_detail(user_id, entity_id, contract_id, parse_include(include))
+
 @router.put("/{contract_id}", response_model=ContrattoOmnia8)
 def update_contract(user_id: str, entity_id: str, contract_id: str, payload: ContrattoOmnia8 = Body(...)):
     cf = contract_file(user_id, entity_id, contract_id)
-    if not cf.exists(): raise HTTPException(status_code=404, detail="Contratto non trovato.")
-    atomic_write_json(cf, payload.dict(by_alias=True))
+    if not path_exists(cf): raise HTTPException(status_code=404, detail="Contratto non trovato.")
+    data = payload.dict(by_alias=True)
+    atomic_write_json(cf, data)
     update_by_policy_index(user_id, payload.identificativi.numero_polizza, entity_id, contract_id)
-    rebuild_entity_views(user_id, entity_id)
+    refresh_contract_view(user_id, entity_id, contract_id, data)
+    upsert_contract_due(user_id, entity_id, contract_id, data)
+    return payload
+
+@router.patch("/{contract_id}", response_model=ContrattoOmnia8)
+def patch_contract(user_id: str, entity_id: str, contract_id: str,
+                   patch: Dict[str, Any] = Body(..., media_type=MERGE_PATCH_MEDIA_TYPE)):
+    # merge patch sulle chiavi JSON (alias): {"Premi": {"Netto": 100}}
+    cf = contract_file(user_id, entity_id, contract_id)
+    with entity_lock(user_id, entity_id):
+        if not path_exists(cf): raise HTTPException(status_code=404, detail="Contratto non trovato.")
+        current = read_json(cf)
+        merged = merge_patch(current, patch)
+        if merged == current: return current  # patch senza effetto: niente scrittura né indici
+        payload = validate_merged(ContrattoOmnia8, merged)
+        data = payload.dict(by_alias=True)
+        if same_as_stored(data, current): return payload
+        atomic_write_json(cf, data)
+        update_by_policy_index(user_id, payload.identificativi.numero_polizza, entity_id, contract_id)
+        refresh_contract_view(user_id, entity_id, contract_id, data)
+        upsert_contract_due(user_id, entity_id, contract_id, data)
     return payload
 
 @router.delete("/{contract_id}", response_model=DeleteResponse)
 def delete_contract(user_id: str, entity_id: str, contract_id: str):
     cdir = contract_dir(user_id, entity_id, contract_id)
-    if not cdir.exists(): raise HTTPException(status_code=404, detail="Contratto non trovato.")
-    shutil.rmtree(cdir); rebuild_entity_views(user_id, entity_id)
+    if not path_exists(cdir): raise HTTPException(status_code=404, detail="Contratto non trovato.")
+    release_blob_refs_under(user_id, cdir)
+    remove_tree(cdir); remove_contract_view(user_id, entity_id, contract_id)
+    remove_contract_due(user_id, entity_id, contract_id)
     return DeleteResponse(id=contract_id)
@@ -1,20 +1,35 @@
 from __future__ import annotations
 import base64
+import time
 import uuid
+import zipfile
 from pathlib import Path
-from typing import List, Dict, Any
+from urllib.parse import quote
+from typing import List, Dict, Any, Optional
 
-from fastapi import APIRouter, Body, HTTPException, Query
-from fastapi.responses import FileResponse
+from fastapi import APIRouter, Body, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from pydantic import ValidationError
 
-from app.models.document import CreateDocumentRequest, CreateResponse
+from app.config import UPLOAD_CHUNK_SIZE, UPLOAD_SESSION_CHUNK_SIZE, UPLOAD_SESSION_MAX_CHUNK_SIZE
+from app.models.document import CreateDocumentRequest, CreateResponse, DocumentoMeta, UploadSession
 from app.models.responses import DeleteResponse
 from app.utils.utils import (
     contract_docs_dir, claim_docs_dir, title_docs_dir, doc_meta_file,
     user_dir, contract_file, claim_file, title_file, claim_dir,
-    atomic_write_json, read_json, write_blob, ensure_dir
+    atomic_write_json, read_json, write_blob, path_exists, list_json, remove_file,
+    BlobWriter, BlobLoc, blob_lookup, blob_header, iter_blob, should_compress,
+    locate_blob
+)
+from app.services.indexes import (
+    ensure_blob_refs, blob_ref_take, blob_ref_decr, blob_ref_release,
+    doc_owner_add, doc_owner_remove, list_owner_docs
+)
+from app.services.upload_sessions import (
+    create_session, load_session, drop_session, finish_session, session_status, session_busy,
+    received_offset, chunk_bounds, open_chunk, close_chunk, commit_session_blob
 )
-from app.services.indexes import count_blob_references
 
 router = APIRouter(tags=["Documents"])
 
@@ -22,35 +37,345 @@ router = APIRouter(tags=["Documents"])
 # Helpers
 # ============================================================================
 def _list_docs_in_dir(base_dir: Path) -> List[str]:
-    if not base_dir.exists():
-        return []
-    return [p.stem for p in base_dir.glob("*.json")]
+    return list_json(base_dir)
 
 def _read_meta(base_dir: Path, doc_id: str) -> Dict[str, Any]:
     mf = doc_meta_file(base_dir, doc_id)
-    if not mf.exists():
+    if not path_exists(mf):
         raise HTTPException(status_code=404, detail="Documento non trovato.")
     return read_json(mf)
 
-def _write_meta(base_dir: Path, doc_id: str, meta: Dict[str, Any]) -> None:
-    # garantisce la cartella e scrive in modo atomico
-    ensure_dir(base_dir)
-    path = doc_meta_file(base_dir, doc_id)
-    ensure_dir(path.parent)
-    atomic_write_json(path, meta)
+def _read_metas(base_dir: Path, doc_ids: List[str]) -> List[Dict[str, Any]]:
+    # lettura in blocco (export): i documenti eliminati nel frattempo si saltano
+    out = []
+    for doc_id in doc_ids:
+        try:
+            out.append(read_json(doc_meta_file(base_dir, doc_id)))
+        except FileNotFoundError:
+            continue
+    return out
+
+def _write_meta(user_id: str, base_dir: Path, doc_id: str, meta: Dict[str, Any], old_hash: str | None = None) -> None:
+    ensure_blob_refs(user_id)
+    # refcount: conta solo i cambi di riferimento; il nuovo si prende prima del
+    # metadato, sotto il lock del blob (una delete concorrente non lo elimina)
+    new_hash = meta.get("hash")
+    took = bool(new_hash) and new_hash != old_hash
+    if took:
+        blob_ref_take(user_id, new_hash)
+    try:
+        # scrittura atomica (atomic_write_json crea la cartella se serve)
+        atomic_write_json(doc_meta_file(base_dir, doc_id), meta)
+    except BaseException:
+        if took:
+            blob_ref_decr(user_id, new_hash)
+        raise
+    if old_hash and new_hash != old_hash:
+        blob_ref_decr(user_id, old_hash)
 
-def _download(user_id: str, meta: Dict[str, Any]) -> FileResponse:
-    rel = meta.get("path_relativo")
-    if not rel:
+def _delete_meta(user_id: str, mf: Path, sha1: str | None, delete_blob: bool) -> None:
+    ensure_blob_refs(user_id)
+    remove_file(mf)
+    if sha1:
+        # il blob si elimina solo se, sotto il suo lock, nessun metadato lo referenzia più
+        blob_ref_release(user_id, sha1, delete_blob)
+
+# ---- download: Range (206, anche multi-range), ETag = SHA1, If-None-Match → 304
+#   Il blob è indirizzato per contenuto: l'ETag forte è lo SHA1. L'URL del
+#   documento può però cambiare contenuto (PUT), quindi di default il client
+#   rivalida (no-cache → 304 senza corpo); con ?v=<sha1> l'URL è immutabile.
+_IMMUTABLE = "public, max-age=31536000, immutable"
+_REVALIDATE = "no-cache"
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return any(t.removeprefix("W/") == etag for t in tags)
+
+def _resolve_blob(user_id: str, meta: Dict[str, Any]) -> Optional[BlobLoc]:
+    """Posizione del blob del documento: per hash (file sciolto o tratto di pack), poi path_relativo."""
+    sha1, rel = meta.get("hash"), meta.get("path_relativo")
+    loc = locate_blob(user_id, sha1) if sha1 else None
+    if loc is None and rel:
+        try:
+            loc = BlobLoc(user_dir(user_id) / rel, 0, (user_dir(user_id) / rel).stat().st_size)
+        except FileNotFoundError:
+            return None
+    return loc
+
+def _download(user_id: str, meta: Dict[str, Any], request: Request, v: Optional[str] = None) -> Response:
+    if not meta.get("path_relativo"):
         raise HTTPException(status_code=404, detail="Documento senza blob.")
-    path = user_dir(user_id) / rel
-    if not path.exists():
+    sha1 = meta.get("hash")
+    loc = _resolve_blob(user_id, meta)
+    if loc is None:
         raise HTTPException(status_code=404, detail="Blob non trovato.")
-    return FileResponse(
-        path,
-        media_type=meta.get("mime") or "application/octet-stream",
-        filename=meta.get("nome_originale") or "download.bin",
-    )
+    headers: Dict[str, str] = {}
+    if sha1:
+        headers["etag"] = f'"{sha1}"'
+        headers["cache-control"] = _IMMUTABLE if v == sha1 else _REVALIDATE
+        inm = request.headers.get("if-none-match")
+        if inm and _etag_matches(inm, headers["etag"]):
+            return Response(status_code=304, headers=headers)
+    media_type = meta.get("mime") or "application/octet-stream"
+    filename = meta.get("nome_originale") or "download.bin"
+    codec, size, offset = blob_header(loc)
+    if codec == "raw" and offset == 0 and not loc.packed and _range_ok(request.headers.get("range")):
+        # file sciolto non compresso: FileResponse gestisce Range/If-Range (206, multipart/byteranges, 416).
+        # Compressi e pack (_stream_blob) servono un solo intervallo: un Range multiplo
+        # degrada a 200 col contenuto intero (ammesso da RFC 7233 §3.1). Un Range
+        # sintatticamente non valido va sempre a _stream_blob (FileResponse risponderebbe 400)
+        return FileResponse(loc.path, media_type=media_type, filename=filename, headers=headers,
+                            stat_result=loc.path.stat())
+    return _stream_blob(loc, size, request, media_type, filename, headers)
+
+def _content_disposition(filename: str) -> str:
+    q = quote(filename)
+    return f"attachment; filename*=utf-8''{q}" if q != filename else f'attachment; filename="{filename}"'
+
+def _spec_ok(spec: str) -> bool:
+    # byte-range-spec "a-b" / "a-" (b >= a) o suffix-byte-range-spec "-n"
+    first, _, last = (p.strip() for p in spec.strip().partition("-"))
+    if not (first or last) or not all(p.isdigit() for p in (first, last) if p):
+        return False
+    return not (first and last) or int(last) >= int(first)
+
+def _range_ok(rng: Optional[str]) -> bool:
+    """Header Range assente o sintatticamente valido (RFC 7233 §2.1): i non validi si ignorano."""
+    if not rng:
+        return True
+    unit, _, spec = rng.partition("=")
+    return unit.strip() == "bytes" and all(_spec_ok(s) for s in spec.split(","))
+
+def _single_range(request: Request, size: int, etag: Optional[str]) -> Optional[tuple[int, int]]:
+    """Intervallo [start, end) di un Range a intervallo singolo; None = contenuto intero."""
+    rng = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if not rng or (if_range is not None and if_range != etag):
+        return None
+    if not _range_ok(rng) or "," in rng:
+        return None  # non valido ("bytes=5-3") o multi-range: 200 col contenuto intero
+    first, _, last = (p.strip() for p in rng.partition("=")[2].strip().partition("-"))
+    if first:
+        start, end = int(first), (int(last) + 1 if last else size)
+    else:
+        n = int(last)  # "bytes=-0": suffisso vuoto, mai soddisfacibile (416)
+        start, end = (max(size - n, 0) if n else size), size
+    if start >= size:
+        raise HTTPException(status_code=416, detail="Range non soddisfacibile.", headers={"Content-Range": f"bytes */{size}"})
+    return start, min(end, size)
+
+def _stream_blob(loc: BlobLoc, size: int, request: Request, media_type: str, filename: str,
+                 headers: Dict[str, str]) -> StreamingResponse:
+    # blob compresso o in un pack: lettura in streaming dal tratto del file
+    # (Range singolo; sui compressi si decomprime fino a `start`)
+    headers = {**headers, "accept-ranges": "bytes", "content-disposition": _content_disposition(filename)}
+    rng = _single_range(request, size, headers.get("etag"))
+    if rng is None:
+        headers["content-length"] = str(size)
+        return StreamingResponse(iter_blob(loc), media_type=media_type, headers=headers)
+    start, end = rng
+    headers["content-range"] = f"bytes {start}-{end - 1}/{size}"
+    headers["content-length"] = str(end - start)
+    return StreamingResponse(iter_blob(loc, start, end), status_code=206, media_type=media_type, headers=headers)
+
+# ---- export ZIP in streaming: GET .../documents.zip ---------------------------
+#   L'archivio è generato al volo: ogni voce è letta dal blob (sciolto, compresso
+#   o in un pack) e scritta con data descriptor, quindi né l'archivio né i
+#   singoli file vengono bufferizzati (memoria ≈ UPLOAD_CHUNK_SIZE).
+class _ZipSink:
+    """Destinazione non seekable di zipfile: il generatore ne svuota i byte accumulati."""
+
+    def __init__(self) -> None:
+        self.buf = bytearray()
+
+    def write(self, b: bytes) -> int:
+        self.buf += b
+        return len(b)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        out = bytes(self.buf)
+        self.buf.clear()
+        return out
+
+def _zip_entry_name(name: Optional[str], seen: set[str]) -> str:
+    # nome_originale senza cartelle; i doppioni diventano "nome (2).ext"
+    name = (name or "").replace("\\", "/").rsplit("/", 1)[-1].strip() or "documento"
+    stem, dot, ext = name.rpartition(".")
+    if not stem:
+        stem, dot, ext = name, "", ""
+    cand, n = name, 1
+    while cand.lower() in seen:
+        n += 1
+        cand = f"{stem} ({n}){dot}{ext}"
+    seen.add(cand.lower())
+    return cand
+
+def _iter_zip(items: List[tuple[str, BlobLoc, int, str]]):
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, "w") as zf:
+        for name, loc, size, mime in items:
+            zi = zipfile.ZipInfo(name, time.localtime(loc.path.stat().st_mtime)[:6])
+            zi.compress_type = zipfile.ZIP_DEFLATED if should_compress(mime) else zipfile.ZIP_STORED
+            with zf.open(zi, "w", force_zip64=size >= zipfile.ZIP64_LIMIT) as w:
+                for chunk in iter_blob(loc):
+                    w.write(chunk)
+                    if len(sink.buf) >= UPLOAD_CHUNK_SIZE:
+                        yield sink.drain()
+            yield sink.drain()
+    yield sink.drain()  # directory centrale
+
+def _zip_response(user_id: str, metas: List[Dict[str, Any]], filename: str) -> StreamingResponse:
+    # blob risolti PRIMA di iniziare lo stream (dopo non si può più rispondere 404):
+    # i documenti senza contenuto o con blob mancante non entrano nell'archivio
+    items, seen = [], set()
+    for meta in metas:
+        loc = _resolve_blob(user_id, meta)
+        if loc is None:
+            continue
+        items.append((_zip_entry_name(meta.get("nome_originale"), seen), loc, blob_header(loc)[1], meta.get("mime") or ""))
+    headers = {"content-disposition": _content_disposition(filename), "x-documents-count": str(len(items))}
+    return StreamingResponse(_iter_zip(items), media_type="application/zip", headers=headers)
+
+# ---- upload in streaming (corpo raw, niente base64) -------------------------
+#   POST .../documents/upload?categoria=..&nome_originale=..  (MIME da Content-Type)
+#   Il corpo va su disco a blocchi di UPLOAD_CHUNK_SIZE con SHA1 incrementale:
+#   la memoria per richiesta non dipende dalla dimensione del file.
+def _upload_meta(request: Request, level: str, scope: Optional[str], categoria: str,
+                 nome_originale: str, mime: Optional[str]) -> Dict[str, Any]:
+    # validazione PRIMA di ricevere il corpo (size/hash si completano dopo)
+    try:
+        meta = DocumentoMeta(
+            scope=scope or level, categoria=categoria, nome_originale=nome_originale, size=0,
+            mime=mime or request.headers.get("content-type") or "application/octet-stream",
+        ).dict()
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors(include_url=False))
+    meta["metadati"]["level"] = level
+    return meta
+
+async def _spool_body(user_id: str, request: Request, meta: Dict[str, Any], sha1: Optional[str]) -> None:
+    if sha1:
+        # SHA1 dichiarato dal client: se il contenuto è già presente il corpo non si legge
+        sha1 = sha1.lower()
+        hit = await run_in_threadpool(blob_lookup, user_id, sha1, True)
+        if hit:
+            meta["hash"], (meta["path_relativo"], meta["size"]) = sha1, hit
+            return
+    writer = await run_in_threadpool(BlobWriter, user_id, sha1, should_compress(meta.get("mime")))
+    buf = bytearray()
+    try:
+        async for chunk in request.stream():
+            buf += chunk
+            if len(buf) >= UPLOAD_CHUNK_SIZE:
+                data, buf = bytes(buf), bytearray()
+                await run_in_threadpool(writer.write, data)
+        if buf:
+            await run_in_threadpool(writer.write, bytes(buf))
+        meta["hash"], meta["path_relativo"], meta["size"] = await run_in_threadpool(writer.commit)
+    except BaseException:
+        writer.abort()
+        raise
+
+# ---- upload riprendibili (sessioni in app/services/upload_sessions.py) -------
+#   POST .../documents/uploads?size=..&categoria=..&nome_originale=..  → sessione
+#   PUT  /users/{u}/uploads/{upload_id}/chunks/{n}   corpo raw del blocco n
+#   GET  /users/{u}/uploads/{upload_id}              offset ricevuto, prossimo blocco
+#   POST /users/{u}/uploads/{upload_id}/complete     blob (dedup SHA1) + documento
+#   Dopo una disconnessione il client chiede l'offset e riprende da next_chunk.
+def _upload_target_exists(user_id: str, t: Dict[str, Any]) -> bool:
+    eid, cid, owner = t["entity_id"], t["contract_id"], t.get("owner_id")
+    if t["level"] == "SINISTRO":
+        return path_exists(claim_file(user_id, eid, cid, owner))
+    if t["level"] == "TITOLO":
+        return path_exists(title_file(user_id, eid, cid, owner))
+    return path_exists(contract_file(user_id, eid, cid))
+
+def _create_upload_doc(user_id: str, t: Dict[str, Any], meta: Dict[str, Any]) -> str:
+    # stessa destinazione delle POST .../documents del livello
+    eid, cid, owner = t["entity_id"], t["contract_id"], t.get("owner_id")
+    doc_id = uuid.uuid4().hex
+    if t["level"] == "SINISTRO":
+        _write_meta(user_id, claim_docs_dir(user_id, eid, cid, owner), doc_id, meta)
+        doc_owner_add(user_id, eid, cid, "claims", owner, doc_id)
+    elif t["level"] == "TITOLO":
+        _write_meta(user_id, title_docs_dir(user_id, eid, cid, owner), doc_id, meta)
+        doc_owner_add(user_id, eid, cid, "titles", owner, doc_id)
+    else:
+        _write_meta(user_id, contract_docs_dir(user_id, eid, cid), doc_id, meta)
+    return doc_id
+
+def _open_upload_session(user_id: str, target: Dict[str, Any], meta: Dict[str, Any], size: int,
+                         chunk_size: int, sha1: Optional[str]) -> UploadSession:
+    if sha1:
+        # contenuto già presente: documento creato subito, nessun blocco da inviare
+        sha1 = sha1.lower()
+        hit = blob_lookup(user_id, sha1, True)
+        if hit:
+            meta["hash"], (meta["path_relativo"], meta["size"]) = sha1, hit
+            s = create_session(user_id, target, meta, meta["size"], chunk_size, sha1)
+            finish_session(user_id, s, _create_upload_doc(user_id, target, meta))
+            return UploadSession(**session_status(user_id, s))
+    return UploadSession(**session_status(user_id, create_session(user_id, target, meta, size, chunk_size, sha1)))
+
+@router.get("/users/{user_id}/uploads/{upload_id}", response_model=UploadSession)
+def get_upload_session(user_id: str, upload_id: str):
+    return session_status(user_id, load_session(user_id, upload_id))
+
+@router.put("/users/{user_id}/uploads/{upload_id}/chunks/{n}", response_model=UploadSession)
+async def put_upload_chunk(user_id: str, upload_id: str, n: int, request: Request):
+    with session_busy(upload_id):
+        s = await run_in_threadpool(load_session, user_id, upload_id)
+        start, end = await run_in_threadpool(chunk_bounds, user_id, s, n)
+        expected = end - start
+        declared = request.headers.get("content-length")
+        if declared is not None and declared != str(expected):
+            raise HTTPException(status_code=400, detail=f"Il blocco {n} deve essere di {expected} byte.")
+        f = await run_in_threadpool(open_chunk, user_id, s, start)
+        written, buf = 0, bytearray()
+        try:
+            async for chunk in request.stream():
+                written += len(chunk)
+                if written > expected:
+                    break
+                buf += chunk
+                if len(buf) >= UPLOAD_CHUNK_SIZE:
+                    data, buf = bytes(buf), bytearray()
+                    await run_in_threadpool(f.write, data)
+            if buf and written <= expected:
+                await run_in_threadpool(f.write, bytes(buf))
+        finally:
+            await run_in_threadpool(close_chunk, f, start, written, expected)
+        if written != expected:
+            raise HTTPException(status_code=400, detail=f"Il blocco {n} deve essere di {expected} byte (ricevuti {written}).")
+        return await run_in_threadpool(session_status, user_id, s)
+
+@router.post("/users/{user_id}/uploads/{upload_id}/complete", response_model=UploadSession)
+def complete_upload_session(user_id: str, upload_id: str):
+    with session_busy(upload_id):
+        s = load_session(user_id, upload_id)
+        if s.get("doc_id"):
+            return session_status(user_id, s)  # retry del completamento: stesso documento
+        got = received_offset(user_id, s)
+        if got < s["size"]:
+            raise HTTPException(status_code=409, detail=f"Upload incompleto: ricevuti {got} di {s['size']} byte.")
+        if not _upload_target_exists(user_id, s["target"]):
+            raise HTTPException(status_code=404, detail="Destinazione del documento non trovata.")
+        meta = s["meta"]
+        meta["hash"], meta["path_relativo"], meta["size"] = commit_session_blob(user_id, s)
+        finish_session(user_id, s, _create_upload_doc(user_id, s["target"], meta))
+        return session_status(user_id, s)
+
+@router.delete("/users/{user_id}/uploads/{upload_id}", response_model=DeleteResponse)
+def delete_upload_session(user_id: str, upload_id: str):
+    with session_busy(upload_id):
+        load_session(user_id, upload_id)
+        drop_session(user_id, upload_id)
+    return DeleteResponse(id=upload_id)
 
 # ---- supporto compatibilità: percorso legacy dei claim-docs -----------------
 def _claim_legacy_docs_dir(user_id: str, entity_id: str, contract_id: str, claim_id: str) -> Path:
@@ -69,28 +394,62 @@ def _claim_doc_bases(user_id: str, entity_id: str, contract_id: str, claim_id: s
 def list_contract_docs(user_id: str, entity_id: str, contract_id: str):
     return _list_docs_in_dir(contract_docs_dir(user_id, entity_id, contract_id))
 
+@router.get("/users/{user_id}/entities/{entity_id}/contracts/{contract_id}/documents.zip")
+def zip_contract_docs(user_id: str, entity_id: str, contract_id: str):
+    if not path_exists(contract_file(user_id, entity_id, contract_id)):
+        raise HTTPException(status_code=404, detail="Contratto non trovato.")
+    base = contract_docs_dir(user_id, entity_id, contract_id)
+    return _zip_response(user_id, _read_metas(base, sorted(_list_docs_in_dir(base))), f"contratto-{contract_id}.zip")
+
 @router.post("/users/{user_id}/entities/{entity_id}/contracts/{contract_id}/documents", response_model=CreateResponse)
 def create_contract_doc(user_id: str, entity_id: str, contract_id: str, payload: CreateDocumentRequest = Body(...)):
-    if not contract_file(user_id, entity_id, contract_id).exists():
+    if not path_exists(contract_file(user_id, entity_id, contract_id)):
         raise HTTPException(status_code=404, detail="Contratto non trovato.")
     doc_id = uuid.uuid4().hex
     meta = payload.meta.dict()
     meta.setdefault("metadati", {})["level"] = "CONTRATTO"
     if payload.content_base64:
-        h, rel = write_blob(user_id, base64.b64decode(payload.content_base64))
+        h, rel = write_blob(user_id, base64.b64decode(payload.content_base64), mime=meta.get("mime"))
         meta["hash"] = h
         meta["path_relativo"] = rel
-    _write_meta(contract_docs_dir(user_id, entity_id, contract_id), doc_id, meta)
+    _write_meta(user_id, contract_docs_dir(user_id, entity_id, contract_id), doc_id, meta)
+    return CreateResponse(id=doc_id)
+
+@router.post("/users/{user_id}/entities/{entity_id}/contracts/{contract_id}/documents/upload", response_model=CreateResponse)
+async def upload_contract_doc(user_id: str, entity_id: str, contract_id: str, request: Request,
+                              categoria: str = Query(...), nome_originale: str = Query(...),
+                              scope: Optional[str] = Query(None), mime: Optional[str] = Query(None),
+                              sha1: Optional[str] = Query(None, description="SHA1 atteso: se già presente l'upload si salta")):
+    if not path_exists(contract_file(user_id, entity_id, contract_id)):
+        raise HTTPException(status_code=404, detail="Contratto non trovato.")
+    meta = _upload_meta(request, "CONTRATTO", scope, categoria, nome_originale, mime)
+    await _spool_body(user_id, request, meta, sha1)
+    doc_id = uuid.uuid4().hex
+    await run_in_threadpool(_write_meta, user_id, contract_docs_dir(user_id, entity_id, contract_id), doc_id, meta)
     return CreateResponse(id=doc_id)
 
+@router.post("/users/{user_id}/entities/{entity_id}/contracts/{contract_id}/documents/uploads", response_model=UploadSession)
+def open_contract_upload(user_id: str, entity_id: str, contract_id: str, request: Request,
+                         categoria: str = Query(...), nome_originale: str = Query(...),
+                         size: int = Query(..., ge=0, description="Dimensione totale del file"),
+                         chunk_size: int = Query(UPLOAD_SESSION_CHUNK_SIZE, ge=1, le=UPLOAD_SESSION_MAX_CHUNK_SIZE),
+                         scope: Optional[str] = Query(None), mime: Optional[str] = Query(None),
+                         sha1: Optional[str] = Query(None, description="SHA1 atteso: se già presente il documento è creato subito")):
+    if not path_exists(contract_file(user_id, entity_id, contract_id)):
+        raise HTTPException(status_code=404, detail="Contratto non trovato.")
+    meta = _upload_meta(request, "CONTRATTO", scope, categoria, nome_originale, mime)
+    target = {"level": "CONTRATTO", "entity_id": entity_id, "contract_id": contract_id}
+    return _open_upload_session(user_id, target, meta, size, chunk_size, sha1)
+
 @router.get("/users/{user_id}/entities/{entity_id}/contracts/{contract_id}/documents/{doc_id}", response_model=Dict[str, Any])
 def get_contract_doc_meta(user_id: str, entity_id: str, contract_id: str, doc_id: str):
     return _read_meta(contract_docs_dir(user_id, entity_id, contract_id), doc_id)
 
 @router.get("/users/{user_id}/entities/{entity_id}/contracts/{contract_id}/documents/{doc_id}/download")
-def download_contract_doc(user_id: str, entity_id: str, contract_id: str, doc_id: str):
+def download_contract_doc(user_id: str, entity_id: str, contract_id: str, doc_id: str,
+                          request: Request, v: Optional[str] = Query(None, description="SHA1 del contenuto (URL immutabile)")):
     meta = _read_meta(contract_docs_dir(user_id, entity_id, contract_id), doc_id)
-    return _download(user_id, meta)
+    return _download(user_id, meta, request, v)
 
 @router.put("/users/{user_id}/entities/{entity_id}/contracts/{contract_id}/documents/{doc_id}", response_model=Dict[str, Any])
 def update_contract_doc(user_id: str, entity_id: str, contract_id: str, doc_id: str, payload: CreateDocumentRequest = Body(...)):
@@ -102,25 +461,19 @@ def update_contract_doc(user_id: str, entity_id: str, contract_id: str, doc_id:
         if old.get(k):
             meta.setdefault(k, old[k])
     if payload.content_base64:
-        h, rel = write_blob(user_id, base64.b64decode(payload.content_base64))
+        h, rel = write_blob(user_id, base64.b64decode(payload.content_base64), mime=meta.get("mime"))
         meta["hash"] = h
         meta["path_relativo"] = rel
-    _write_meta(base_dir, doc_id, meta)
+    _write_meta(user_id, base_dir, doc_id, meta, old.get("hash"))
     return {"doc_id": doc_id, **meta}
 
 @router.delete("/users/{user_id}/entities/{entity_id}/contracts/{contract_id}/documents/{doc_id}", response_model=DeleteResponse)
 def delete_contract_doc(user_id: str, entity_id: str, contract_id: str, doc_id: str, delete_blob: bool = Query(False)):
     base_dir = contract_docs_dir(user_id, entity_id, contract_id)
     mf = doc_meta_file(base_dir, doc_id)
-    if not mf.exists():
+    if not path_exists(mf):
         raise HTTPException(status_code=404, detail="Documento non trovato.")
-    sha1 = read_json(mf).get("hash")
-    mf.unlink()
-    if delete_blob and sha1 and count_blob_references(user_id, sha1) <= 1:
-        from app.utils.utils import blob_path_for_hash
-        path = blob_path_for_hash(user_id, sha1)
-        if path.exists():
-            path.unlink()
+    _delete_meta(user_id, mf, read_json(mf).get("hash"), delete_blob)
     return DeleteResponse(id=doc_id)
 
 # ============================================================================
@@ -128,51 +481,81 @@ def delete_contract_doc(user_id: str, entity_id: str, contract_id: str, doc_id:
 # ============================================================================
 @router.get("/users/{user_id}/entities/{entity_id}/contracts/{contract_id}/claims/{claim_id}/documents", response_model=List[str])
 def list_claim_docs(user_id: str, entity_id: str, contract_id: str, claim_id: str):
-    ids: set[str] = set()
+    # indice owner (cartella condivisa + legacy): nessuna lettura dei metadati
+    return sorted(list_owner_docs(user_id, entity_id, contract_id, "claims", claim_id))
+
+@router.get("/users/{user_id}/entities/{entity_id}/contracts/{contract_id}/claims/{claim_id}/documents.zip")
+def zip_claim_docs(user_id: str, entity_id: str, contract_id: str, claim_id: str):
+    if not path_exists(claim_file(user_id, entity_id, contract_id, claim_id)):
+        raise HTTPException(status_code=404, detail="Sinistro non trovato.")
+    # indice owner: doc_id → "shared"|"legacy" (stesse cartelle di list_claim_docs)
     shared_dir, legacy_dir = _claim_doc_bases(user_id, entity_id, contract_id, claim_id)
-    # nuovo schema: filtra per claim_id nel metadato
-    if shared_dir.exists():
-        for f in shared_dir.glob("*.json"):
-            try:
-                meta = read_json(f)
-            except Exception:
-                continue
-            if meta.get("claim_id") == claim_id:
-                ids.add(f.stem)
-    # legacy: cartella per-claim -> tutti i file sono del claim corrente
-    if legacy_dir.exists():
-        ids.update(p.stem for p in legacy_dir.glob("*.json"))
-    return sorted(ids)
+    owned = list_owner_docs(user_id, entity_id, contract_id, "claims", claim_id)
+    metas = [m for m in _read_metas(shared_dir, sorted(d for d, w in owned.items() if w == "shared"))
+             if m.get("claim_id") == claim_id]
+    metas += _read_metas(legacy_dir, sorted(d for d, w in owned.items() if w != "shared"))
+    return _zip_response(user_id, metas, f"sinistro-{claim_id}.zip")
 
 @router.post("/users/{user_id}/entities/{entity_id}/contracts/{contract_id}/claims/{claim_id}/documents", response_model=CreateResponse)
 def create_claim_doc(user_id: str, entity_id: str, contract_id: str, claim_id: str, payload: CreateDocumentRequest = Body(...)):
-    if not claim_file(user_id, entity_id, contract_id, claim_id).exists():
+    if not path_exists(claim_file(user_id, entity_id, contract_id, claim_id)):
         raise HTTPException(status_code=404, detail="Sinistro non trovato.")
     doc_id = uuid.uuid4().hex
     meta = payload.meta.dict()
     meta["claim_id"] = claim_id                    # ⛳️ associazione forte
     meta.setdefault("metadati", {})["level"] = "SINISTRO"
     if payload.content_base64:
-        h, rel = write_blob(user_id, base64.b64decode(payload.content_base64))
+        h, rel = write_blob(user_id, base64.b64decode(payload.content_base64), mime=meta.get("mime"))
         meta["hash"] = h
         meta["path_relativo"] = rel
     base = claim_docs_dir(user_id, entity_id, contract_id, claim_id)  # condiviso
-    _write_meta(base, doc_id, meta)
+    _write_meta(user_id, base, doc_id, meta)
+    doc_owner_add(user_id, entity_id, contract_id, "claims", claim_id, doc_id)
+    return CreateResponse(id=doc_id)
+
+@router.post("/users/{user_id}/entities/{entity_id}/contracts/{contract_id}/claims/{claim_id}/documents/upload", response_model=CreateResponse)
+async def upload_claim_doc(user_id: str, entity_id: str, contract_id: str, claim_id: str, request: Request,
+                           categoria: str = Query(...), nome_originale: str = Query(...),
+                           scope: Optional[str] = Query(None), mime: Optional[str] = Query(None),
+                           sha1: Optional[str] = Query(None, description="SHA1 atteso: se già presente l'upload si salta")):
+    if not path_exists(claim_file(user_id, entity_id, contract_id, claim_id)):
+        raise HTTPException(status_code=404, detail="Sinistro non trovato.")
+    meta = _upload_meta(request, "SINISTRO", scope, categoria, nome_originale, mime)
+    meta["claim_id"] = claim_id
+    await _spool_body(user_id, request, meta, sha1)
+    doc_id = uuid.uuid4().hex
+    base = claim_docs_dir(user_id, entity_id, contract_id, claim_id)
+    await run_in_threadpool(_write_meta, user_id, base, doc_id, meta)
+    await run_in_threadpool(doc_owner_add, user_id, entity_id, contract_id, "claims", claim_id, doc_id)
     return CreateResponse(id=doc_id)
 
+@router.post("/users/{user_id}/entities/{entity_id}/contracts/{contract_id}/claims/{claim_id}/documents/uploads", response_model=UploadSession)
+def open_claim_upload(user_id: str, entity_id: str, contract_id: str, claim_id: str, request: Request,
+                      categoria: str = Query(...), nome_originale: str = Query(...),
+                      size: int = Query(..., ge=0, description="Dimensione totale del file"),
+                      chunk_size: int = Query(UPLOAD_SESSION_CHUNK_SIZE, ge=1, le=UPLOAD_SESSION_MAX_CHUNK_SIZE),
+                      scope: Optional[str] = Query(None), mime: Optional[str] = Query(None),
+                      sha1: Optional[str] = Query(None, description="SHA1 atteso: se già presente il documento è creato subito")):
+    if not path_exists(claim_file(user_id, entity_id, contract_id, claim_id)):
+        raise HTTPException(status_code=404, detail="Sinistro non trovato.")
+    meta = _upload_meta(request, "SINISTRO", scope, categoria, nome_originale, mime)
+    meta["claim_id"] = claim_id
+    target = {"level": "SINISTRO", "entity_id": entity_id, "contract_id": contract_id, "owner_id": claim_id}
+    return _open_upload_session(user_id, target, meta, size, chunk_size, sha1)
+
 def _get_claim_doc_meta_any(user_id: str, entity_id: str, contract_id: str, claim_id: str, doc_id: str) -> tuple[Dict[str, Any], Path]:
     """Ritorna (meta, base_dir effettivo) cercando prima nello schema nuovo, poi nel legacy."""
     shared_dir, legacy_dir = _claim_doc_bases(user_id, entity_id, contract_id, claim_id)
     # nuovo schema (condiviso)
     mf = doc_meta_file(shared_dir, doc_id)
-    if mf.exists():
+    if path_exists(mf):
         meta = read_json(mf)
         if meta.get("claim_id") != claim_id:
             raise HTTPException(status_code=404, detail="Documento non associato a questo sinistro.")
         return meta, shared_dir
     # legacy (per-claim)
     mf2 = doc_meta_file(legacy_dir, doc_id)
-    if mf2.exists():
+    if path_exists(mf2):
         return read_json(mf2), legacy_dir
     raise HTTPException(status_code=404, detail="Documento non trovato.")
 
@@ -182,9 +565,10 @@ def get_claim_doc_meta(user_id: str, entity_id: str, contract_id: str, claim_id:
     return meta
 
 @router.get("/users/{user_id}/entities/{entity_id}/contracts/{contract_id}/claims/{claim_id}/documents/{doc_id}/download")
-def download_claim_doc(user_id: str, entity_id: str, contract_id: str, claim_id: str, doc_id: str):
+def download_claim_doc(user_id: str, entity_id: str, contract_id: str, claim_id: str, doc_id: str,
+                       request: Request, v: Optional[str] = Query(None, description="SHA1 del contenuto (URL immutabile)")):
     meta, _ = _get_claim_doc_meta_any(user_id, entity_id, contract_id, claim_id, doc_id)
-    return _download(user_id, meta)
+    return _download(user_id, meta, request, v)
 
 @router.put("/users/{user_id}/entities/{entity_id}/contracts/{contract_id}/claims/{claim_id}/documents/{doc_id}", response_model=Dict[str, Any])
 def update_claim_doc(user_id: str, entity_id: str, contract_id: str, claim_id: str, doc_id: str, payload: CreateDocumentRequest = Body(...)):
@@ -198,10 +582,10 @@ def update_claim_doc(user_id: str, entity_id: str, contract_id: str, claim_id: s
         if meta_old.get(k):
             meta.setdefault(k, meta_old[k])
     if payload.content_base64:
-        h, rel = write_blob(user_id, base64.b64decode(payload.content_base64))
+        h, rel = write_blob(user_id, base64.b64decode(payload.content_base64), mime=meta.get("mime"))
         meta["hash"] = h
         meta["path_relativo"] = rel
-    _write_meta(base_dir, doc_id, meta)
+    _write_meta(user_id, base_dir, doc_id, meta, meta_old.get("hash"))
     return {"doc_id": doc_id, **meta}
 
 @router.delete("/users/{user_id}/entities/{entity_id}/contracts/{contract_id}/claims/{claim_id}/documents/{doc_id}", response_model=DeleteResponse)
@@ -209,14 +593,10 @@ def delete_claim_doc(user_id: str, entity_id: str, contract_id: str, claim_id: s
     meta, base_dir = _get_claim_doc_meta_any(user_id, entity_id, contract_id, claim_id, doc_id)
     sha1 = meta.get("hash")
     mf = doc_meta_file(base_dir, doc_id)
-    if not mf.exists():
+    if not path_exists(mf):
         raise HTTPException(status_code=404, detail="Documento non trovato.")
-    mf.unlink()
-    if delete_blob and sha1 and count_blob_references(user_id, sha1) <= 1:
-        from app.utils.utils import blob_path_for_hash
-        p = blob_path_for_hash(user_id, sha1)
-        if p.exists():
-            p.unlink()
+    _delete_meta(user_id, mf, sha1, delete_blob)
+    doc_owner_remove(user_id, entity_id, contract_id, "claims", claim_id, doc_id)
     return DeleteResponse(id=doc_id)
 
 # ============================================================================
@@ -224,32 +604,63 @@ def delete_claim_doc(user_id: str, entity_id: str, contract_id: str, claim_id: s
 # ============================================================================
 @router.get("/users/{user_id}/entities/{entity_id}/contracts/{contract_id}/titles/{title_id}/documents", response_model=List[str])
 def list_title_docs(user_id: str, entity_id: str, contract_id: str, title_id: str):
+    return list(list_owner_docs(user_id, entity_id, contract_id, "titles", title_id))
+
+@router.get("/users/{user_id}/entities/{entity_id}/contracts/{contract_id}/titles/{title_id}/documents.zip")
+def zip_title_docs(user_id: str, entity_id: str, contract_id: str, title_id: str):
+    if not path_exists(title_file(user_id, entity_id, contract_id, title_id)):
+        raise HTTPException(status_code=404, detail="Titolo non trovato.")
     base = title_docs_dir(user_id, entity_id, contract_id, title_id)
-    ids: List[str] = []
-    for f in base.glob("*.json"):
-        try:
-            meta = read_json(f)
-        except Exception:
-            continue
-        if meta.get("title_id") == title_id:
-            ids.append(f.stem)
-    return ids
+    owned = sorted(list_owner_docs(user_id, entity_id, contract_id, "titles", title_id))
+    metas = [m for m in _read_metas(base, owned) if m.get("title_id") == title_id]
+    return _zip_response(user_id, metas, f"titolo-{title_id}.zip")
 
 @router.post("/users/{user_id}/entities/{entity_id}/contracts/{contract_id}/titles/{title_id}/documents", response_model=CreateResponse)
 def create_title_doc(user_id: str, entity_id: str, contract_id: str, title_id: str, payload: CreateDocumentRequest = Body(...)):
-    if not title_file(user_id, entity_id, contract_id, title_id).exists():
+    if not path_exists(title_file(user_id, entity_id, contract_id, title_id)):
         raise HTTPException(status_code=404, detail="Titolo non trovato.")
     doc_id = uuid.uuid4().hex
     meta = payload.meta.dict()
     meta["title_id"] = title_id
     meta.setdefault("metadati", {})["level"] = "TITOLO"
     if payload.content_base64:
-        h, rel = write_blob(user_id, base64.b64decode(payload.content_base64))
+        h, rel = write_blob(user_id, base64.b64decode(payload.content_base64), mime=meta.get("mime"))
         meta["hash"] = h
         meta["path_relativo"] = rel
-    _write_meta(title_docs_dir(user_id, entity_id, contract_id, title_id), doc_id, meta)
+    _write_meta(user_id, title_docs_dir(user_id, entity_id, contract_id, title_id), doc_id, meta)
+    doc_owner_add(user_id, entity_id, contract_id, "titles", title_id, doc_id)
     return CreateResponse(id=doc_id)
 
+@router.post("/users/{user_id}/entities/{entity_id}/contracts/{contract_id}/titles/{title_id}/documents/upload", response_model=CreateResponse)
+async def upload_title_doc(user_id: str, entity_id: str, contract_id: str, title_id: str, request: Request,
+                           categoria: str = Query(...), nome_originale: str = Query(...),
+                           scope: Optional[str] = Query(None), mime: Optional[str] = Query(None),
+                           sha1: Optional[str] = Query(None, description="SHA1 atteso: se già presente l'upload si salta")):
+    if not path_exists(title_file(user_id, entity_id, contract_id, title_id)):
+        raise HTTPException(status_code=404, detail="Titolo non trovato.")
+    meta = _upload_meta(request, "TITOLO", scope, categoria, nome_originale, mime)
+    meta["title_id"] = title_id
+    await _spool_body(user_id, request, meta, sha1)
+    doc_id = uuid.uuid4().hex
+    base = title_docs_dir(user_id, entity_id, contract_id, title_id)
+    await run_in_threadpool(_write_meta, user_id, base, doc_id, meta)
+    await run_in_threadpool(doc_owner_add, user_id, entity_id, contract_id, "titles", title_id, doc_id)
+    return CreateResponse(id=doc_id)
+
+@router.post("/users/{user_id}/entities/{entity_id}/contracts/{contract_id}/titles/{title_id}/documents/uploads", response_model=UploadSession)
+def open_title_upload(user_id: str, entity_id: str, contract_id: str, title_id: str, request: Request,
+                      categoria: str = Query(...), nome_originale: str = Query(...),
+                      size: int = Query(..., ge=0, description="Dimensione totale del file"),
+                      chunk_size: int = Query(UPLOAD_SESSION_CHUNK_SIZE, ge=1, le=UPLOAD_SESSION_MAX_CHUNK_SIZE),
+                      scope: Optional[str] = Query(None), mime: Optional[str] = Query(None),
+                      sha1: Optional[str] = Query(None, description="SHA1 atteso: se già presente il documento è creato subito")):
+    if not path_exists(title_file(user_id, entity_id, contract_id, title_id)):
+        raise HTTPException(status_code=404, detail="Titolo non trovato.")
+    meta = _upload_meta(request, "TITOLO", scope, categoria, nome_originale, mime)
+    meta["title_id"] = title_id
+    target = {"level": "TITOLO", "entity_id": entity_id, "contract_id": contract_id, "owner_id": title_id}
+    return _open_upload_session(user_id, target, meta, size, chunk_size, sha1)
+
 @router.get("/users/{user_id}/entities/{entity_id}/contracts/{contract_id}/titles/{title_id}/documents/{doc_id}", response_model=Dict[str, Any])
 def get_title_doc_meta(user_id: str, entity_id: str, contract_id: str, title_id: str, doc_id: str):
     base = title_docs_dir(user_id, entity_id, contract_id, title_id)
@@ -259,12 +670,13 @@ def get_title_doc_meta(user_id: str, entity_id: str, contract_id: str, title_id:
     return meta
 
 @router.get("/users/{user_id}/entities/{entity_id}/contracts/{contract_id}/titles/{title_id}/documents/{doc_id}/download")
-def download_title_doc(user_id: str, entity_id: str, contract_id: str, title_id: str, doc_id: str):
+def download_title_doc(user_id: str, entity_id: str, contract_id: str, title_id: str, doc_id: str,
+                       request: Request, v: Optional[str] = Query(None, description="SHA1 del contenuto (URL immutabile)")):
     base = title_docs_dir(user_id, entity_id, contract_id, title_id)
     meta = _read_meta(base, doc_id)
     if meta.get("title_id") != title_id:
         raise HTTPException(status_code=404, detail="Documento non associato a questo titolo.")
-    return _download(user_id, meta)
+    return _download(user_id, meta, request, v)
 
 @router.put("/users/{user_id}/entities/{entity_id}/contracts/{contract_id}/titles/{title_id}/documents/{doc_id}", response_model=Dict[str, Any])
 def update_title_doc(user_id: str, entity_id: str, contract_id: str, title_id: str, doc_id: str, payload: CreateDocumentRequest = Body(...)):
@@ -279,26 +691,22 @@ def update_title_doc(user_id: str, entity_id: str, contract_id: str, title_id: s
         if old.get(k):
             meta.setdefault(k, old[k])
     if payload.content_base64:
-        h, rel = write_blob(user_id, base64.b64decode(payload.content_base64))
+        h, rel = write_blob(user_id, base64.b64decode(payload.content_base64), mime=meta.get("mime"))
         meta["hash"] = h
         meta["path_relativo"] = rel
-    _write_meta(base, doc_id, meta)
+    _write_meta(user_id, base, doc_id, meta, old.get("hash"))
     return {"doc_id": doc_id, **meta}
 
 @router.delete("/users/{user_id}/entities/{entity_id}/contracts/{contract_id}/titles/{title_id}/documents/{doc_id}", response_model=DeleteResponse)
 def delete_title_doc(user_id: str, entity_id: str, contract_id: str, title_id: str, doc_id: str, delete_blob: bool = Query(False)):
     base = title_docs_dir(user_id, entity_id, contract_id, title_id)
     mf = doc_meta_file(base, doc_id)
-    if not mf.exists():
+    if not path_exists(mf):
         raise HTTPException(status_code=404, detail="Documento non trovato.")
     meta = read_json(mf)
     if meta.get("title_id") != title_id:
         raise HTTPException(status_code=404, detail="Documento non associato a questo titolo.")
     sha1 = meta.get("hash")
-    mf.unlink()
-    if delete_blob and sha1 and count_blob_references(user_id, sha1) <= 1:
-        from app.utils.utils import blob_path_for_hash
-        p = blob_path_for_hash(user_id, sha1)
-        if p.exists():
-            p.unlink()
+    _delete_meta(user_id, mf, sha1, delete_blob)
+    doc_owner_remove(user_id, entity_id, contract_id, "titles", title_id, doc_id)
     return DeleteResponse(id=doc_id)
@@ -1,11 +1,13 @@
 from __future__ import annotations
-from typing import List
+from typing import Any, Dict, List
 from fastapi import APIRouter, Body, HTTPException, Path as FPath, status
 from app.models.entity import Entity
 from app.models.responses import DeleteResponse
 from app.utils.utils import entity_file, entities_dir, entity_dir
-from app.utils.utils import atomic_write_json, read_json
-import shutil
+from app.utils.utils import atomic_write_json, read_json, path_exists, list_dirs, remove_tree
+from app.utils.utils import raw_json_responses, stored_json_response
+from app.utils.utils import MERGE_PATCH_MEDIA_TYPE, merge_patch, validate_merged, same_as_stored
+from app.services.indexes import entity_lock, remove_entity_due, release_blob_refs_under
 
 router = APIRouter(prefix="/users/{user_id}/entities", tags=["Entities"])
 USER_ID_DOC = "ID utente (cartella primo livello)"
@@ -16,18 +18,19 @@ def create_entity(user_id: str = FPath(..., description=USER_ID_DOC),
                   entity_id: str = FPath(..., description=ENTITY_ID_DOC),
                   payload: Entity = Body(...)):
     ef = entity_file(user_id, entity_id)
-    if ef.exists(): raise HTTPException(status_code=409, detail="Entità già esistente.")
+    if path_exists(ef): raise HTTPException(status_code=409, detail="Entità già esistente.")
     atomic_write_json(ef, payload.dict()); return payload
 
 @router.get("", response_model=List[str])
 def list_entities(user_id: str = FPath(..., description=USER_ID_DOC)):
-    return [p.name for p in entities_dir(user_id).iterdir() if p.is_dir()]
+    return list_dirs(entities_dir(user_id))
 
 @router.get("/{entity_id}", response_model=Entity)
 def get_entity(user_id: str = FPath(..., description=USER_ID_DOC),
                entity_id: str = FPath(..., description=ENTITY_ID_DOC)):
     ef = entity_file(user_id, entity_id)
-    if not ef.exists(): raise HTTPException(status_code=404, detail="Entità non trovata.")
+    if not path_exists(ef): raise HTTPException(status_code=404, detail="Entità non trovata.")
+    if raw_json_responses(): return stored_json_response(ef)
     return read_json(ef)
 
 @router.put("/{entity_id}", response_model=Entity)
@@ -35,12 +38,30 @@ def update_entity(user_id: str = FPath(..., description=USER_ID_DOC),
                   entity_id: str = FPath(..., description=ENTITY_ID_DOC),
                   payload: Entity = Body(...)):
     ef = entity_file(user_id, entity_id)
-    if not ef.exists(): raise HTTPException(status_code=404, detail="Entità non trovata.")
+    if not path_exists(ef): raise HTTPException(status_code=404, detail="Entità non trovata.")
     atomic_write_json(ef, payload.dict()); return payload
 
+@router.patch("/{entity_id}", response_model=Entity)
+def patch_entity(user_id: str = FPath(..., description=USER_ID_DOC),
+                 entity_id: str = FPath(..., description=ENTITY_ID_DOC),
+                 patch: Dict[str, Any] = Body(..., media_type=MERGE_PATCH_MEDIA_TYPE)):
+    ef = entity_file(user_id, entity_id)
+    with entity_lock(user_id, entity_id):
+        if not path_exists(ef): raise HTTPException(status_code=404, detail="Entità non trovata.")
+        current = read_json(ef)
+        merged = merge_patch(current, patch)
+        if merged == current: return current  # patch senza effetto: nessuna scrittura
+        payload = validate_merged(Entity, merged)
+        data = payload.dict()
+        if not same_as_stored(data, current):
+            atomic_write_json(ef, data)
+    return payload
+
 @router.delete("/{entity_id}", response_model=DeleteResponse)
 def delete_entity(user_id: str = FPath(..., description=USER_ID_DOC),
                   entity_id: str = FPath(..., description=ENTITY_ID_DOC)):
     edir = entity_dir(user_id, entity_id)
-    if not edir.exists(): raise HTTPException(status_code=404, detail="Entità non trovata.")
-    shutil.rmtree(edir); return DeleteResponse(id=entity_id)
+    if not path_exists(edir): raise HTTPException(status_code=404, detail="Entità non trovata.")
+    release_blob_refs_under(user_id, edir)
+    remove_tree(edir); remove_entity_due(user_id, entity_id)
+    return DeleteResponse(id=entity_id)
@@ -0,0 +1,44 @@
+from __future__ import annotations
+import tempfile
+from typing import Optional
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from app.config import UPLOAD_CHUNK_SIZE
+from app.utils.utils import get_codec
+from app.services.bulk_import import FORMATS, KINDS, detect_format, run_import
+
+router = APIRouter(prefix="/users/{user_id}/import", tags=["Import"])
+
+@router.post("", summary="Import massivo di entità e contratti (NDJSON o CSV)")
+async def bulk_import(user_id: str, request: Request,
+                      fmt: Optional[str] = Query(None, alias="format", description="ndjson | csv (default: da Content-Type)"),
+                      kind: Optional[str] = Query(None, description="Tipo dei record senza campo 'type': entity | contract"),
+                      skip_existing: bool = Query(False, description="Non sovrascrive entità/contratti già presenti")):
+    fmt = fmt or detect_format(request.headers.get("content-type"))
+    if fmt not in FORMATS or (kind and kind not in KINDS):
+        raise HTTPException(status_code=422, detail=f"format in {FORMATS}, kind in {KINDS}.")
+    # corpo su un temporaneo a blocchi (memoria costante), poi import con
+    # avanzamento in streaming: una riga NDJSON per evento (progress/rejected/done)
+    spool = await run_in_threadpool(tempfile.TemporaryFile)
+    try:
+        buf = bytearray()
+        async for chunk in request.stream():
+            buf += chunk
+            if len(buf) >= UPLOAD_CHUNK_SIZE:
+                data, buf = bytes(buf), bytearray()
+                await run_in_threadpool(spool.write, data)
+        await run_in_threadpool(spool.write, bytes(buf))
+        spool.seek(0)
+    except BaseException:
+        spool.close()
+        raise
+    codec = get_codec()
+
+    def events():
+        try:
+            for ev in run_import(user_id, spool, fmt, kind, skip_existing):
+                yield codec.dumps(ev) + b"\n"
+        finally:
+            spool.close()
+    return StreamingResponse(events(), media_type="application/x-ndjson")
@@ -1,11 +1,16 @@
 from __future__ import annotations
 from typing import List, Dict, Any
-from fastapi import APIRouter, Body, HTTPException
+from fastapi import APIRouter, Body, HTTPException, Query
+from pydantic import ValidationError
+from app.config import BATCH_MAX_ITEMS
 from app.models.title import Titolo
-from app.models.responses import DeleteResponse
+from app.models.responses import DeleteResponse, BatchItemResult, BatchResponse
 from app.utils.utils import titles_dir, title_file, contract_file
-from app.utils.utils import atomic_write_json, read_json
-from app.services.indexes import rebuild_entity_views
+from app.utils.utils import atomic_write_json, read_json, path_exists, list_json, remove_file
+from app.utils.utils import raw_json_responses, stored_json_response
+from app.utils.utils import MERGE_PATCH_MEDIA_TYPE, merge_patch, validate_merged, same_as_stored
+from app.services.indexes import upsert_title_view, remove_title_view, upsert_title_due, remove_title_due
+from app.services.indexes import upsert_title_views, upsert_titles_due, entity_lock
 import uuid
 
 router = APIRouter(prefix="/users/{user_id}/entities/{entity_id}/contracts/{contract_id}/titles", tags=["Titles"])
@@ -13,33 +18,97 @@ router = APIRouter(prefix="/users/{user_id}/entities/{entity_id}/contracts/{cont
 @router.post("", response_model=dict)
 def create_title(user_id: str, entity_id: str, contract_id: str, payload: Titolo = Body(...)):
     cf = contract_file(user_id, entity_id, contract_id)
-    if not cf.exists(): raise HTTPException(status_code=404, detail="Contratto non trovato.")
+    if not path_exists(cf): raise HTTPException(status_code=404, detail="Contratto non trovato.")
     contract = read_json(cf)
     payload.numero_polizza = contract["Identificativi"]["NumeroPolizza"]
     payload.entity_id = entity_id
     title_id = uuid.uuid4().hex
-    atomic_write_json(title_file(user_id, entity_id, contract_id, title_id), payload.dict())
-    rebuild_entity_views(user_id, entity_id)
+    data = payload.dict()
+    atomic_write_json(title_file(user_id, entity_id, contract_id, title_id), data)
+    upsert_title_view(user_id, entity_id, contract_id, title_id, data, contract)
+    upsert_title_due(user_id, entity_id, contract_id, title_id, data)
     return {"title_id": title_id, "titolo": payload}
 
+@router.post("/batch", response_model=BatchResponse)
+def create_titles_batch(user_id: str, entity_id: str, contract_id: str, payload: List[Any] = Body(...),
+                        all_or_nothing: bool = Query(False, description="Se un elemento non è valido non si scrive nulla (422)")):
+    # piano rate in una richiesta: contratto letto una volta, vista e indice
+    # scadenze aggiornati una volta sola per tutto il lotto
+    if len(payload) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"Al massimo {BATCH_MAX_ITEMS} titoli per richiesta.")
+    cf = contract_file(user_id, entity_id, contract_id)
+    if not path_exists(cf): raise HTTPException(status_code=404, detail="Contratto non trovato.")
+    contract = read_json(cf)
+    items: List[BatchItemResult] = []
+    valid: Dict[str, Dict[str, Any]] = {}
+    for i, raw in enumerate(payload):
+        if not isinstance(raw, dict):
+            items.append(BatchItemResult(index=i, errors=[{"type": "dict_type", "loc": [], "msg": "Atteso un oggetto titolo"}]))
+            continue
+        try:
+            t = Titolo(**raw)
+        except ValidationError as e:
+            items.append(BatchItemResult(index=i, errors=e.errors(include_url=False, include_context=False)))
+            continue
+        t.numero_polizza = contract["Identificativi"]["NumeroPolizza"]
+        t.entity_id = entity_id
+        title_id = uuid.uuid4().hex
+        valid[title_id] = t.dict()
+        items.append(BatchItemResult(index=i, id=title_id))
+    failed = len(payload) - len(valid)
+    if failed and all_or_nothing:
+        for it in items:
+            it.id = None
+        raise HTTPException(status_code=422, detail=BatchResponse(created=0, failed=failed, items=items).dict())
+    for title_id, data in valid.items():
+        atomic_write_json(title_file(user_id, entity_id, contract_id, title_id), data)
+    upsert_title_views(user_id, entity_id, contract_id, valid, contract)
+    upsert_titles_due(user_id, entity_id, contract_id, valid)
+    return BatchResponse(created=len(valid), failed=failed, items=items)
+
 @router.get("", response_model=List[str])
 def list_titles(user_id: str, entity_id: str, contract_id: str):
-    return [p.stem for p in titles_dir(user_id, entity_id, contract_id).rglob("*.json") if p.parent.name != "documents"]
+    return list_json(titles_dir(user_id, entity_id, contract_id))
 
 @router.get("/{title_id}", response_model=Titolo)
 def get_title(user_id: str, entity_id: str, contract_id: str, title_id: str):
     tf = title_file(user_id, entity_id, contract_id, title_id)
-    if not tf.exists(): raise HTTPException(status_code=404, detail="Titolo non trovato.")
+    if not path_exists(tf): raise HTTPException(status_code=404, detail="Titolo non trovato.")
+    if raw_json_responses(): return stored_json_response(tf)
     return read_json(tf)
 
 @router.put("/{title_id}", response_model=Titolo)
 def update_title(user_id: str, entity_id: str, contract_id: str, title_id: str, payload: Titolo = Body(...)):
     tf = title_file(user_id, entity_id, contract_id, title_id)
-    if not tf.exists(): raise HTTPException(status_code=404, detail="Titolo non trovato.")
-    atomic_write_json(tf, payload.dict()); rebuild_entity_views(user_id, entity_id); return payload
+    if not path_exists(tf): raise HTTPException(status_code=404, detail="Titolo non trovato.")
+    data = payload.dict()
+    atomic_write_json(tf, data)
+    upsert_title_view(user_id, entity_id, contract_id, title_id, data, read_json(contract_file(user_id, entity_id, contract_id)))
+    upsert_title_due(user_id, entity_id, contract_id, title_id, data)
+    return payload
+
+@router.patch("/{title_id}", response_model=Titolo)
+def patch_title(user_id: str, entity_id: str, contract_id: str, title_id: str,
+                patch: Dict[str, Any] = Body(..., media_type=MERGE_PATCH_MEDIA_TYPE)):
+    tf = title_file(user_id, entity_id, contract_id, title_id)
+    with entity_lock(user_id, entity_id):
+        if not path_exists(tf): raise HTTPException(status_code=404, detail="Titolo non trovato.")
+        current = read_json(tf)
+        merged = merge_patch(current, patch)
+        if merged == current: return current  # patch senza effetto: niente scrittura né indici
+        payload = validate_merged(Titolo, merged)
+        data = payload.dict()
+        if same_as_stored(data, current): return payload
+        atomic_write_json(tf, data)
+        upsert_title_view(user_id, entity_id, contract_id, title_id, data, read_json(contract_file(user_id, entity_id, contract_id)))
+        upsert_title_due(user_id, entity_id, contract_id, title_id, data)
+    return payload
 
 @router.delete("/{title_id}", response_model=DeleteResponse)
 def delete_title(user_id: str, entity_id: str, contract_id: str, title_id: str):
     tf = title_file(user_id, entity_id, contract_id, title_id)
-    if not tf.exists(): raise HTTPException(status_code=404, detail="Titolo non trovato.")
-    tf.unlink(); rebuild_entity_views(user_id, entity_id); return DeleteResponse(id=title_id)
+    if not path_exists(tf): raise HTTPException(status_code=404, detail="Titolo non trovato.")
+    remove_file(tf)
+    remove_title_view(user_id, entity_id, contract_id, title_id)
+    remove_title_due(user_id, entity_id, contract_id, title_id)
+    return DeleteResponse(id=title_id)
@@ -1,34 +1,153 @@
 from __future__ import annotations
-from typing import Dict, Any, List
-from fastapi import APIRouter, HTTPException
-from app.services.indexes import rebuild_entity_views, compute_due_indexes
-from app.utils.utils import views_dir_for_entity, by_policy_dir
-from app.utils.utils import read_json
+from datetime import date
+from typing import Dict, Any, List, Optional
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.responses import Response
+from app.services.indexes import rebuild_entity_views, compute_due_indexes, rebuild_due_index, load_view
+from app.services.view_query import VIEW_QUERY_MAX_LIMIT, TITLES_SPEC, CLAIMS_SPEC, ViewSpec, split_csv, query_view
+from app.services.view_aggregate import (
+    TITLES_AGG, CLAIMS_AGG, AggSpec, parse_metrics, check_keys, aggregate_entity_view, aggregate_user_views
+)
+from app.utils.utils import views_dir_for_entity, by_policy_dir, entities_dir, list_dirs
+from app.utils.utils import read_json, path_exists, raw_json_responses, stored_json_response, json_codec
 
 router = APIRouter(tags=["Views"])
 
+def _view(user_id: str, entity_id: str, name: str):
+    res = load_view(user_id, entity_id, name)
+    if res is None: return []
+    rows, (_, deltas) = res
+    if not raw_json_responses(): return rows
+    # snapshot senza delta in sospeso: i byte salvati sono già la vista
+    if not deltas: return stored_json_response(views_dir_for_entity(user_id, entity_id) / name)
+    return Response(content=json_codec().dumps(rows), media_type="application/json")
+
+def _query(user_id: str, entity_id: str, name: str, spec: ViewSpec, filters: Dict[str, Optional[List[str]]],
+           dal: Optional[date], al: Optional[date], sort: Optional[str], fields: Optional[str],
+           limit: Optional[int], cursor: Optional[str]) -> Response:
+    # il corpo resta una lista (come senza parametri); totale e cursore negli header
+    res = load_view(user_id, entity_id, name)
+    rows = res[0] if res else []
+    res = query_view(rows, spec, {k: split_csv(v) for k, v in filters.items()},
+                     dal.isoformat() if dal else None, al.isoformat() if al else None,
+                     split_csv([sort] if sort else None), split_csv([fields] if fields else None), limit, cursor)
+    headers = {"X-Total-Count": str(res["total"])}
+    if res["next_cursor"]:
+        headers["X-Next-Cursor"] = res["next_cursor"]
+    return Response(content=json_codec().dumps(res["items"]), media_type="application/json", headers=headers)
+
+_SORT_DOC = "Campi di ordinamento separati da virgola, '-' = decrescente (es. -premio,scadenza_titolo)"
+_FIELDS_DOC = "Proiezione: campi da restituire, separati da virgola"
+_CURSOR_DOC = "Valore dell'header X-Next-Cursor della pagina precedente (stessi filtri e sort)"
+
 @router.get("/users/{user_id}/entities/{entity_id}/titles", response_model=List[Dict[str, Any]], summary="Vista titoli per Entità")
-def view_entity_titles(user_id: str, entity_id: str):
-    f = views_dir_for_entity(user_id, entity_id) / "titles_index.json"
-    if not f.exists(): rebuild_entity_views(user_id, entity_id)
-    return read_json(f) if f.exists() else []
+def view_entity_titles(user_id: str, entity_id: str, request: Request,
+                       stato: Optional[List[str]] = Query(None), compagnia: Optional[List[str]] = Query(None),
+                       rischio: Optional[List[str]] = Query(None), contract_id: Optional[List[str]] = Query(None),
+                       numero_polizza: Optional[List[str]] = Query(None),
+                       scadenza_dal: Optional[date] = Query(None), scadenza_al: Optional[date] = Query(None),
+                       sort: Optional[str] = Query(None, description=_SORT_DOC),
+                       fields: Optional[str] = Query(None, description=_FIELDS_DOC),
+                       limit: Optional[int] = Query(None, ge=1, le=VIEW_QUERY_MAX_LIMIT),
+                       cursor: Optional[str] = Query(None, description=_CURSOR_DOC)):
+    if not request.query_params:
+        return _view(user_id, entity_id, "titles_index.json")
+    filters = {"stato": stato, "compagnia": compagnia, "rischio": rischio,
+               "contract_id": contract_id, "numero_polizza": numero_polizza}
+    return _query(user_id, entity_id, "titles_index.json", TITLES_SPEC, filters,
+                  scadenza_dal, scadenza_al, sort, fields, limit, cursor)
 
 @router.get("/users/{user_id}/entities/{entity_id}/claims", response_model=List[Dict[str, Any]], summary="Vista sinistri per Entità")
-def view_entity_claims(user_id: str, entity_id: str):
-    f = views_dir_for_entity(user_id, entity_id) / "claims_index.json"
-    if not f.exists(): rebuild_entity_views(user_id, entity_id)
-    return read_json(f) if f.exists() else []
+def view_entity_claims(user_id: str, entity_id: str, request: Request,
+                       stato: Optional[List[str]] = Query(None), compagnia: Optional[List[str]] = Query(None),
+                       rischio: Optional[List[str]] = Query(None), contract_id: Optional[List[str]] = Query(None),
+                       esercizio: Optional[List[str]] = Query(None),
+                       accadimento_dal: Optional[date] = Query(None), accadimento_al: Optional[date] = Query(None),
+                       sort: Optional[str] = Query(None, description=_SORT_DOC),
+                       fields: Optional[str] = Query(None, description=_FIELDS_DOC),
+                       limit: Optional[int] = Query(None, ge=1, le=VIEW_QUERY_MAX_LIMIT),
+                       cursor: Optional[str] = Query(None, description=_CURSOR_DOC)):
+    if not request.query_params:
+        return _view(user_id, entity_id, "claims_index.json")
+    filters = {"stato": stato, "compagnia": compagnia, "rischio": rischio,
+               "contract_id": contract_id, "esercizio": esercizio}
+    return _query(user_id, entity_id, "claims_index.json", CLAIMS_SPEC, filters,
+                  accadimento_dal, accadimento_al, sort, fields, limit, cursor)
+
+# ---- aggregazioni group-by (solo i gruppi in risposta) ----------------------
+_GROUP_BY_DOC = "Chiavi di raggruppamento separate da virgola (es. stato,compagnia); vuoto = un solo gruppo"
+_METRICS_DOC = "count, sum:campo, min:campo, max:campo (separate da virgola o ripetute)"
+
+def _aggregate(user_id: str, entity_id: Optional[str], spec: AggSpec, group_by: Optional[str],
+               metrics: Optional[List[str]], filters: Dict[str, Optional[List[str]]]) -> Dict[str, Any]:
+    keys = split_csv([group_by] if group_by else None)
+    flt = {k: split_csv(v) for k, v in filters.items()}
+    extra = () if entity_id else ("entity_id",)
+    check_keys(keys, flt, spec, extra)
+    ms = parse_metrics(split_csv(metrics), spec)
+    if entity_id:
+        return aggregate_entity_view(user_id, entity_id, spec, keys, flt, ms)
+    return aggregate_user_views(user_id, list_dirs(entities_dir(user_id)), spec, keys, flt, ms)
+
+@router.get("/users/{user_id}/entities/{entity_id}/titles/aggregate", response_model=Dict[str, Any], summary="Aggregazioni titoli per Entità")
+def aggregate_entity_titles(user_id: str, entity_id: str,
+                            group_by: Optional[str] = Query(None, description=_GROUP_BY_DOC),
+                            metrics: Optional[List[str]] = Query(None, description=_METRICS_DOC),
+                            stato: Optional[List[str]] = Query(None), compagnia: Optional[List[str]] = Query(None),
+                            rischio: Optional[List[str]] = Query(None), contract_id: Optional[List[str]] = Query(None),
+                            numero_polizza: Optional[List[str]] = Query(None)):
+    filters = {"stato": stato, "compagnia": compagnia, "rischio": rischio,
+               "contract_id": contract_id, "numero_polizza": numero_polizza}
+    return _aggregate(user_id, entity_id, TITLES_AGG, group_by, metrics, filters)
+
+@router.get("/users/{user_id}/entities/{entity_id}/claims/aggregate", response_model=Dict[str, Any], summary="Aggregazioni sinistri per Entità")
+def aggregate_entity_claims(user_id: str, entity_id: str,
+                            group_by: Optional[str] = Query(None, description=_GROUP_BY_DOC),
+                            metrics: Optional[List[str]] = Query(None, description=_METRICS_DOC),
+                            stato: Optional[List[str]] = Query(None), compagnia: Optional[List[str]] = Query(None),
+                            rischio: Optional[List[str]] = Query(None), contract_id: Optional[List[str]] = Query(None),
+                            esercizio: Optional[List[str]] = Query(None), intermediario: Optional[List[str]] = Query(None)):
+    filters = {"stato": stato, "compagnia": compagnia, "rischio": rischio,
+               "contract_id": contract_id, "esercizio": esercizio, "intermediario": intermediario}
+    return _aggregate(user_id, entity_id, CLAIMS_AGG, group_by, metrics, filters)
+
+@router.get("/users/{user_id}/titles/aggregate", response_model=Dict[str, Any], summary="Aggregazioni titoli su tutte le Entità")
+def aggregate_user_titles(user_id: str,
+                          group_by: Optional[str] = Query(None, description=_GROUP_BY_DOC + "; ammessa anche entity_id"),
+                          metrics: Optional[List[str]] = Query(None, description=_METRICS_DOC),
+                          entity_id: Optional[List[str]] = Query(None),
+                          stato: Optional[List[str]] = Query(None), compagnia: Optional[List[str]] = Query(None),
+                          rischio: Optional[List[str]] = Query(None), numero_polizza: Optional[List[str]] = Query(None)):
+    filters = {"entity_id": entity_id, "stato": stato, "compagnia": compagnia, "rischio": rischio,
+               "numero_polizza": numero_polizza}
+    return _aggregate(user_id, None, TITLES_AGG, group_by, metrics, filters)
+
+@router.get("/users/{user_id}/claims/aggregate", response_model=Dict[str, Any], summary="Aggregazioni sinistri su tutte le Entità")
+def aggregate_user_claims(user_id: str,
+                          group_by: Optional[str] = Query(None, description=_GROUP_BY_DOC + "; ammessa anche entity_id"),
+                          metrics: Optional[List[str]] = Query(None, description=_METRICS_DOC),
+                          entity_id: Optional[List[str]] = Query(None),
+                          stato: Optional[List[str]] = Query(None), compagnia: Optional[List[str]] = Query(None),
+                          rischio: Optional[List[str]] = Query(None), esercizio: Optional[List[str]] = Query(None),
+                          intermediario: Optional[List[str]] = Query(None)):
+    filters = {"entity_id": entity_id, "stato": stato, "compagnia": compagnia, "rischio": rischio,
+               "esercizio": esercizio, "intermediario": intermediario}
+    return _aggregate(user_id, None, CLAIMS_AGG, group_by, metrics, filters)
+
+@router.post("/users/{user_id}/entities/{entity_id}/views/rebuild", response_model=Dict[str, int], summary="Rigenera le viste dell'Entità (riparazione)")
+def rebuild_views(user_id: str, entity_id: str):
+    return rebuild_entity_views(user_id, entity_id)
 
 @router.get("/users/{user_id}/search/policy/{numero_polizza}", response_model=Dict[str, Any], summary="Ricerca per Numero Polizza")
 def search_by_policy(user_id: str, numero_polizza: str):
     f = by_policy_dir(user_id) / f"{numero_polizza}.json"
-    if not f.exists(): raise HTTPException(status_code=404, detail="Numero polizza non indicizzato.")
+    if not path_exists(f): raise HTTPException(status_code=404, detail="Numero polizza non indicizzato.")
     return read_json(f)
 
 @router.get("/users/{user_id}/dashboard/due", response_model=Dict[str, Any], summary="Scadenze contratti/titoli entro N giorni")
 def dashboard_due(user_id: str, days: int = 120):
+    return compute_due_indexes(user_id, days)
 
-    res = compute_due_indexes(user_id, days)
-    print(res)
-
-    return res
+@router.post("/users/{user_id}/dashboard/due/rebuild", response_model=Dict[str, int], summary="Rigenera l'indice scadenze (riparazione)")
+def rebuild_dashboard_due(user_id: str):
+    return rebuild_due_index(user_id)
@@ -0,0 +1,265 @@
+from __future__ import annotations
+import base64
+import binascii
+import uuid
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+from fastapi import HTTPException
+from pydantic import ValidationError
+
+from app.config import ROOT_DATA_DIR
+from app.models.claim import Sinistro, DiarioEntry
+from app.models.contract import ContrattoOmnia8
+from app.models.document import CreateDocumentRequest
+from app.models.responses import BatchOperation
+from app.models.title import Titolo
+from app.utils.utils import (
+    entity_file, contract_file, title_file, claim_file, diary_file, doc_meta_file,
+    contract_docs_dir, claim_docs_dir, title_docs_dir, sanitize_id, path_exists, read_json,
+    storage_backend, write_blob, commit_json_txn, recover_json_txns
+)
+from app.services.indexes import (
+    entity_lock, update_by_policy_index, apply_view_deltas, apply_due_deltas,
+    doc_owner_add, blob_ref_take, blob_ref_decr, rebuild_entity_views, rebuild_due_index
+)
+
+# =============================================================================
+# Batch di operazioni su un'entità (POST .../entities/{entity_id}/batch)
+#   piano   → sotto il lock dell'entità ogni operazione è validata contro lo
+#             stato su disco + le scritture delle operazioni precedenti
+#             (overlay in memoria); al primo errore non si scrive nulla
+#   commit  → blob dei documenti, poi commit_json_txn: tutti i JSON o nessuno
+#   indici  → dopo il commit, una volta per batch: viste, scadenze, by_policy,
+#             owner dei documenti, refcount blob (ricostruibili se interrotti)
+# =============================================================================
+class _Plan:
+    def __init__(self, user_id: str, entity_id: str):
+        self.user_id = user_id
+        self.entity_id = entity_id
+        self.files: Dict[Path, Optional[Any]] = {}       # path → dati (None = eliminato)
+        self.refs: Dict[str, str] = {}
+        self.contracts: Dict[str, Dict[str, Any]] = {}   # contratti scritti
+        self.titles: Dict[tuple, Optional[Dict[str, Any]]] = {}
+        self.claims: Dict[tuple, Optional[Dict[str, Any]]] = {}
+        self.blobs: List[tuple[Dict[str, Any], bytes]] = []  # (meta, contenuto) da scrivere
+        self.owners: List[tuple[str, str, str, str]] = []    # (contract_id, kind, owner_id, doc_id)
+
+    def exists(self, p: Path) -> bool:
+        return self.files[p] is not None if p in self.files else path_exists(p)
+
+    def read(self, p: Path) -> Any:
+        return self.files[p] if p in self.files else read_json(p)
+
+    def id(self, op: BatchOperation, field: str) -> str:
+        v = getattr(op, field)
+        if not v:
+            raise HTTPException(status_code=422, detail=f"{field} obbligatorio per {op.op}.")
+        if v.startswith("$"):
+            if v[1:] not in self.refs:
+                raise HTTPException(status_code=422, detail=f"Riferimento {v!r} non definito da un'operazione precedente.")
+            return self.refs[v[1:]]
+        return sanitize_id(v, field)
+
+    def contract(self, op: BatchOperation) -> tuple[str, Dict[str, Any]]:
+        cid = self.id(op, "contract_id")
+        cf = contract_file(self.user_id, self.entity_id, cid)
+        if not self.exists(cf):
+            raise HTTPException(status_code=404, detail="Contratto non trovato.")
+        return cid, self.read(cf)
+
+# ---- operazioni: stesse regole delle rotte REST, ritornano l'ID -------------
+def _contract_create(p: _Plan, op: BatchOperation) -> str:
+    cid = uuid.uuid4().hex
+    data = ContrattoOmnia8(**op.payload).dict(by_alias=True)
+    p.files[contract_file(p.user_id, p.entity_id, cid)] = data
+    p.contracts[cid] = data
+    return cid
+
+def _contract_update(p: _Plan, op: BatchOperation) -> str:
+    cid, _ = p.contract(op)
+    data = ContrattoOmnia8(**op.payload).dict(by_alias=True)
+    p.files[contract_file(p.user_id, p.entity_id, cid)] = data
+    p.contracts[cid] = data
+    return cid
+
+def _title_create(p: _Plan, op: BatchOperation) -> str:
+    cid, contract = p.contract(op)
+    t = Titolo(**op.payload)
+    t.numero_polizza = contract["Identificativi"]["NumeroPolizza"]
+    t.entity_id = p.entity_id
+    tid = uuid.uuid4().hex
+    data = t.dict()
+    p.files[title_file(p.user_id, p.entity_id, cid, tid)] = data
+    p.titles[(cid, tid)] = data
+    return tid
+
+def _title_update(p: _Plan, op: BatchOperation) -> str:
+    cid, _ = p.contract(op)
+    tid = p.id(op, "title_id")
+    tf = title_file(p.user_id, p.entity_id, cid, tid)
+    if not p.exists(tf):
+        raise HTTPException(status_code=404, detail="Titolo non trovato.")
+    data = Titolo(**op.payload).dict()
+    p.files[tf] = data
+    p.titles[(cid, tid)] = data
+    return tid
+
+def _title_delete(p: _Plan, op: BatchOperation) -> str:
+    cid, _ = p.contract(op)
+    tid = p.id(op, "title_id")
+    tf = title_file(p.user_id, p.entity_id, cid, tid)
+    if not p.exists(tf):
+        raise HTTPException(status_code=404, detail="Titolo non trovato.")
+    p.files[tf] = None
+    p.titles[(cid, tid)] = None
+    return tid
+
+def _claim_create(p: _Plan, op: BatchOperation) -> str:
+    cid, contract = p.contract(op)
+    s = Sinistro(**op.payload)
+    s.numero_contratto = s.numero_contratto or contract["Identificativi"]["NumeroPolizza"]
+    s.compagnia = s.compagnia or contract["Identificativi"]["Compagnia"]
+    s.rischio = s.rischio or contract.get("RamiEl", {}).get("Descrizione")
+    sid = uuid.uuid4().hex
+    data = s.dict()
+    p.files[claim_file(p.user_id, p.entity_id, cid, sid)] = data
+    p.claims[(cid, sid)] = data
+    return sid
+
+def _claim_update(p: _Plan, op: BatchOperation) -> str:
+    cid, _ = p.contract(op)
+    sid = p.id(op, "claim_id")
+    cf = claim_file(p.user_id, p.entity_id, cid, sid)
+    if not p.exists(cf):
+        raise HTTPException(status_code=404, detail="Sinistro non trovato.")
+    data = Sinistro(**op.payload).dict()
+    p.files[cf] = data
+    p.claims[(cid, sid)] = data
+    return sid
+
+def _diary_create(p: _Plan, op: BatchOperation) -> str:
+    cid, _ = p.contract(op)
+    sid = p.id(op, "claim_id")
+    if not p.exists(claim_file(p.user_id, p.entity_id, cid, sid)):
+        raise HTTPException(status_code=404, detail="Sinistro non trovato.")
+    entry_id = uuid.uuid4().hex
+    p.files[diary_file(p.user_id, p.entity_id, cid, sid, entry_id)] = DiarioEntry(**op.payload).dict()
+    return entry_id
+
+def _document_create(p: _Plan, op: BatchOperation) -> str:
+    # livello dal target indicato: sinistro, titolo o (default) contratto
+    cid, _ = p.contract(op)
+    req = CreateDocumentRequest(**op.payload)
+    meta = req.meta.dict()
+    doc_id = uuid.uuid4().hex
+    if op.claim_id:
+        sid = p.id(op, "claim_id")
+        if not p.exists(claim_file(p.user_id, p.entity_id, cid, sid)):
+            raise HTTPException(status_code=404, detail="Sinistro non trovato.")
+        meta["claim_id"] = sid
+        meta.setdefault("metadati", {})["level"] = "SINISTRO"
+        base = claim_docs_dir(p.user_id, p.entity_id, cid, sid)
+        p.owners.append((cid, "claims", sid, doc_id))
+    elif op.title_id:
+        tid = p.id(op, "title_id")
+        if not p.exists(title_file(p.user_id, p.entity_id, cid, tid)):
+            raise HTTPException(status_code=404, detail="Titolo non trovato.")
+        meta["title_id"] = tid
+        meta.setdefault("metadati", {})["level"] = "TITOLO"
+        base = title_docs_dir(p.user_id, p.entity_id, cid, tid)
+        p.owners.append((cid, "titles", tid, doc_id))
+    else:
+        meta.setdefault("metadati", {})["level"] = "CONTRATTO"
+        base = contract_docs_dir(p.user_id, p.entity_id, cid)
+    if req.content_base64:
+        try:
+            content = base64.b64decode(req.content_base64, validate=True)
+        except (binascii.Error, ValueError):
+            raise HTTPException(status_code=422, detail="content_base64 non valido.")
+        p.blobs.append((meta, content))
+    p.files[doc_meta_file(base, doc_id)] = meta
+    return doc_id
+
+_OPS: Dict[str, Callable[[_Plan, BatchOperation], str]] = {
+    "contract.create": _contract_create,
+    "contract.update": _contract_update,
+    "title.create": _title_create,
+    "title.update": _title_update,
+    "title.delete": _title_delete,
+    "claim.create": _claim_create,
+    "claim.update": _claim_update,
+    "diary.create": _diary_create,
+    "document.create": _document_create,
+}
+
+def recover_batches(user_id: str, entity_id: Optional[str] = None) -> List[str]:
+    """Completa i batch interrotti (solo fs) e riallinea viste e scadenze delle entità coinvolte."""
+    recovered = recover_json_txns(user_id, entity_id)
+    for eid in recovered:
+        rebuild_entity_views(user_id, eid)
+    if recovered:
+        rebuild_due_index(user_id)
+    return recovered
+
+def recover_all_batches() -> Dict[str, List[str]]:
+    """All'avvio: recover_batches su ogni bucket con entità (solo backend fs)."""
+    root = Path(ROOT_DATA_DIR)
+    if storage_backend() != "fs" or not root.exists():
+        return {}
+    out = {}
+    for d in sorted(root.iterdir()):
+        if (d / "entities").is_dir():
+            out[d.name] = recover_batches(d.name)
+    return out
+
+def run_batch(user_id: str, entity_id: str, operations: List[BatchOperation]) -> Dict[str, Any]:
+    with entity_lock(user_id, entity_id):
+        if not path_exists(entity_file(user_id, entity_id)):
+            raise HTTPException(status_code=404, detail="Entità non trovata.")
+        recover_batches(user_id, entity_id)
+
+        p = _Plan(user_id, entity_id)
+        results = []
+        for i, op in enumerate(operations):
+            try:
+                oid = _OPS[op.op](p, op)
+            except ValidationError as e:
+                raise HTTPException(status_code=422, detail={
+                    "index": i, "op": op.op, "errors": e.errors(include_url=False, include_context=False)})
+            except HTTPException as e:
+                raise HTTPException(status_code=e.status_code, detail={"index": i, "op": op.op, "error": e.detail})
+            if op.ref:
+                p.refs[op.ref] = oid
+            results.append({"index": i, "op": op.op, "id": oid})
+
+        # blob prima del commit: se il batch fallisce restano orfani e li raccoglie il GC
+        hashes = []
+        for meta, content in p.blobs:
+            meta["hash"], meta["path_relativo"] = write_blob(user_id, content, mime=meta.get("mime"))
+            hashes.append(meta["hash"])
+        # riferimenti presi prima del commit, sotto il lock del blob: una delete
+        # concorrente non può eliminare un blob appena deduplicato. Dopo il
+        # manifest il batch si completa (roll-forward), quindi un errore del
+        # commit non li rilascia: al più un refcount in eccesso (blob-refs lo ripara)
+        taken: List[str] = []
+        try:
+            for h in hashes:
+                blob_ref_take(user_id, h)
+                taken.append(h)
+        except BaseException:
+            for h in taken:
+                blob_ref_decr(user_id, h)
+            raise
+
+        commit_json_txn(user_id, entity_id,
+                        [(f, obj) for f, obj in p.files.items() if obj is not None],
+                        [f for f, obj in p.files.items() if obj is None])
+
+        for cid, kind, owner_id, doc_id in p.owners:
+            doc_owner_add(user_id, entity_id, cid, kind, owner_id, doc_id)
+        for cid, c in p.contracts.items():
+            update_by_policy_index(user_id, c["Identificativi"]["NumeroPolizza"], entity_id, cid)
+        apply_due_deltas(user_id, entity_id, p.contracts, p.titles)
+        apply_view_deltas(user_id, entity_id, dict(p.contracts), p.titles, p.claims)
+    return {"committed": len(results), "results": results, "refs": p.refs}
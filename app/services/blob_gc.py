@@ -0,0 +1,182 @@
+from __future__ import annotations
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Set
+
+from app.config import ROOT_DATA_DIR, BLOB_GC_INTERVAL_S, BLOB_GC_GRACE_S, BLOB_GC_MAX_OPS_PER_S
+from app.utils.utils import (
+    blobs_dir, blob_refs_get, blob_refs_forget, path_lock, read_json, storage_mode,
+    blob_path_for_hash, iter_packed, pack_entry, pack_index_update
+)
+from app.services.indexes import iter_all_document_meta_files, ensure_blob_refs
+from app.services.upload_sessions import expire_sessions
+
+# =============================================================================
+# GC dei blob: mark & sweep
+#   mark  → hash referenziati dai metadati documento (cartelle condivise
+#           claims|titles/documents e legacy claims/<claim_id>/documents)
+#   sweep → elimina i blob non marcati più vecchi di `grace_s` (mtime) e i
+#           temporanei di upload abbandonati in blobs/.tmp/; per i blob nei
+#           pack si rimuove la voce d'indice (spazio recuperato da blob-repack);
+#           in coda si eliminano le sessioni di upload riprendibile scadute
+#   Un blob viene eliminato solo se anche la tabella refcount lo dà a 0:
+#   in caso di disaccordo si salta (e si segnala) invece di rischiare.
+# =============================================================================
+class _Throttle:
+    """Al massimo `rate` operazioni al secondo (0 = nessun limite)."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next = time.monotonic()
+
+    def __call__(self) -> None:
+        if not self.interval:
+            return
+        now = time.monotonic()
+        if now < self.next:
+            time.sleep(self.next - now)
+        self.next = max(now, self.next) + self.interval
+
+def collect_garbage(user_id: str, grace_s: float = BLOB_GC_GRACE_S,
+                    max_ops_per_s: float = BLOB_GC_MAX_OPS_PER_S, dry_run: bool = False) -> Dict[str, Any]:
+    t0 = time.time()
+    tick = _Throttle(max_ops_per_s)
+    ensure_blob_refs(user_id)
+
+    marked: Set[str] = set()
+    metas = 0
+    for mf in iter_all_document_meta_files(user_id):
+        tick()
+        metas += 1
+        try:
+            h = read_json(mf).get("hash")
+        except Exception:
+            continue
+        if h:
+            marked.add(h)
+
+    cutoff = time.time() - grace_s
+    report: Dict[str, Any] = {
+        "user_id": user_id, "dry_run": dry_run, "metas": metas, "referenced": len(marked),
+        "blobs": 0, "unreferenced": 0, "in_grace": 0, "refcount_mismatch": [],
+        "deleted": 0, "reclaimed_bytes": 0, "tmp_deleted": 0,
+        "packed_deleted": 0, "pack_dead_bytes": 0, "upload_sessions_expired": 0,
+    }
+    broot = blobs_dir(user_id)
+    for bp in broot.glob("*/*"):
+        tick()
+        if len(bp.parent.name) != 2 or not bp.is_file():
+            continue
+        report["blobs"] += 1
+        if bp.name in marked:
+            continue
+        report["unreferenced"] += 1
+        with path_lock(str(bp)):  # stesso lock di BlobWriter.commit
+            try:
+                st = bp.stat()
+            except FileNotFoundError:
+                continue
+            if st.st_mtime > cutoff:
+                report["in_grace"] += 1
+                continue
+            if (blob_refs_get(user_id, bp.name) or 0) > 0:
+                report["refcount_mismatch"].append(bp.name)
+                continue
+            report["reclaimed_bytes"] += st.st_size
+            report["deleted"] += 1
+            if not dry_run:
+                bp.unlink()
+                blob_refs_forget(user_id, bp.name)
+
+    # blob nei pack: il ts dell'indice fa da mtime
+    for h, e in list(iter_packed(user_id)):
+        tick()
+        report["blobs"] += 1
+        if h in marked:
+            continue
+        report["unreferenced"] += 1
+        with path_lock(str(blob_path_for_hash(user_id, h))):
+            e = pack_entry(user_id, h)  # riletta sotto lock (ts aggiornato da un dedup)
+            if not e:
+                continue
+            if e[3] > cutoff:
+                report["in_grace"] += 1
+                continue
+            if (blob_refs_get(user_id, h) or 0) > 0:
+                report["refcount_mismatch"].append(h)
+                continue
+            report["packed_deleted"] += 1
+            report["pack_dead_bytes"] += e[2]
+            if not dry_run:
+                pack_index_update(user_id, h, None)
+                blob_refs_forget(user_id, h)
+
+    # upload interrotti (BlobWriter mai chiuso)
+    for tmp in (broot / ".tmp").glob("*.part"):
+        tick()
+        try:
+            if tmp.stat().st_mtime <= cutoff:
+                if not dry_run:
+                    tmp.unlink()
+                report["tmp_deleted"] += 1
+        except FileNotFoundError:
+            continue
+
+    if not dry_run:
+        report["upload_sessions_expired"] = expire_sessions(user_id)
+
+    report["elapsed_s"] = round(time.time() - t0, 3)
+    return report
+
+def gc_user_ids() -> List[str]:
+    """Bucket da visitare: '_shared' in modalità condivisa, altrimenti una cartella per utente."""
+    if storage_mode() == "shared":
+        return ["_shared"]
+    root = ROOT_DATA_DIR
+    if not root.exists():
+        return []
+    return sorted(d.name for d in root.iterdir() if (d / "blobs").is_dir())
+
+# =============================================================================
+# Esecuzione periodica in un thread daemon (avviato dal lifespan dell'app)
+# =============================================================================
+_state: Dict[str, Any] = {"running": False, "interval_s": 0, "last_run": None, "reports": []}
+_stop = threading.Event()
+_thread: Optional[threading.Thread] = None
+
+def run_gc_once(dry_run: bool = False) -> List[Dict[str, Any]]:
+    reports = []
+    for uid in gc_user_ids():
+        try:
+            reports.append(collect_garbage(uid, dry_run=dry_run))
+        except Exception as e:  # un bucket guasto non ferma gli altri
+            reports.append({"user_id": uid, "error": repr(e)})
+    _state["last_run"] = time.time()
+    _state["reports"] = reports
+    return reports
+
+def _loop(interval_s: float) -> None:
+    while not _stop.wait(interval_s):
+        run_gc_once()
+
+def start_blob_gc(interval_s: Optional[float] = None) -> bool:
+    global _thread
+    if interval_s is None:
+        interval_s = float(os.getenv("ENAC_BLOB_GC_INTERVAL_S", BLOB_GC_INTERVAL_S))
+    if interval_s <= 0 or (_thread is not None and _thread.is_alive()):
+        return False
+    _stop.clear()
+    _thread = threading.Thread(target=_loop, args=(interval_s,), name="blob-gc", daemon=True)
+    _thread.start()
+    _state.update(running=True, interval_s=interval_s)
+    return True
+
+def stop_blob_gc() -> None:
+    _stop.set()
+    if _thread is not None:
+        _thread.join(timeout=5)
+    _state["running"] = False
+
+def gc_status() -> Dict[str, Any]:
+    return dict(_state)
@@ -0,0 +1,71 @@
+from __future__ import annotations
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+from app.config import BLOB_PACK_MAX_SIZE, BLOB_PACK_COMPACT_RATIO
+from app.utils.utils import (
+    blobs_dir, packs_dir, blob_path_for_hash, path_lock, pack_append, pack_entry, iter_packed, BlobLoc,
+    offline_lock
+)
+
+# =============================================================================
+# Repack dei blob (stile `git gc`): da eseguire a server fermo (imposto da
+# offline_lock: RuntimeError se un processo server tiene il proprio lock)
+#   1) i blob sciolti fino a `max_size` byte vengono accodati ai pack e rimossi
+#   2) i pack con più di `compact_ratio` di spazio morto (voci rimosse dal GC o
+#      da delete_blob, byte orfani di scritture interrotte) vengono riscritti
+#      copiando solo le voci vive, poi eliminati. Le voci copiate vanno sempre
+#      in pack nuovi, creati in questa passata e mai visitati dal ciclo: un pack
+#      esistente non riceve byte mentre se ne stima lo spazio morto
+# =============================================================================
+def repack_blobs(user_id: str, max_size: int = BLOB_PACK_MAX_SIZE,
+                 compact_ratio: float = BLOB_PACK_COMPACT_RATIO) -> Dict[str, Any]:
+    with offline_lock():
+        return _repack(user_id, max_size, compact_ratio)
+
+def _repack(user_id: str, max_size: int, compact_ratio: float) -> Dict[str, Any]:
+    t0 = time.time()
+    report: Dict[str, Any] = {"user_id": user_id, "packed": 0, "packed_bytes": 0,
+                              "compacted_packs": 0, "moved": 0, "reclaimed_bytes": 0}
+
+    for bp in sorted(blobs_dir(user_id).glob("*/*")):
+        if len(bp.parent.name) != 2 or not bp.is_file():
+            continue
+        with path_lock(str(bp)):
+            try:
+                size = bp.stat().st_size
+            except FileNotFoundError:
+                continue
+            if size > max_size:
+                continue
+            pack_append(user_id, bp.name, bp)  # durevole prima di rimuovere lo sciolto
+            bp.unlink()
+        report["packed"] += 1
+        report["packed_bytes"] += size
+
+    live: Dict[str, List[str]] = {}
+    live_bytes: Dict[str, int] = {}
+    for h, e in iter_packed(user_id):
+        live.setdefault(e[0], []).append(h)
+        live_bytes[e[0]] = live_bytes.get(e[0], 0) + e[2]
+
+    packs = sorted(packs_dir(user_id).glob("pack-*.pack"))
+    for pack in packs:
+        size = pack.stat().st_size
+        used = live_bytes.get(pack.name, 0)
+        if size == 0 or size - used <= size * compact_ratio:
+            continue
+        for h in live.get(pack.name, []):
+            with path_lock(str(blob_path_for_hash(user_id, h))):
+                e = pack_entry(user_id, h)
+                if not e or e[0] != pack.name:
+                    continue
+                pack_append(user_id, h, BlobLoc(pack, e[1], e[2], True), exclude=packs)
+            report["moved"] += 1
+        pack.unlink()
+        report["compacted_packs"] += 1
+        report["reclaimed_bytes"] += size - used
+
+    report["elapsed_s"] = round(time.time() - t0, 3)
+    return report
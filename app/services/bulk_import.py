@@ -0,0 +1,265 @@
+from __future__ import annotations
+import csv
+import io
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Set, TextIO, Tuple
+
+from fastapi import HTTPException
+from pydantic import ValidationError
+
+from app.config import IMPORT_BATCH_SIZE, IMPORT_WORKERS
+from app.models.contract import ContrattoOmnia8
+from app.models.entity import Entity
+from app.utils.utils import (
+    entity_file, contract_file, by_policy_dir, sanitize_id, path_exists, read_json,
+    atomic_write_json_many, get_codec
+)
+from app.services.indexes import entity_lock, rebuild_entity_views, rebuild_due_index
+
+# =============================================================================
+# Import massivo di entità e contratti (NDJSON o CSV)
+#   lettura    → un record alla volta dallo stream (mai il file intero)
+#   validazione→ lotti di IMPORT_BATCH_SIZE record in processi worker
+#                (al più 2 lotti per worker in volo: memoria costante);
+#                pool di processi condiviso, avviato con "spawn": niente fork
+#                di un processo server con thread (lock ereditati → deadlock)
+#   scrittura  → nel processo principale, nell'ordine del file: un lotto =
+#                una atomic_write_json_many (contract.json + by_policy), sotto
+#                gli entity_lock delle entità del lotto (presi in ordine), come
+#                ogni altro scrittore
+#   indici     → alla fine: viste una volta per entità toccata (sotto il suo
+#                entity_lock, in rebuild_entity_views), indice scadenze
+#                ricostruito una volta
+# Record: {"type": "entity"|"contract", "entity_id": ..., ...campi del modello}
+#   (contratti con gli alias JSON: Identificativi.NumeroPolizza, ...; in CSV
+#   colonne puntate "Identificativi.Compagnia"; celle vuote = campo assente).
+#   Un contratto senza contract_id riusa quello già indicizzato per la stessa
+#   polizza della stessa entità (anche se comparsa prima nello stesso lotto):
+#   ripetere un import non crea doppioni.
+# =============================================================================
+FORMATS = ("ndjson", "csv")
+KINDS = ("entity", "contract")
+
+_pools: Dict[int, ProcessPoolExecutor] = {}
+_pools_guard = threading.Lock()
+
+def _executor(workers: int) -> ProcessPoolExecutor:
+    with _pools_guard:
+        pool = _pools.get(workers)
+        if pool is None:
+            pool = _pools[workers] = ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn"))
+        return pool
+
+def _discard(workers: int, pool: ProcessPoolExecutor) -> None:
+    # worker morto (OOM, kill): il pool è inutilizzabile, il prossimo import ne crea uno nuovo
+    with _pools_guard:
+        if _pools.get(workers) is pool:
+            del _pools[workers]
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def detect_format(name_or_type: Optional[str]) -> str:
+    """Formato da estensione del file o Content-Type (default ndjson)."""
+    v = (name_or_type or "").lower()
+    return "csv" if v.endswith(".csv") or "csv" in v else "ndjson"
+
+def iter_records(fp: BinaryIO, fmt: str) -> Iterator[tuple[int, Any]]:
+    """(numero di riga, record grezzo): bytes della riga per NDJSON, dict per CSV."""
+    if fmt == "csv":
+        reader = csv.DictReader(io.TextIOWrapper(fp, encoding="utf-8-sig", newline=""))
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for n, line in enumerate(fp, 1):
+        if line.strip():
+            yield n, line
+
+def _unflatten(row: Dict[str, Any]) -> Dict[str, Any]:
+    # colonne CSV "Sezione.Campo" → {"Sezione": {"Campo": ...}}; celle vuote saltate
+    out: Dict[str, Any] = {}
+    for k, v in row.items():
+        if k is None or v is None or v == "":
+            continue
+        node, parts = out, k.strip().split(".")
+        for p in parts[:-1]:
+            node = node.setdefault(p, {})
+        node[parts[-1]] = v
+    return out
+
+def _validate(raw: Any, default_kind: Optional[str], codec) -> Dict[str, Any]:
+    rec = _unflatten(raw) if isinstance(raw, dict) else codec.loads(raw)
+    if not isinstance(rec, dict):
+        raise ValueError("record non è un oggetto JSON")
+    kind = rec.pop("type", None) or default_kind
+    if kind not in KINDS:
+        raise ValueError(f"tipo record mancante o non valido: {kind!r} (usare 'entity' o 'contract')")
+    try:
+        entity_id = sanitize_id(str(rec.pop("entity_id", "")), "entity_id")
+        contract_id = rec.pop("contract_id", None)
+        if contract_id:
+            contract_id = sanitize_id(str(contract_id), "contract_id")
+    except HTTPException as e:
+        raise ValueError(e.detail)
+    if kind == "entity":
+        return {"kind": kind, "entity_id": entity_id, "data": Entity(**rec).dict()}
+    c = ContrattoOmnia8(**rec)
+    return {"kind": kind, "entity_id": entity_id, "contract_id": contract_id,
+            "numero_polizza": c.identificativi.numero_polizza, "data": c.dict(by_alias=True)}
+
+def _validate_batch(batch: List[tuple[int, Any]], default_kind: Optional[str]) -> List[Dict[str, Any]]:
+    """Eseguita nei processi worker: parse + validazione Pydantic di un lotto."""
+    codec = get_codec()
+    out = []
+    for line, raw in batch:
+        try:
+            out.append({"line": line, **_validate(raw, default_kind, codec)})
+        except ValidationError as e:
+            out.append({"line": line, "errors": e.errors(include_url=False, include_context=False, include_input=False)})
+        except Exception as e:
+            out.append({"line": line, "errors": [{"type": "value_error", "loc": [], "msg": str(e)}]})
+    return out
+
+def _batches(records: Iterator[tuple[int, Any]], size: int) -> Iterator[List[tuple[int, Any]]]:
+    batch: List[tuple[int, Any]] = []
+    for rec in records:
+        batch.append(rec)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _raw_text(raw: Any) -> Any:
+    return raw.decode("utf-8", "replace").rstrip("\r\n") if isinstance(raw, bytes) else raw
+
+class _Writer:
+    """Scritture nell'ordine del file + elenco delle entità da reindicizzare."""
+
+    def __init__(self, user_id: str, skip_existing: bool):
+        self.user_id = user_id
+        self.skip_existing = skip_existing
+        self.entities: Set[str] = set()       # entità note (scritte o già esistenti)
+        self.touched: Set[str] = set()        # entità con contratti scritti → viste
+        self.stats = {"entities": 0, "contracts": 0, "skipped": 0, "rejected": 0}
+
+    def _entity_known(self, entity_id: str) -> bool:
+        if entity_id in self.entities:
+            return True
+        if path_exists(entity_file(self.user_id, entity_id)):
+            self.entities.add(entity_id)
+            return True
+        return False
+
+    def _policy_contract(self, entity_id: str, numero_polizza: str) -> Optional[str]:
+        f = by_policy_dir(self.user_id) / f"{numero_polizza}.json"
+        if not path_exists(f):
+            return None
+        hit = read_json(f)
+        return hit.get("contract_id") if hit.get("entity_id") == entity_id else None
+
+    def write(self, results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Scrive un lotto validato; ritorna le righe rifiutate."""
+        uid = self.user_id
+        with ExitStack() as locks:
+            # verifiche e scrittura sotto i lock delle entità del lotto, in ordine (niente deadlock)
+            for eid in sorted({r["entity_id"] for r in results if "errors" not in r}):
+                locks.enter_context(entity_lock(uid, eid))
+            return self._write_locked(results)
+
+    def _write_locked(self, results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        uid = self.user_id
+        files: List[tuple[Any, Any]] = []
+        rejected = [r for r in results if "errors" in r]
+        # polizze di questo lotto: by_policy è scritto solo a fine lotto
+        policies: Dict[str, Tuple[str, str]] = {}
+        for r in results:
+            if "errors" in r:
+                continue
+            eid = r["entity_id"]
+            if r["kind"] == "entity":
+                if self.skip_existing and self._entity_known(eid):
+                    self.stats["skipped"] += 1
+                    continue
+                files.append((entity_file(uid, eid), r["data"]))
+                self.entities.add(eid)
+                self.stats["entities"] += 1
+                continue
+            if not self._entity_known(eid):
+                rejected.append({"line": r["line"], "errors": [
+                    {"type": "missing_entity", "loc": ["entity_id"], "msg": f"Entità {eid!r} inesistente"}]})
+                continue
+            pol = r["numero_polizza"]
+            seen = policies.get(pol)
+            cid = r["contract_id"] or (seen[1] if seen and seen[0] == eid else None) or self._policy_contract(eid, pol)
+            if cid and self.skip_existing and ((eid, cid) in policies.values() or path_exists(contract_file(uid, eid, cid))):
+                self.stats["skipped"] += 1
+                continue
+            cid = cid or uuid.uuid4().hex
+            files.append((contract_file(uid, eid, cid), r["data"]))
+            files.append((by_policy_dir(uid) / f"{pol}.json", {"entity_id": eid, "contract_id": cid}))
+            policies[pol] = (eid, cid)
+            self.touched.add(eid)
+            self.stats["contracts"] += 1
+        if files:
+            atomic_write_json_many(files)
+        self.stats["rejected"] += len(rejected)
+        return sorted(rejected, key=lambda r: r["line"])
+
+def run_import(user_id: str, fp: BinaryIO, fmt: str = "ndjson", default_kind: Optional[str] = None,
+               skip_existing: bool = False, workers: Optional[int] = None,
+               batch_size: int = IMPORT_BATCH_SIZE, rejects: Optional[TextIO] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Generatore di eventi: {"event": "rejected", line, errors, record} per ogni
+    riga scartata, {"event": "progress", ...} dopo ogni lotto e infine
+    {"event": "done", ...}. Con `rejects` le righe scartate sono anche scritte
+    lì (NDJSON) man mano.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"formato non valido {fmt!r}: usare {' | '.join(FORMATS)}")
+    t0 = time.time()
+    workers = workers or IMPORT_WORKERS or os.cpu_count() or 1
+    writer = _Writer(user_id, skip_existing)
+    codec = get_codec()
+    read = 0
+    pool = _executor(workers)
+    inflight: deque = deque()
+
+    def drain_one() -> Iterator[Dict[str, Any]]:
+        raws, fut = inflight.popleft()
+        for r in writer.write(fut.result()):
+            ev = {"event": "rejected", "line": r["line"], "errors": r["errors"], "record": _raw_text(raws[r["line"]])}
+            if rejects is not None:
+                rejects.write(codec.dumps(ev).decode("utf-8") + "\n")
+            yield ev
+        yield {"event": "progress", "read": read, **writer.stats, "elapsed_s": round(time.time() - t0, 3)}
+
+    try:
+        for batch in _batches(iter_records(fp, fmt), batch_size):
+            read += len(batch)
+            inflight.append((dict(batch), pool.submit(_validate_batch, batch, default_kind)))
+            if len(inflight) >= 2 * workers:
+                yield from drain_one()
+        while inflight:
+            yield from drain_one()
+    except BrokenProcessPool:
+        _discard(workers, pool)
+        raise
+    finally:
+        # pool condiviso: un import interrotto (client disconnesso) non lascia lotti in coda
+        for _, fut in inflight:
+            fut.cancel()
+
+    # manutenzione differita: una passata per entità + una per le scadenze
+    for eid in sorted(writer.touched):
+        rebuild_entity_views(user_id, eid)
+    if writer.touched:
+        rebuild_due_index(user_id)
+    yield {"event": "done", "read": read, **writer.stats, "views_rebuilt": len(writer.touched),
+           "elapsed_s": round(time.time() - t0, 3)}
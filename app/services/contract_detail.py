@@ -0,0 +1,138 @@
+from __future__ import annotations
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Set
+
+from fastapi import HTTPException
+
+from app.config import DETAIL_IO_WORKERS
+from app.models.claim import Sinistro
+from app.utils.utils import (
+    contract_file, titles_dir, title_file, title_docs_dir, claims_dir, claim_dir, claim_file,
+    claim_docs_dir, diary_dir, contract_docs_dir, doc_meta_file, read_json, path_exists,
+    list_json, list_dirs
+)
+from app.services.indexes import contract_doc_owners
+
+# =============================================================================
+# Dettaglio aggregato di un contratto (una richiesta invece di 50+)
+#   fase 1 → elenchi (titoli, sinistri, documenti del contratto) + indice owner
+#   fase 2 → tutti i file (titoli, sinistri, conteggio diari, metadati
+#            documento) letti in parallelo su un pool di thread condiviso
+#   Documenti di sinistri/titoli dall'indice owner, come le rotte documents.
+# =============================================================================
+INCLUDES = ("titles", "claims", "diary", "documents")
+DEFAULT_INCLUDE = "titles,claims,documents"
+
+_pool: Optional[ThreadPoolExecutor] = None
+_pool_guard = threading.Lock()
+
+def _executor() -> ThreadPoolExecutor:
+    global _pool
+    with _pool_guard:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=DETAIL_IO_WORKERS, thread_name_prefix="detail-io")
+        return _pool
+
+def parse_include(raw: Optional[str]) -> Set[str]:
+    parts = {p.strip() for p in (raw or "").split(",") if p.strip()}
+    bad = parts - set(INCLUDES)
+    if bad:
+        raise HTTPException(status_code=422, detail=f"include non valido {sorted(bad)}: usare {', '.join(INCLUDES)}")
+    return parts
+
+def _read_or_none(p: Path) -> Any:
+    # eliminato fra l'elenco e la lettura: si salta
+    try:
+        return read_json(p)
+    except FileNotFoundError:
+        return None
+
+def _claim_or_none(p: Path) -> Optional[Dict[str, Any]]:
+    # come GET claim: compat-layer sulle chiavi legacy
+    data = _read_or_none(p)
+    return None if data is None else Sinistro(**data).dict()
+
+def contract_detail(user_id: str, entity_id: str, contract_id: str, include: Set[str]) -> Dict[str, Any]:
+    cf = contract_file(user_id, entity_id, contract_id)
+    if not path_exists(cf):
+        raise HTTPException(status_code=404, detail="Contratto non trovato.")
+    pool = _executor()
+    docs = "documents" in include
+    want_claims = "claims" in include or "diary" in include
+
+    # ---- fase 1: elenchi --------------------------------------------------
+    f_contract = pool.submit(_read_or_none, cf)
+    f_tids = pool.submit(list_json, titles_dir(user_id, entity_id, contract_id)) if "titles" in include else None
+    f_sids = pool.submit(list_dirs, claims_dir(user_id, entity_id, contract_id)) if want_claims else None
+    f_cdocs = pool.submit(list_json, contract_docs_dir(user_id, entity_id, contract_id)) if docs else None
+    tids = sorted(f_tids.result()) if f_tids else []
+    sids = sorted(d for d in f_sids.result() if d != "documents") if f_sids else []
+    cdocs = sorted(f_cdocs.result()) if f_cdocs else []
+    # indice owner letto una volta sola, poi sezionato per titolo/sinistro
+    owners = contract_doc_owners(user_id, entity_id, contract_id) if docs and (tids or sids) else {}
+    towned = {tid: owners.get("titles", {}).get(tid, {}) for tid in tids} if docs else {}
+    sowned = {sid: owners.get("claims", {}).get(sid, {}) for sid in sids} if docs else {}
+
+    # ---- fase 2: letture in parallelo ------------------------------------
+    jobs: Dict[tuple, tuple[Callable, Any]] = {}
+    for d in cdocs:
+        jobs[("doc", "contract", contract_id, d)] = (_read_or_none, doc_meta_file(contract_docs_dir(user_id, entity_id, contract_id), d))
+    for tid in tids:
+        jobs[("title", tid)] = (_read_or_none, title_file(user_id, entity_id, contract_id, tid))
+        for d in towned.get(tid, ()):
+            jobs[("doc", "title", tid, d)] = (_read_or_none, doc_meta_file(title_docs_dir(user_id, entity_id, contract_id, tid), d))
+    for sid in sids:
+        if "claims" in include:
+            jobs[("claim", sid)] = (_claim_or_none, claim_file(user_id, entity_id, contract_id, sid))
+        if "diary" in include:
+            jobs[("diary", sid)] = (lambda d: len(list_json(d)), diary_dir(user_id, entity_id, contract_id, sid))
+        for d, where in sowned.get(sid, {}).items():
+            base = (claim_docs_dir(user_id, entity_id, contract_id, sid) if where == "shared"
+                    else claim_dir(user_id, entity_id, contract_id, sid) / "documents")
+            jobs[("doc", "claim", sid, d)] = (_read_or_none, doc_meta_file(base, d))
+    keys = list(jobs)
+    done = dict(zip(keys, pool.map(lambda job: job[0](job[1]), [jobs[k] for k in keys])))
+
+    def doc_list(kind: str, owner_id: str, doc_ids, owner_key: Optional[str] = None) -> List[Dict[str, Any]]:
+        out = []
+        for d in sorted(doc_ids):
+            m = done.get(("doc", kind, owner_id, d))
+            # cartella condivisa: il meta deve appartenere davvero al proprietario
+            if m is None or (owner_key and m.get(owner_key, owner_id) != owner_id):
+                continue
+            out.append({"doc_id": d, **m})
+        return out
+
+    contract = f_contract.result()
+    if contract is None:
+        raise HTTPException(status_code=404, detail="Contratto non trovato.")
+    out: Dict[str, Any] = {"contract_id": contract_id, "contratto": contract}
+    if docs:
+        out["documents"] = doc_list("contract", contract_id, cdocs)
+    if "titles" in include:
+        out["titles"] = []
+        for tid in tids:
+            t = done.get(("title", tid))
+            if t is None:
+                continue
+            row = {"title_id": tid, **t}
+            if docs:
+                row["documents"] = doc_list("title", tid, towned.get(tid, ()), "title_id")
+            out["titles"].append(row)
+    if want_claims:
+        out["claims"] = []
+        for sid in sids:
+            row: Dict[str, Any] = {"claim_id": sid}
+            if "claims" in include:
+                s = done.get(("claim", sid))
+                if s is None:
+                    continue
+                row.update(s)
+            if "diary" in include:
+                row["diary_count"] = done.get(("diary", sid), 0)
+            if docs:
+                row["documents"] = doc_list("claim", sid, sowned.get(sid, {}), "claim_id")
+            out["claims"].append(row)
+    return out
@@ -1,13 +1,31 @@
 from __future__ import annotations
+from bisect import bisect_left, bisect_right
 from datetime import date, timedelta
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional
+from fastapi import HTTPException
 from app.utils.utils import (
-    contracts_dir, contract_file, titles_dir, claims_dir,
-    views_dir_for_entity, by_policy_dir, entities_dir, user_dir
+    contracts_dir, contract_file, titles_dir, claims_dir, entity_dir,
+    views_dir_for_entity, by_policy_dir, due_dir, entities_dir, user_dir
 )
-from app.utils.utils import read_json, atomic_write_json
+from app.utils.utils import (
+    blob_refs_dir, blobs_dir, blob_refs_get, blob_refs_adjust, path_lock,
+    doc_owners_file, iter_packed, blob_path_for_hash, locate_blob, delete_blob_content
+)
+from app.utils.utils import (
+    read_json, atomic_write_json, atomic_write_json_many, path_exists, list_dirs, list_json, glob_json,
+    remove_file, json_version, cache_lookup, cache_store, sqlite_store, indexed_nodes, indexed_hash_counts
+)
+from app.config import VIEW_COMPACT_DELTAS, VIEW_MAX_DELTAS
 from pathlib import Path
 import json
+import threading
+
+_TITLES_VIEW = "titles_index.json"
+_CLAIMS_VIEW = "claims_index.json"
+
+def entity_lock(user_id: str, entity_id: str) -> threading.RLock:
+    """Serializza le read-modify-write delle viste di un'entità."""
+    return path_lock(str(entity_dir(user_id, entity_id)))
 
 def update_by_policy_index(user_id: str, numero_polizza: str, entity_id: str, contract_id: str) -> None:
     if not numero_polizza:
@@ -15,165 +33,755 @@ def update_by_policy_index(user_id: str, numero_polizza: str, entity_id: str, co
     f = by_policy_dir(user_id) / f"{numero_polizza}.json"
     atomic_write_json(f, {"entity_id": entity_id, "contract_id": contract_id})
 
-def rebuild_entity_views(user_id: str, entity_id: str) -> None:
-    """Rigenera titles_index/claims_index per l'Entità."""
+# =============================================================================
+# Viste per entità: righe
+# =============================================================================
+def _contract_denorm(contract: Dict[str, Any]) -> Dict[str, Any]:
+    ident = contract.get("Identificativi") or {}
+    return {
+        "compagnia": ident.get("Compagnia"),
+        "numero_polizza": ident.get("NumeroPolizza"),
+        "rischio": (contract.get("RamiEl") or {}).get("Descrizione"),
+    }
+
+def _title_row(contract_id: str, title_id: str, contract: Dict[str, Any], t: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "contract_id": contract_id,
+        "title_id": title_id,
+        **_contract_denorm(contract),
+        "scadenza_titolo": t.get("scadenza_titolo"),
+        "stato": t.get("stato"),
+        "pv": t.get("pv"),
+        "pv2": t.get("pv2"),
+        "premio": t.get("premio_lordo"),
+    }
+
+def _claim_row(contract_id: str, claim_id: str, s: Dict[str, Any]) -> Dict[str, Any]:
+    row = dict(s)
+    row["claim_id"] = claim_id
+    row["contract_id"] = contract_id
+    return row
+
+# =============================================================================
+# Viste per entità: snapshot + delta per riga
+#   <vista>.json è lo snapshot; ogni mutazione scrive solo file delta piccoli in
+#   views/<vista>.d/ (stato più recente per chiave, riapplicarli è idempotente):
+#     "<contract_id>+<id>.json" → {"key": [contract_id, id], "row": riga | null}
+#     "<contract_id>.json"      → {"contract_id": ..., "denorm": campi del contratto}
+#   Una scrittura costa O(righe toccate), non O(righe dell'entità). La lettura
+#   ripiega snapshot + delta (in cache per versione) e, oltre VIEW_COMPACT_DELTAS
+#   delta, riscrive lo snapshot; le scritture compattano solo oltre VIEW_MAX_DELTAS.
+# =============================================================================
+_VIEW_KEYS = {_TITLES_VIEW: "title_id", _CLAIMS_VIEW: "claim_id"}
+
+def _view_file(user_id: str, entity_id: str, name: str) -> Path:
+    return views_dir_for_entity(user_id, entity_id) / name
+
+def _delta_dir(user_id: str, entity_id: str, name: str) -> Path:
+    return views_dir_for_entity(user_id, entity_id) / f"{name[:-5]}.d"
+
+def view_version(user_id: str, entity_id: str, name: str) -> tuple:
+    """Versione della vista: snapshot + delta (FileNotFoundError se lo snapshot non c'è)."""
+    d = _delta_dir(user_id, entity_id, name)
+    deltas = []
+    for stem in sorted(list_json(d)):
+        try:
+            deltas.append((stem, json_version(d / f"{stem}.json")))
+        except FileNotFoundError:
+            continue
+    return json_version(_view_file(user_id, entity_id, name)), tuple(deltas)
+
+def _fold(rows: List[Dict[str, Any]], deltas: List[Dict[str, Any]], key: str) -> List[Dict[str, Any]]:
+    # righe della cache: mai modificate, le righe aggiornate sono dict nuovi
+    out = {(r.get("contract_id"), r.get(key)): r for r in rows}
+    denorm: Dict[str, Dict[str, Any]] = {}
+    for d in deltas:
+        if "key" in d:
+            k = tuple(d["key"])
+            if d["row"] is None:
+                out.pop(k, None)
+            else:
+                out[k] = d["row"]
+        else:
+            denorm[d["contract_id"]] = d["denorm"]
+    if denorm and key == "title_id":
+        for k, r in out.items():
+            dn = denorm.get(k[0])
+            if dn is not None and any(r.get(f) != v for f, v in dn.items()):
+                out[k] = {**r, **dn}
+    return list(out.values())
+
+def _compact(user_id: str, entity_id: str, name: str, rows: List[Dict[str, Any]], stems: List[str]) -> None:
+    """Snapshot = vista ripiegata, poi via i delta inclusi (chiamare sotto entity_lock)."""
+    atomic_write_json(_view_file(user_id, entity_id, name), rows)
+    d = _delta_dir(user_id, entity_id, name)
+    for stem in stems:
+        try:
+            remove_file(d / f"{stem}.json")
+        except FileNotFoundError:
+            pass
+
+def load_view(user_id: str, entity_id: str, name: str) -> Optional[tuple]:
+    """
+    (righe, versione) della vista materializzata; None se l'entità non esiste.
+    Le righe sono condivise con la cache di lettura: da NON modificare.
+    """
+    f = _view_file(user_id, entity_id, name)
+    if not path_exists(f):
+        rebuild_entity_views(user_id, entity_id)
+        if not path_exists(f):
+            return None
+    with entity_lock(user_id, entity_id):
+        ver = view_version(user_id, entity_id, name)
+        ck = f"{f}\0view"
+        rows = cache_lookup(ck, ver)
+        if rows is None:
+            d = _delta_dir(user_id, entity_id, name)
+            stems = [stem for stem, _ in ver[1]]
+            rows = _fold(read_json(f, clone=False), [read_json(d / f"{s}.json", clone=False) for s in stems],
+                         _VIEW_KEYS[name])
+            if len(stems) > VIEW_COMPACT_DELTAS:
+                _compact(user_id, entity_id, name, rows, stems)
+                ver = view_version(user_id, entity_id, name)
+            cache_store(ck, ver, rows, ver[0][1] + sum(v[1] for _, v in ver[1]))
+    return rows, ver
+
+def _write_deltas(user_id: str, entity_id: str, name: str, deltas: Dict[str, Dict[str, Any]]) -> None:
+    with entity_lock(user_id, entity_id):
+        if not path_exists(_view_file(user_id, entity_id, name)):
+            rebuild_entity_views(user_id, entity_id)  # include già lo stato appena scritto
+            return
+        d = _delta_dir(user_id, entity_id, name)
+        atomic_write_json_many([(d / f"{stem}.json", obj) for stem, obj in deltas.items()])
+        if len(list_json(d)) > VIEW_MAX_DELTAS:
+            load_view(user_id, entity_id, name)  # ripiega e compatta
+
+def _row_delta(contract_id: str, row_id: str, row: Optional[Dict[str, Any]]) -> tuple:
+    return f"{contract_id}+{row_id}", {"key": [contract_id, row_id], "row": row}
+
+# =============================================================================
+# Viste per entità: rebuild completo (riparazione)
+# =============================================================================
+def rebuild_entity_views(user_id: str, entity_id: str) -> Dict[str, int]:
+    """
+    Rigenera titles_index/claims_index per l'Entità scansionando tutto l'albero.
+    Le scritture usano la manutenzione incrementale (upsert_*/remove_*):
+    questa funzione resta come operazione di riparazione.
+    """
     titles: List[Dict[str, Any]] = []
     claims: List[Dict[str, Any]] = []
 
-    croot = contracts_dir(user_id, entity_id)
-    if not croot.exists():
-        return
-    for cdir in croot.iterdir():
-        if not cdir.is_dir(): continue
-        cjson = contract_file(user_id, entity_id, cdir.name)
-        if not cjson.exists(): continue
-        contract = read_json(cjson)
-        n_pol = contract["Identificativi"]["NumeroPolizza"]
-        compagnia = contract["Identificativi"]["Compagnia"]
-        rischio = contract.get("RamiEl", {}).get("Descrizione")
-
-        # titoli
-        troot = titles_dir(user_id, entity_id, cdir.name)
-        if troot.exists():
-            for tf in troot.rglob("*.json"):
-                if tf.parent.name == "documents":  # salta metadati documenti
-                    continue
-                t = read_json(tf)
-                titles.append({
-                    "contract_id": cdir.name,
-                    "title_id": tf.stem,
-                    "compagnia": compagnia,
-                    "numero_polizza": n_pol,
-                    "rischio": rischio,
-                    "scadenza_titolo": t.get("scadenza_titolo"),
-                    "stato": t.get("stato"),
-                    "pv": t.get("pv"),
-                    "pv2": t.get("pv2"),
-                    "premio": t.get("premio_lordo"),
-                })
-
-        # sinistri
-        sroot = claims_dir(user_id, entity_id, cdir.name)
-        if sroot.exists():
-            for sdir in sroot.iterdir():
-                cf = sdir / "claim.json"
-                if cf.exists():
-                    s = read_json(cf); s["claim_id"] = sdir.name; s["contract_id"] = cdir.name
-                    claims.append(s)
-
-    vdir = views_dir_for_entity(user_id, entity_id)
-    atomic_write_json(vdir / "titles_index.json", titles)
-    atomic_write_json(vdir / "claims_index.json", claims)
+    with entity_lock(user_id, entity_id):
+        if not path_exists(entity_dir(user_id, entity_id)):
+            # entità inesistente: niente viste (e niente cartelle create da una GET)
+            return {"titles": 0, "claims": 0}
+        indexed = indexed_nodes(user_id, "contract", entity_id=entity_id)
+        if indexed is not None:
+            # sqlite: tre query sulle colonne indicizzate invece di visitare l'albero
+            contracts = {cid: c for _, _, cid, _, c in indexed}
+            titles = [_title_row(cid, tid, contracts[cid], t)
+                      for _, _, cid, tid, t in indexed_nodes(user_id, "title", entity_id=entity_id) if cid in contracts]
+            claims = [_claim_row(cid, sid, cl)
+                      for _, _, cid, sid, cl in indexed_nodes(user_id, "claim", entity_id=entity_id) if cid in contracts]
+        for cid in ([] if indexed is not None else list_dirs(contracts_dir(user_id, entity_id))):
+            cjson = contract_file(user_id, entity_id, cid)
+            if not path_exists(cjson): continue
+            contract = read_json(cjson)
 
-def compute_due_indexes(user_id: str, days: int = 120) -> Dict[str, Any]:
-    today = date.today()
-    limit = today + timedelta(days=days)
+            # titoli (solo file diretti: i metadati documenti stanno in titles/documents/)
+            troot = titles_dir(user_id, entity_id, cid)
+            for tid in list_json(troot):
+                titles.append(_title_row(cid, tid, contract, read_json(troot / f"{tid}.json")))
 
-    contracts_due: List[Dict[str, Any]] = []
-    titles_due: List[Dict[str, Any]] = []
+            # sinistri
+            sroot = claims_dir(user_id, entity_id, cid)
+            for sid in list_dirs(sroot):
+                cf = sroot / sid / "claim.json"
+                if path_exists(cf):
+                    claims.append(_claim_row(cid, sid, read_json(cf)))
 
-    # 0) Se l'area utente/entità non esiste, ritorna subito strutture vuote
-    base_entities: Path = entities_dir(user_id)
-    if not base_entities.exists():
-        return {"contracts_due": [], "titles_due": []}
+        for name, rows in ((_TITLES_VIEW, titles), (_CLAIMS_VIEW, claims)):
+            _compact(user_id, entity_id, name, rows, list_json(_delta_dir(user_id, entity_id, name)))
+    return {"titles": len(titles), "claims": len(claims)}
 
-    # 1) Itera sulle entità
-    for edir in base_entities.iterdir():
-        if not edir.is_dir():
-            continue
+# =============================================================================
+# Viste per entità: manutenzione incrementale (delta)
+#   Ogni mutazione scrive solo i delta delle righe interessate.
+#   Se la vista non esiste ancora si ricade sul rebuild completo.
+# =============================================================================
+def upsert_title_view(user_id: str, entity_id: str, contract_id: str, title_id: str,
+                      title: Dict[str, Any], contract: Dict[str, Any]) -> None:
+    _write_deltas(user_id, entity_id, _TITLES_VIEW, dict([
+        _row_delta(contract_id, title_id, _title_row(contract_id, title_id, contract, title))]))
 
-        # 2) Folder contratti opzionale
-        croot = edir / "contracts"
-        if not croot.exists():
-            continue
+def upsert_title_views(user_id: str, entity_id: str, contract_id: str,
+                       titles: Dict[str, Dict[str, Any]], contract: Dict[str, Any]) -> None:
+    """Come upsert_title_view per più titoli dello stesso contratto: una scrittura raggruppata."""
+    if titles:
+        _write_deltas(user_id, entity_id, _TITLES_VIEW, dict(
+            _row_delta(contract_id, tid, _title_row(contract_id, tid, contract, t)) for tid, t in titles.items()))
+
+def remove_title_view(user_id: str, entity_id: str, contract_id: str, title_id: str) -> None:
+    _write_deltas(user_id, entity_id, _TITLES_VIEW, dict([_row_delta(contract_id, title_id, None)]))
+
+def upsert_claim_view(user_id: str, entity_id: str, contract_id: str, claim_id: str, claim: Dict[str, Any]) -> None:
+    _write_deltas(user_id, entity_id, _CLAIMS_VIEW, dict([
+        _row_delta(contract_id, claim_id, _claim_row(contract_id, claim_id, claim))]))
+
+def remove_claim_view(user_id: str, entity_id: str, contract_id: str, claim_id: str) -> None:
+    _write_deltas(user_id, entity_id, _CLAIMS_VIEW, dict([_row_delta(contract_id, claim_id, None)]))
+
+def refresh_contract_view(user_id: str, entity_id: str, contract_id: str, contract: Dict[str, Any]) -> None:
+    """Campi denormalizzati dal contratto sulle righe titolo: un solo delta per contratto."""
+    _write_deltas(user_id, entity_id, _TITLES_VIEW,
+                  {contract_id: {"contract_id": contract_id, "denorm": _contract_denorm(contract)}})
+
+def remove_contract_view(user_id: str, entity_id: str, contract_id: str) -> None:
+    # un tombstone per riga del contratto: un contratto ricreato con lo stesso ID
+    # (import con contract_id) non fa riapparire le righe vecchie
+    with entity_lock(user_id, entity_id):
+        for name, key in _VIEW_KEYS.items():
+            res = load_view(user_id, entity_id, name)
+            if res is None:
+                return
+            gone = dict(_row_delta(contract_id, r.get(key), None) for r in res[0] if r.get("contract_id") == contract_id)
+            if gone:
+                _write_deltas(user_id, entity_id, name, gone)
+
+def apply_view_deltas(user_id: str, entity_id: str, contracts: Dict[str, Dict[str, Any]],
+                      titles: Dict[tuple, Optional[Dict[str, Any]]],
+                      claims: Dict[tuple, Optional[Dict[str, Any]]]) -> None:
+    """
+    Delta di più operazioni (POST .../batch) con una scrittura raggruppata per
+    vista. contracts: contratti scritti (campi denormalizzati); titles/claims:
+    (contract_id, id) → dati, o None per la rimozione.
+    """
+    def contract_of(cid: str) -> Dict[str, Any]:
+        if cid not in contracts:
+            cf = contract_file(user_id, entity_id, cid)
+            contracts[cid] = read_json(cf) if path_exists(cf) else {}
+        return contracts[cid]
+
+    with entity_lock(user_id, entity_id):
+        if titles or contracts:
+            deltas = {cid: {"contract_id": cid, "denorm": _contract_denorm(c)} for cid, c in contracts.items()}
+            deltas.update(_row_delta(cid, tid, None if t is None else _title_row(cid, tid, contract_of(cid), t))
+                          for (cid, tid), t in titles.items())
+            _write_deltas(user_id, entity_id, _TITLES_VIEW, deltas)
+        if claims:
+            _write_deltas(user_id, entity_id, _CLAIMS_VIEW, dict(
+                _row_delta(cid, sid, None if s is None else _claim_row(cid, sid, s)) for (cid, sid), s in claims.items()))
+
+# =============================================================================
+# Indice scadenze persistente, shardato per mese di scadenza
+#   indexes/due/contract/<AAAA-MM>.json   [data_iso, riga] ordinati per data
+#   indexes/due/title/<AAAA-MM>.json
+#   indexes/due/loc/<eid>/<cid>.json      {"contract": mese, "titles": {tid: mese}}
+#   indexes/due/_ready.json               marker: indice costruito
+#   La dashboard legge solo i mesi dell'intervallo (bisect nel primo e
+#   nell'ultimo); una scrittura riscrive il locator del contratto e i soli
+#   mesi della scadenza vecchia e nuova, ognuno sotto il proprio lock (le
+#   scritture arrivano già serializzate per entità da entity_lock). Il lock
+#   del tenant serve solo alla costruzione completa: senza marker gli
+#   scrittori la attendono, poi applicano la propria modifica.
+# =============================================================================
+_DUE_KINDS = ("contract", "title")
+_DUE_READY = "_ready.json"
+_UNCHANGED = object()
+
+def _due_lock(user_id: str) -> threading.RLock:
+    return path_lock(str(due_dir(user_id)))
+
+def _due_shard(user_id: str, kind: str, month: str) -> Path:
+    return due_dir(user_id) / kind / f"{month}.json"
 
-        # 3) Itera sui contratti dell'entità (se esistono)
+def _due_loc(user_id: str, entity_id: str, contract_id: str) -> Path:
+    return due_dir(user_id) / "loc" / entity_id / f"{contract_id}.json"
+
+def _due_key(kind: str, row: Dict[str, Any]) -> tuple:
+    if kind == "contract":
+        return row["entity_id"], row["contract_id"]
+    return row["entity_id"], row["contract_id"], row["title_id"]
+
+# Con il backend sqlite l'indice è la colonna `scadenza` della tabella nodes
+# (indice bucket, kind, scadenza): niente file da mantenere in scrittura.
+def _indexed_due(user_id: str, kind: str, lo: str, hi: str) -> Optional[List[list]]:
+    nodes = indexed_nodes(user_id, kind, scadenza=(lo, hi))
+    if nodes is None:
+        return None
+    out = []
+    for _, eid, cid, oid, obj in nodes:
+        e = _contract_due_entry(eid, cid, obj) if kind == "contract" else _title_due_entry(eid, cid, oid, obj)
+        if e and lo <= e[0] <= hi:
+            out.append(e)
+    return out
+
+def _iso_date(v: Any) -> Optional[str]:
+    """Normalizza una scadenza (date o stringa ISO) nella chiave di ordinamento; None se non valida."""
+    if isinstance(v, date):
+        return v.isoformat()
+    if isinstance(v, str) and v:
         try:
-            cdirs = list(croot.iterdir())
+            return date.fromisoformat(v).isoformat()
+        except ValueError:
+            return None
+    return None
+
+def _contract_due_entry(entity_id: str, contract_id: str, c: Dict[str, Any]) -> Optional[list]:
+    scad = (c.get("Amministrativi") or {}).get("Scadenza")
+    key = _iso_date(scad)
+    if key is None:
+        return None
+    ident = c.get("Identificativi") or {}
+    return [key, {
+        "entity_id":      entity_id,
+        "contract_id":    contract_id,
+        "numero_polizza": ident.get("NumeroPolizza"),
+        "compagnia":      ident.get("Compagnia"),
+        "scadenza":       scad if isinstance(scad, str) else key,
+    }]
+
+def _title_due_entry(entity_id: str, contract_id: str, title_id: str, t: Dict[str, Any]) -> Optional[list]:
+    scadt = t.get("scadenza_titolo")
+    key = _iso_date(scadt)
+    if key is None:
+        return None
+    return [key, {
+        "entity_id":       entity_id,
+        "contract_id":     contract_id,
+        "title_id":        title_id,
+        "scadenza_titolo": scadt if isinstance(scadt, str) else key,
+        "stato":           t.get("stato"),
+        "premio":          t.get("premio_lordo"),
+    }]
+
+def _build_due(user_id: str) -> Dict[str, int]:
+    """Scansione completa del tenant → shard mensili + locator. Chiamare sotto _due_lock."""
+    ready = due_dir(user_id) / _DUE_READY
+    if path_exists(ready):
+        remove_file(ready)  # gli scrittori attendono la fine della costruzione
+    shards: Dict[tuple, List[list]] = {}
+    locs: Dict[tuple, Dict[str, Any]] = {}
+    counts = {"contracts": 0, "titles": 0}
+
+    def add(kind: str, e: list) -> None:
+        shards.setdefault((kind, e[0][:7]), []).append(e)
+        loc = locs.setdefault((e[1]["entity_id"], e[1]["contract_id"]), {"contract": None, "titles": {}})
+        if kind == "contract":
+            loc["contract"] = e[0][:7]
+        else:
+            loc["titles"][e[1]["title_id"]] = e[0][:7]
+        counts[f"{kind}s"] += 1
+
+    base_entities: Path = entities_dir(user_id)
+    for eid in list_dirs(base_entities):
+        croot = base_entities / eid / "contracts"
+        try:
+            cids = list_dirs(croot)
         except FileNotFoundError:
-            # La cartella è stata rimossa fra il check e l'iterazione
+            # cartella rimossa fra il check e l'iterazione
             continue
 
-        for cdir in cdirs:
-            if not cdir.is_dir():
-                continue
-
-            # 3a) Scadenza contratto da contract.json
-            cj = cdir / "contract.json"
-            if cj.exists():
+        for cid in cids:
+            cj = croot / cid / "contract.json"
+            if path_exists(cj):
                 try:
-                    c = read_json(cj)  # può lanciare eccezioni
+                    c = read_json(cj)
                 except Exception:
                     c = None
-
                 if isinstance(c, dict):
-                    scad = (c.get("Amministrativi") or {}).get("Scadenza")
-                    if isinstance(scad, str) and scad:
-                        try:
-                            d = date.fromisoformat(scad)
-                            if today <= d <= limit:
-                                ident = (c.get("Identificativi") or {})
-                                contracts_due.append({
-                                    "entity_id":   edir.name,
-                                    "contract_id": cdir.name,
-                                    "numero_polizza": ident.get("NumeroPolizza"),
-                                    "compagnia":      ident.get("Compagnia"),
-                                    "scadenza":       scad,
-                                })
-                        except Exception:
-                            # data non ISO o non parsabile → ignora
-                            pass
-
-            # 3b) Scadenze titoli sotto il contratto (cartella opzionale)
-            troot = cdir / "titles"
-            if not troot.exists():
-                continue
-
-            # Scansiona tutti i .json dei titoli (escludi metadati documenti)
-            try:
-                json_files = list(troot.rglob("*.json"))
-            except FileNotFoundError:
-                continue
-
-            for tf in json_files:
-                if tf.parent.name == "documents":
-                    continue
+                    e = _contract_due_entry(eid, cid, c)
+                    if e: add("contract", e)
+
+            troot = croot / cid / "titles"
+            for tid in list_json(troot):
                 try:
-                    t = read_json(tf)
+                    t = read_json(troot / f"{tid}.json")
                 except Exception:
                     continue
-                if not isinstance(t, dict):
+                if isinstance(t, dict):
+                    e = _title_due_entry(eid, cid, tid, t)
+                    if e: add("title", e)
+
+    # prima i file nuovi, poi via quelli superati: chi legge vede il vecchio o il nuovo
+    atomic_write_json_many([(_due_loc(user_id, eid, cid), loc) for (eid, cid), loc in locs.items()])
+    for (kind, month), rows in shards.items():
+        rows.sort(key=lambda e: e[0])
+        with path_lock(str(_due_shard(user_id, kind, month))):
+            atomic_write_json(_due_shard(user_id, kind, month), rows)
+    for kind in _DUE_KINDS:
+        for month in list_json(due_dir(user_id) / kind):
+            if (kind, month) not in shards:
+                with path_lock(str(_due_shard(user_id, kind, month))):
+                    remove_file(_due_shard(user_id, kind, month))
+    for f in glob_json(due_dir(user_id) / "loc", "*/*.json"):
+        if (f.parent.name, f.stem) not in locs:
+            remove_file(f)
+    for legacy in ("contracts.json", "titles.json"):  # formato precedente: un file per tipo
+        if path_exists(due_dir(user_id) / legacy):
+            remove_file(due_dir(user_id) / legacy)
+    atomic_write_json(ready, counts)
+    return counts
+
+def _ensure_due(user_id: str) -> bool:
+    """Indice pronto (costruito se manca); False = tenant vuoto, nulla da indicizzare."""
+    ready = due_dir(user_id) / _DUE_READY
+    if path_exists(ready):
+        return True
+    with _due_lock(user_id):
+        if path_exists(ready):
+            return True
+        if not path_exists(entities_dir(user_id)):
+            return False
+        _build_due(user_id)
+    return True
+
+def rebuild_due_index(user_id: str) -> Dict[str, int]:
+    """Ricostruisce l'indice scadenze con una scansione completa del tenant (riparazione)."""
+    indexed = _indexed_due(user_id, "contract", "0000", "9999-99-99")
+    if indexed is not None:
+        return {"contracts": len(indexed), "titles": len(_indexed_due(user_id, "title", "0000", "9999-99-99"))}
+    with _due_lock(user_id):
+        return _build_due(user_id)
+
+def _update_shard(user_id: str, kind: str, month: str, drop: set, add: List[list]) -> None:
+    f = _due_shard(user_id, kind, month)
+    with path_lock(str(f)):
+        rows = read_json(f, clone=False) if path_exists(f) else []
+        keep = [e for e in rows if _due_key(kind, e[1]) not in drop]
+        if not add and len(keep) == len(rows):
+            return
+        keep.extend(add)
+        keep.sort(key=lambda e: e[0])
+        if keep:
+            atomic_write_json(f, keep)
+        elif path_exists(f):
+            remove_file(f)
+
+def _update_contract_due(user_id: str, entity_id: str, contract_id: str, contract: Any = _UNCHANGED,
+                         titles: Optional[Dict[str, Optional[Dict[str, Any]]]] = None, remove: bool = False) -> None:
+    """
+    Voci di un contratto e dei suoi titoli (None = voce rimossa); remove=True
+    toglie tutto il contratto. Tocca solo il locator e i mesi coinvolti.
+    """
+    if sqlite_store() or not _ensure_due(user_id):
+        return
+    lf = _due_loc(user_id, entity_id, contract_id)
+    with path_lock(str(lf)):
+        loc = read_json(lf) if path_exists(lf) else {"contract": None, "titles": {}}
+        plan: Dict[tuple, tuple] = {}
+
+        def move(kind: str, key: tuple, old: Optional[str], e: Optional[list]) -> Optional[str]:
+            # via dal mese vecchio, dentro quello nuovo (sostituendo l'eventuale voce)
+            for month in {old, e[0][:7] if e else None} - {None}:
+                plan.setdefault((kind, month), (set(), []))[0].add(key)
+            if e:
+                plan[(kind, e[0][:7])][1].append(e)
+            return e[0][:7] if e else None
+
+        if remove:
+            move("contract", (entity_id, contract_id), loc["contract"], None)
+            for tid, month in loc["titles"].items():
+                move("title", (entity_id, contract_id, tid), month, None)
+            loc = {"contract": None, "titles": {}}
+        else:
+            if contract is not _UNCHANGED:
+                e = None if contract is None else _contract_due_entry(entity_id, contract_id, contract)
+                loc["contract"] = move("contract", (entity_id, contract_id), loc["contract"], e)
+            for tid, t in (titles or {}).items():
+                e = None if t is None else _title_due_entry(entity_id, contract_id, tid, t)
+                month = move("title", (entity_id, contract_id, tid), loc["titles"].pop(tid, None), e)
+                if month:
+                    loc["titles"][tid] = month
+        for (kind, month), (drop, add) in sorted(plan.items(), key=lambda kv: kv[0]):
+            _update_shard(user_id, kind, month, drop, add)
+        if loc["contract"] or loc["titles"]:
+            atomic_write_json(lf, loc)
+        elif path_exists(lf):
+            remove_file(lf)
+
+def upsert_contract_due(user_id: str, entity_id: str, contract_id: str, contract: Dict[str, Any]) -> None:
+    _update_contract_due(user_id, entity_id, contract_id, contract=contract)
+
+def upsert_title_due(user_id: str, entity_id: str, contract_id: str, title_id: str, title: Dict[str, Any]) -> None:
+    _update_contract_due(user_id, entity_id, contract_id, titles={title_id: title})
+
+def upsert_titles_due(user_id: str, entity_id: str, contract_id: str, titles: Dict[str, Dict[str, Any]]) -> None:
+    """Come upsert_title_due per più titoli: ogni mese coinvolto è riscritto una volta."""
+    if titles:
+        _update_contract_due(user_id, entity_id, contract_id, titles=titles)
+
+def apply_due_deltas(user_id: str, entity_id: str, contracts: Dict[str, Dict[str, Any]],
+                     titles: Dict[tuple, Optional[Dict[str, Any]]]) -> None:
+    """Delta di un batch sull'indice scadenze: un aggiornamento per contratto toccato."""
+    by_contract: Dict[str, Dict[str, Any]] = {}
+    for (cid, tid), t in titles.items():
+        by_contract.setdefault(cid, {})[tid] = t
+    for cid in sorted(set(contracts) | set(by_contract)):
+        _update_contract_due(user_id, entity_id, cid, contracts.get(cid, _UNCHANGED), by_contract.get(cid))
+
+def remove_title_due(user_id: str, entity_id: str, contract_id: str, title_id: str) -> None:
+    _update_contract_due(user_id, entity_id, contract_id, titles={title_id: None})
+
+def remove_contract_due(user_id: str, entity_id: str, contract_id: str) -> None:
+    """Rimuove il contratto e tutti i suoi titoli dall'indice scadenze."""
+    _update_contract_due(user_id, entity_id, contract_id, remove=True)
+
+def remove_entity_due(user_id: str, entity_id: str) -> None:
+    for cid in list_json(due_dir(user_id) / "loc" / entity_id):
+        _update_contract_due(user_id, entity_id, cid, remove=True)
+
+def _due_entries(user_id: str, kind: str, lo: str, hi: str) -> List[list]:
+    """Voci [data, riga] con lo <= data <= hi, ordinate; lette solo dai mesi dell'intervallo."""
+    indexed = _indexed_due(user_id, kind, lo, hi)
+    if indexed is not None:
+        return sorted(indexed, key=lambda e: e[0])
+    if not _ensure_due(user_id):
+        return []
+    out: List[list] = []
+    for month in sorted(m for m in list_json(due_dir(user_id) / kind) if lo[:7] <= m <= hi[:7]):
+        try:
+            rows = read_json(_due_shard(user_id, kind, month), clone=False)  # sola lettura: si copia la fetta
+        except FileNotFoundError:
+            continue  # mese svuotato fra l'elenco e la lettura
+        a = bisect_left(rows, lo, key=lambda e: e[0])
+        b = bisect_right(rows, hi, lo=a, key=lambda e: e[0])
+        out.extend([e[0], dict(e[1])] for e in rows[a:b])
+    return out
+
+def compute_due_indexes(user_id: str, days: int = 120) -> Dict[str, Any]:
+    today = date.today().isoformat()
+    limit = (date.today() + timedelta(days=days)).isoformat()
+    return {"contracts_due": [e[1] for e in _due_entries(user_id, "contract", today, limit)],
+            "titles_due": [e[1] for e in _due_entries(user_id, "title", today, limit)]}
+
+# =============================================================================
+# Indice owner → documenti (per contratto): contracts/<cid>/doc_owners.json
+#   { "claims": { claim_id: { doc_id: "shared"|"legacy" } },
+#     "titles": { title_id: { doc_id: "shared" } } }
+#   Copre la cartella condivisa claims|titles/documents/ e il legacy
+#   claims/<claim_id>/documents/. Se manca si ricostruisce con una scansione.
+# =============================================================================
+def _indexed_doc_owners(user_id: str, entity_id: str, contract_id: str,
+                        owner_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """Stessa struttura di doc_owners.json dalla colonna owner_id (sqlite); None su fs."""
+    nodes = indexed_nodes(user_id, "document", entity_id=entity_id, contract_id=contract_id, owner_id=owner_id)
+    if nodes is None:
+        return None
+    owners: Dict[str, Dict[str, Dict[str, str]]] = {"claims": {}, "titles": {}}
+    for p, _, _, oid, _ in nodes:
+        # .../contracts/<cid>/{claims|titles}/documents/<doc>.json (condivisa)
+        # .../contracts/<cid>/claims/<claim_id>/documents/<doc>.json (legacy)
+        parts = p.parts
+        kind = parts[parts.index("contracts") + 2]
+        if oid and kind in owners:
+            owners[kind].setdefault(oid, {})[p.stem] = "shared" if parts[-3] == kind else "legacy"
+    return owners
+
+def rebuild_doc_owners(user_id: str, entity_id: str, contract_id: str) -> Dict[str, Any]:
+    indexed = _indexed_doc_owners(user_id, entity_id, contract_id)
+    if indexed is not None:
+        return indexed
+    f = doc_owners_file(user_id, entity_id, contract_id)
+    owners: Dict[str, Dict[str, Dict[str, str]]] = {"claims": {}, "titles": {}}
+    with path_lock(str(f)):
+        cdir = f.parent
+        for kind, key in (("claims", "claim_id"), ("titles", "title_id")):
+            for mf in glob_json(cdir / kind / "documents", "*.json"):
+                try:
+                    owner = read_json(mf).get(key)
+                except Exception:
                     continue
+                if owner:
+                    owners[kind].setdefault(owner, {})[mf.stem] = "shared"
+        # legacy: claims/<claim_id>/documents/ → tutti i file sono del claim
+        for mf in glob_json(cdir / "claims", "*/documents/*.json"):
+            owners["claims"].setdefault(mf.parent.parent.name, {})[mf.stem] = "legacy"
+        if path_exists(cdir / "contract.json"):  # niente indici orfani per contratti inesistenti
+            atomic_write_json(f, owners)
+    return owners
+
+def _load_doc_owners(user_id: str, entity_id: str, contract_id: str, clone: bool = True) -> Dict[str, Any]:
+    """Indice owner del contratto; clone=False: oggetto della cache, da NON modificare."""
+    f = doc_owners_file(user_id, entity_id, contract_id)
+    if sqlite_store() or not path_exists(f):
+        return rebuild_doc_owners(user_id, entity_id, contract_id)
+    return read_json(f, clone=clone)
 
-                scadt = t.get("scadenza_titolo")
-                if isinstance(scadt, str) and scadt:
-                    try:
-                        dt = date.fromisoformat(scadt)
-                        if today <= dt <= limit:
-                            titles_due.append({
-                                "entity_id":       edir.name,
-                                "contract_id":     cdir.name,
-                                "title_id":        tf.stem,
-                                "scadenza_titolo": scadt,
-                                "stato":           t.get("stato"),
-                                "premio":          t.get("premio_lordo"),
-                            })
-                    except Exception:
-                        pass
-
-    return {"contracts_due": contracts_due, "titles_due": titles_due}
+def _update_doc_owners(user_id: str, entity_id: str, contract_id: str, mutate) -> None:
+    if sqlite_store():
+        return  # la colonna owner_id è aggiornata dalla scrittura del meta
+    f = doc_owners_file(user_id, entity_id, contract_id)
+    with path_lock(str(f)):
+        owners = _load_doc_owners(user_id, entity_id, contract_id)
+        if mutate(owners):
+            atomic_write_json(f, owners)
+
+def doc_owner_add(user_id: str, entity_id: str, contract_id: str, kind: str, owner_id: str,
+                  doc_id: str, where: str = "shared") -> None:
+    def mutate(owners: Dict[str, Any]) -> bool:
+        docs = owners.setdefault(kind, {}).setdefault(owner_id, {})
+        if docs.get(doc_id) == where:
+            return False
+        docs[doc_id] = where
+        return True
+    _update_doc_owners(user_id, entity_id, contract_id, mutate)
+
+def doc_owner_remove(user_id: str, entity_id: str, contract_id: str, kind: str, owner_id: str, doc_id: str) -> None:
+    def mutate(owners: Dict[str, Any]) -> bool:
+        docs = owners.get(kind, {}).get(owner_id, {})
+        if docs.pop(doc_id, None) is None:
+            return False
+        if not docs:
+            owners[kind].pop(owner_id, None)
+        return True
+    _update_doc_owners(user_id, entity_id, contract_id, mutate)
+
+def doc_owner_drop_legacy(user_id: str, entity_id: str, contract_id: str, claim_id: str) -> None:
+    """Dopo la rimozione della cartella del claim: i doc legacy spariscono, quelli condivisi restano."""
+    def mutate(owners: Dict[str, Any]) -> bool:
+        docs = owners.get("claims", {}).get(claim_id)
+        if not docs:
+            return False
+        keep = {d: w for d, w in docs.items() if w != "legacy"}
+        if len(keep) == len(docs):
+            return False
+        if keep:
+            owners["claims"][claim_id] = keep
+        else:
+            owners["claims"].pop(claim_id, None)
+        return True
+    _update_doc_owners(user_id, entity_id, contract_id, mutate)
+
+def list_owner_docs(user_id: str, entity_id: str, contract_id: str, kind: str, owner_id: str) -> Dict[str, str]:
+    """doc_id → "shared"|"legacy" per il proprietario (claim o titolo)."""
+    indexed = _indexed_doc_owners(user_id, entity_id, contract_id, owner_id)
+    if indexed is not None:
+        return indexed[kind].get(owner_id, {})
+    f = doc_owners_file(user_id, entity_id, contract_id)
+    with path_lock(str(f)):
+        # senza copia dell'indice intero: si copia solo la voce del proprietario
+        return dict(_load_doc_owners(user_id, entity_id, contract_id, clone=False).get(kind, {}).get(owner_id, {}))
+
+def contract_doc_owners(user_id: str, entity_id: str, contract_id: str) -> Dict[str, Any]:
+    """Indice owner dell'intero contratto (sola lettura): una lettura per N proprietari."""
+    indexed = _indexed_doc_owners(user_id, entity_id, contract_id)
+    if indexed is not None:
+        return indexed
+    f = doc_owners_file(user_id, entity_id, contract_id)
+    with path_lock(str(f)):
+        return _load_doc_owners(user_id, entity_id, contract_id, clone=False)
 
 def iter_all_document_meta_files(user_id: str) -> list[Path]:
     base = user_dir(user_id)
-    return list(base.glob("**/documents/*.json"))
+    return glob_json(base, "**/documents/*.json")
 
-def count_blob_references(user_id: str, sha1: str) -> int:
-    total = 0
-    for mf in iter_all_document_meta_files(user_id):
+# =============================================================================
+# Refcount blob (tabella persistente in indexes/blob_refs/)
+#   Il conteggio = numero di metadati documento che puntano allo SHA1.
+#   Alla prima richiesta (tenant pre-esistente) la tabella si costruisce da zero.
+# =============================================================================
+_BLOB_REFS_READY = "_ready.json"  # marker: tabella costruita (JSON: vale anche col backend sqlite)
+
+def _blob_ref_shards(rdir: Path) -> List[Path]:
+    return [p for p in glob_json(rdir, "*.json") if len(p.stem) == 2]
+
+def rebuild_blob_refs(user_id: str, verify_only: bool = False) -> Dict[str, Any]:
+    """
+    Ricalcola i riferimenti dai metadati documento e li confronta con la tabella.
+    Con verify_only=True riporta solo le differenze senza riscrivere nulla.
+    """
+    actual: Dict[str, int] = dict(indexed_hash_counts(user_id) or {})
+    for mf in ([] if sqlite_store() else iter_all_document_meta_files(user_id)):
+        try:
+            h = read_json(mf).get("hash")
+        except Exception:
+            continue
+        if h:
+            actual[h] = actual.get(h, 0) + 1
+    # blob presenti su disco ma non referenziati → 0
+    broot = blobs_dir(user_id)
+    for bp in broot.glob("*/*"):
+        if bp.is_file() and len(bp.parent.name) == 2:
+            actual.setdefault(bp.name, 0)
+    for h, _ in iter_packed(user_id):
+        actual.setdefault(h, 0)
+
+    rdir = blob_refs_dir(user_id)
+    stored: Dict[str, int] = {}
+    for shard in _blob_ref_shards(rdir):
         try:
-            meta = read_json(mf)
-            if meta.get("hash") == sha1:
-                total += 1
+            stored.update(read_json(shard))
         except Exception:
             continue
-    return total
+
+    mismatches = [
+        {"hash": h, "stored": stored.get(h), "actual": actual.get(h, 0)}
+        for h in sorted(set(actual) | set(stored))
+        if stored.get(h) != actual.get(h, 0)
+    ]
+    if not verify_only:
+        shards: Dict[str, Dict[str, int]] = {}
+        for h, n in actual.items():
+            shards.setdefault(h[:2], {})[h] = n
+        for shard in _blob_ref_shards(rdir):
+            if shard.stem not in shards:
+                remove_file(shard)
+        for prefix, counts in shards.items():
+            with path_lock(str(rdir / f"{prefix}.json")):
+                atomic_write_json(rdir / f"{prefix}.json", counts)
+        atomic_write_json(rdir / _BLOB_REFS_READY, {"hashes": len(actual)})
+    return {
+        "hashes": len(actual),
+        "references": sum(actual.values()),
+        "unreferenced": sum(1 for n in actual.values() if n == 0),
+        "mismatches": mismatches,
+    }
+
+def ensure_blob_refs(user_id: str) -> None:
+    """Costruisce la tabella se manca. Chiamare PRIMA di scrivere/rimuovere il meta (evita doppi conteggi)."""
+    if not path_exists(blob_refs_dir(user_id) / _BLOB_REFS_READY):
+        with path_lock(str(blob_refs_dir(user_id))):
+            if not path_exists(blob_refs_dir(user_id) / _BLOB_REFS_READY):
+                rebuild_blob_refs(user_id)
+
+def blob_ref_incr(user_id: str, sha1: str) -> int:
+    ensure_blob_refs(user_id)
+    return blob_refs_adjust(user_id, sha1, +1)
+
+def blob_ref_decr(user_id: str, sha1: str) -> int:
+    ensure_blob_refs(user_id)
+    return blob_refs_adjust(user_id, sha1, -1)
+
+# Riferimento nuovo / rilasciato sotto il lock del blob (lo stesso di BlobWriter.commit
+# e del GC): un dedup non può agganciarsi a un blob che una delete sta eliminando.
+def blob_ref_take(user_id: str, sha1: str) -> None:
+    """+1 al refcount, PRIMA di scrivere il metadato; 409 se il blob è stato eliminato nel frattempo."""
+    ensure_blob_refs(user_id)
+    with path_lock(str(blob_path_for_hash(user_id, sha1))):
+        if locate_blob(user_id, sha1) is None:
+            raise HTTPException(status_code=409, detail="Contenuto eliminato da una richiesta concorrente: ripetere l'upload.")
+        blob_refs_adjust(user_id, sha1, +1)
+
+def blob_ref_release(user_id: str, sha1: str, delete_blob: bool = False) -> None:
+    """-1 al refcount; con delete_blob elimina il contenuto se, sotto lock, nessuno lo referenzia."""
+    blob_ref_decr(user_id, sha1)
+    if not delete_blob:
+        return
+    with path_lock(str(blob_path_for_hash(user_id, sha1))):
+        if not blob_refs_get(user_id, sha1):
+            delete_blob_content(user_id, sha1)  # file sciolto o voce di pack
+
+def release_blob_refs_under(user_id: str, root: Path) -> None:
+    """Da chiamare PRIMA di rimuovere un sottoalbero: decrementa i blob dei documenti contenuti."""
+    for mf in glob_json(root, "**/documents/*.json"):
+        try:
+            h = read_json(mf).get("hash")
+        except Exception:
+            continue
+        if h:
+            blob_ref_decr(user_id, h)
+
+def count_blob_references(user_id: str, sha1: str) -> int:
+    ensure_blob_refs(user_id)
+    return blob_refs_get(user_id, sha1) or 0
@@ -0,0 +1,211 @@
+from __future__ import annotations
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, Iterator, Optional
+
+from fastapi import HTTPException
+
+from app.config import UPLOAD_CHUNK_SIZE, UPLOAD_SESSION_TTL_S, UPLOAD_SESSION_SWEEP_S
+from app.utils.utils import (
+    upload_sessions_dir, upload_parts_dir, atomic_write_json, read_json, list_json,
+    path_exists, remove_file, ensure_dir, BlobWriter, should_compress
+)
+
+# =============================================================================
+# Upload riprendibili
+#   sessione → indexes/uploads/<upload_id>.json (destinazione, meta, size,
+#              chunk_size, sha1 atteso; doc_id dopo il completamento)
+#   dati     → blobs/.uploads/<upload_id>.part (stesso filesystem dei blob)
+#   Il blocco n copre [n*chunk_size, (n+1)*chunk_size): l'offset ricevuto è la
+#   dimensione del .part arrotondata al blocco intero, quindi un blocco
+#   interrotto a metà va solo rimandato. La sessione scade UPLOAD_SESSION_TTL_S
+#   dopo l'ultima attività (mtime del .part, o completamento); le scadute
+#   sono eliminate da un thread del server ogni UPLOAD_SESSION_SWEEP_S.
+# =============================================================================
+_busy: set[str] = set()  # sessioni con una richiesta in corso (in-process)
+_busy_guard = threading.Lock()
+
+def _session_file(user_id: str, upload_id: str) -> Path:
+    return upload_sessions_dir(user_id) / f"{upload_id}.json"
+
+def _part_file(user_id: str, upload_id: str) -> Path:
+    return upload_parts_dir(user_id) / f"{upload_id}.part"
+
+def _last_activity(user_id: str, s: Dict[str, Any]) -> float:
+    try:
+        return max(s["updated_at"], _part_file(user_id, s["upload_id"]).stat().st_mtime)
+    except FileNotFoundError:
+        return s["updated_at"]
+
+def create_session(user_id: str, target: Dict[str, Any], meta: Dict[str, Any], size: int,
+                   chunk_size: int, sha1: Optional[str]) -> Dict[str, Any]:
+    upload_id = uuid.uuid4().hex
+    s = {"upload_id": upload_id, "target": target, "meta": meta, "size": size,
+         "chunk_size": chunk_size, "sha1": sha1, "doc_id": None, "updated_at": time.time()}
+    ensure_dir(upload_parts_dir(user_id))
+    _part_file(user_id, upload_id).touch()
+    atomic_write_json(_session_file(user_id, upload_id), s)
+    return s
+
+def load_session(user_id: str, upload_id: str) -> Dict[str, Any]:
+    if not upload_id.isalnum():
+        raise HTTPException(status_code=400, detail="upload_id non valido.")
+    sf = _session_file(user_id, upload_id)
+    if not path_exists(sf):
+        raise HTTPException(status_code=404, detail="Sessione di upload non trovata o scaduta.")
+    s = read_json(sf)
+    if _last_activity(user_id, s) + UPLOAD_SESSION_TTL_S < time.time():
+        drop_session(user_id, upload_id)
+        raise HTTPException(status_code=404, detail="Sessione di upload non trovata o scaduta.")
+    return s
+
+def drop_session(user_id: str, upload_id: str) -> None:
+    try:
+        _part_file(user_id, upload_id).unlink()
+    except FileNotFoundError:
+        pass
+    try:
+        remove_file(_session_file(user_id, upload_id))
+    except FileNotFoundError:
+        pass
+
+def received_offset(user_id: str, s: Dict[str, Any]) -> int:
+    if s.get("doc_id"):
+        return s["size"]
+    try:
+        n = _part_file(user_id, s["upload_id"]).stat().st_size
+    except FileNotFoundError:
+        return 0
+    if n >= s["size"]:
+        return s["size"]
+    return n - n % s["chunk_size"]
+
+def session_status(user_id: str, s: Dict[str, Any]) -> Dict[str, Any]:
+    offset = received_offset(user_id, s)
+    expires = _last_activity(user_id, s) + UPLOAD_SESSION_TTL_S
+    return {
+        "upload_id": s["upload_id"], "size": s["size"], "chunk_size": s["chunk_size"],
+        "offset": offset, "next_chunk": offset // s["chunk_size"] if offset < s["size"] else None,
+        "expires_at": datetime.fromtimestamp(expires, timezone.utc).isoformat(),
+        "doc_id": s.get("doc_id"),
+    }
+
+@contextmanager
+def session_busy(upload_id: str) -> Iterator[None]:
+    """Una sola richiesta alla volta per sessione (409 alla seconda)."""
+    with _busy_guard:
+        if upload_id in _busy:
+            raise HTTPException(status_code=409, detail="Richiesta già in corso su questa sessione di upload.")
+        _busy.add(upload_id)
+    try:
+        yield
+    finally:
+        with _busy_guard:
+            _busy.discard(upload_id)
+
+def chunk_bounds(user_id: str, s: Dict[str, Any], n: int) -> tuple[int, int]:
+    """[start, end) del blocco n; 409 se completato o se lascerebbe un buco."""
+    if s.get("doc_id"):
+        raise HTTPException(status_code=409, detail="Upload già completato.")
+    start = n * s["chunk_size"]
+    if n < 0 or start >= max(s["size"], 1):
+        raise HTTPException(status_code=416, detail="Numero di blocco fuori dal file.")
+    offset = received_offset(user_id, s)
+    if start > offset:
+        raise HTTPException(status_code=409, detail=f"Blocco non contiguo: offset ricevuto {offset}.")
+    return start, min(start + s["chunk_size"], s["size"])
+
+def open_chunk(user_id: str, s: Dict[str, Any], start: int) -> BinaryIO:
+    # i blocchi successivi a `start` si scartano (reinvio di un blocco già ricevuto)
+    f = open(_part_file(user_id, s["upload_id"]), "r+b")
+    f.truncate(start)
+    f.seek(start)
+    return f
+
+def close_chunk(f: BinaryIO, start: int, written: int, expected: int) -> None:
+    # blocco incompleto: si riporta il .part all'inizio del blocco
+    if written != expected:
+        f.truncate(start)
+    f.close()
+
+def commit_session_blob(user_id: str, s: Dict[str, Any]) -> tuple[str, str, int]:
+    """Riversa il .part completo nel blobstore (dedup SHA1 di BlobWriter)."""
+    writer = BlobWriter(user_id, s.get("sha1"), should_compress(s["meta"].get("mime")))
+    try:
+        with open(_part_file(user_id, s["upload_id"]), "rb") as f:
+            while True:
+                chunk = f.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                writer.write(chunk)
+        return writer.commit()
+    except BaseException:
+        writer.abort()
+        raise
+
+def finish_session(user_id: str, s: Dict[str, Any], doc_id: str) -> None:
+    # la sessione resta (senza dati) fino alla scadenza: un retry del completamento
+    # riceve lo stesso doc_id invece di un 404
+    s.update(doc_id=doc_id, updated_at=time.time())
+    atomic_write_json(_session_file(user_id, s["upload_id"]), s)
+    try:
+        _part_file(user_id, s["upload_id"]).unlink()
+    except FileNotFoundError:
+        pass
+
+def expire_sessions(user_id: str, now: Optional[float] = None) -> int:
+    """Elimina le sessioni scadute e i .part senza sessione; ritorna quante."""
+    now = time.time() if now is None else now
+    dropped = 0
+    for upload_id in list_json(upload_sessions_dir(user_id)):
+        try:
+            s = read_json(_session_file(user_id, upload_id))
+        except (FileNotFoundError, ValueError):
+            continue
+        if _last_activity(user_id, s) + UPLOAD_SESSION_TTL_S < now and upload_id not in _busy:
+            drop_session(user_id, upload_id)
+            dropped += 1
+    pdir = upload_parts_dir(user_id)
+    if pdir.is_dir():
+        for part in pdir.glob("*.part"):
+            try:
+                if not path_exists(_session_file(user_id, part.stem)) and part.stat().st_mtime + UPLOAD_SESSION_TTL_S < now:
+                    part.unlink()
+                    dropped += 1
+            except FileNotFoundError:
+                continue
+    return dropped
+
+# ---- pulizia periodica (thread daemon avviato dal lifespan dell'app) --------
+_sweep_stop = threading.Event()
+_sweep_thread: Optional[threading.Thread] = None
+
+def _sweep_loop(interval_s: float) -> None:
+    from app.services.blob_gc import gc_user_ids  # blob_gc importa questo modulo
+    while not _sweep_stop.wait(interval_s):
+        for uid in gc_user_ids():
+            try:
+                expire_sessions(uid)
+            except Exception:  # un bucket guasto non ferma gli altri
+                continue
+
+def start_session_sweeper(interval_s: Optional[float] = None) -> bool:
+    global _sweep_thread
+    if interval_s is None:
+        interval_s = float(os.getenv("ENAC_UPLOAD_SESSION_SWEEP_S", UPLOAD_SESSION_SWEEP_S))
+    if interval_s <= 0 or (_sweep_thread is not None and _sweep_thread.is_alive()):
+        return False
+    _sweep_stop.clear()
+    _sweep_thread = threading.Thread(target=_sweep_loop, args=(interval_s,), name="upload-sweep", daemon=True)
+    _sweep_thread.start()
+    return True
+
+def stop_session_sweeper() -> None:
+    _sweep_stop.set()
+    if _sweep_thread is not None:
+        _sweep_thread.join(timeout=5)
@@ -0,0 +1,273 @@
+from __future__ import annotations
+from array import array
+from collections import Counter
+from decimal import Decimal, InvalidOperation
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from fastapi import HTTPException
+
+from app.utils.utils import views_dir_for_entity, cache_lookup, cache_store
+from app.services.indexes import load_view, view_version
+
+# =============================================================================
+# Aggregazioni group-by sulle viste (titles_index / claims_index)
+#   colonne → la vista è convertita una volta in colonne: chiavi di gruppo
+#             codificate a dizionario (array di interi + valori distinti),
+#             importi come interi scalati in array('q') (somme esatte)
+#   cache   → ogni colonna è una voce della cache di lettura (cache_store):
+#             stesso budget di byte, legata alla versione della vista
+#             (view_version: snapshot + delta), ricostruita dopo una scrittura
+#   calcolo → count con Counter sui codici di gruppo, sum/min/max in un solo
+#             passaggio sugli array; in uscita solo i gruppi (KB, non la vista)
+# =============================================================================
+AGG_FUNCS = ("count", "sum", "min", "max")
+
+class AggSpec:
+    """Vista, chiavi di raggruppamento/filtro e campi numerici aggregabili."""
+
+    def __init__(self, view: str, keys: Sequence[str], measures: Sequence[str], aliases: Dict[str, str]):
+        self.view = view
+        self.keys = tuple(keys)
+        self.measures = tuple(measures)
+        self.aliases = aliases
+
+TITLES_AGG = AggSpec("titles_index.json", ("stato", "compagnia", "rischio", "contract_id", "numero_polizza"),
+                     ("premio",), {"premio_lordo": "premio"})
+CLAIMS_AGG = AggSpec("claims_index.json", ("stato", "compagnia", "rischio", "contract_id", "esercizio", "intermediario"),
+                     ("danno_stimato", "importo_riservato", "importo_liquidato"), {})
+
+_MISSING = -(2 ** 63)  # valore assente nelle colonne di importi
+_MAX_SCALE = 6         # cifre decimali conservate per gli importi
+_RETRIES = 3
+
+def _dec(v: Any) -> Optional[Decimal]:
+    # importi salvati come stringhe ("120.50") o numeri; altro = assente
+    if v is None or isinstance(v, bool):
+        return None
+    try:
+        d = Decimal(str(v))
+    except InvalidOperation:
+        return None
+    return d if d.is_finite() else None
+
+def _key_column(name: str):
+    def build(rows: List[Dict[str, Any]]) -> tuple:
+        codes_of: Dict[Any, int] = {}
+        values: List[Any] = []
+        codes = array("l", [0]) * len(rows)
+        for i, r in enumerate(rows):
+            v = r.get(name)
+            c = codes_of.get(v)
+            if c is None:
+                c = codes_of[v] = len(values)
+                values.append(v)
+            codes[i] = c
+        return (codes, values), codes.itemsize * len(codes) + sum(64 + len(str(v)) for v in values)
+    return build
+
+def _num_column(name: str):
+    # interi scalati di 10^scale (somme esatte, niente float): "120.50" → 12050
+    def build(rows: List[Dict[str, Any]]) -> tuple:
+        decs = [_dec(r.get(name)) for r in rows]
+        scale = max([min(max(-d.as_tuple().exponent, 0), _MAX_SCALE) for d in decs if d is not None], default=0)
+        ints = []
+        for d in decs:
+            try:
+                ints.append(_MISSING if d is None else int(d.scaleb(scale).to_integral_value()))
+            except InvalidOperation:
+                ints.append(_MISSING)
+        try:
+            col: Sequence[int] = array("q", ints)
+        except OverflowError:  # importi fuori dai 64 bit: lista di int Python
+            col = ints
+        return (col, scale), (8 if isinstance(col, array) else 32) * len(ints)
+    return build
+
+def _count(rows: List[Dict[str, Any]]) -> tuple:
+    return len(rows), 8
+
+class _Stale(Exception):
+    """La vista è cambiata mentre se ne leggevano le colonne."""
+
+class _Columns:
+    """Colonne di una vista dalla cache di lettura, tutte della stessa versione."""
+
+    def __init__(self, user_id: str, entity_id: str, name: str):
+        self.user_id, self.entity_id, self.name = user_id, entity_id, name
+        self.path = str(views_dir_for_entity(user_id, entity_id) / name)
+        self.version = view_version(user_id, entity_id, name)
+
+    def _get(self, tag: str, build) -> Any:
+        key = f"{self.path}\0{tag}"
+        value = cache_lookup(key, self.version)
+        if value is None:
+            res = load_view(self.user_id, self.entity_id, self.name)
+            if res is None or res[1] != self.version:
+                raise _Stale()
+            value, size = build(res[0])
+            cache_store(key, self.version, value, size)
+        return value
+
+    @property
+    def n(self) -> int:
+        return self._get("agg:n", _count)
+
+    def key(self, name: str) -> Tuple[array, List[Any]]:
+        return self._get(f"agg:key:{name}", _key_column(name))
+
+    def num(self, name: str) -> Tuple[Sequence[int], int]:
+        return self._get(f"agg:num:{name}", _num_column(name))
+
+def parse_metrics(metrics: List[str], spec: AggSpec) -> List[Tuple[str, Optional[str]]]:
+    """["count", "sum:premio", ...] → [("count", None), ("sum", "premio"), ...]."""
+    out: List[Tuple[str, Optional[str]]] = []
+    for m in metrics or ["count"]:
+        fn, _, field = m.partition(":")
+        field = spec.aliases.get(field, field) or None
+        if fn not in AGG_FUNCS or (fn == "count") != (field is None):
+            raise HTTPException(status_code=422, detail=f"Metrica non valida: {m!r} (count, sum:campo, min:campo, max:campo).")
+        if field is not None and field not in spec.measures:
+            raise HTTPException(status_code=422, detail=f"Campi aggregabili: {', '.join(spec.measures)}")
+        if (fn, field) not in out:
+            out.append((fn, field))
+    return out
+
+def check_keys(group_by: List[str], filters: Dict[str, List[str]], spec: AggSpec, extra: Sequence[str] = ()) -> None:
+    allowed = spec.keys + tuple(extra)
+    bad = [k for k in list(group_by) + [k for k, v in filters.items() if v] if k not in allowed]
+    if bad:
+        raise HTTPException(status_code=422, detail=f"Chiavi ammesse: {', '.join(allowed)}")
+
+def _aggregate(cols: _Columns, group_by: Sequence[str], filters: Dict[str, List[str]],
+               metrics: List[Tuple[str, Optional[str]]]) -> Tuple[int, Dict[tuple, Dict[str, Any]]]:
+    """Gruppi di una vista: {tupla valori chiave: {"count", "sum_x", ...}} + righe filtrate."""
+    # filtri: confronto sui codici, non sulle stringhe delle righe
+    sel: Optional[List[int]] = None
+    for k, vals in filters.items():
+        if not vals:
+            continue
+        codes, values = cols.key(k)
+        ok = {c for c, v in enumerate(values) if v is not None and str(v) in vals}
+        idx = range(cols.n) if sel is None else sel
+        sel = [i for i in idx if codes[i] in ok]
+
+    # codice di gruppo composto: c1 * |V2| * |V3| + c2 * |V3| + c3
+    keycols = [cols.key(k) for k in group_by]
+    gcodes: Sequence[int]
+    if not keycols:
+        gcodes = array("l", [0]) * cols.n
+    elif len(keycols) == 1:
+        gcodes = keycols[0][0]
+    else:
+        gcodes = keycols[0][0]
+        for codes, values in keycols[1:]:
+            m = len(values)
+            gcodes = [a * m + b for a, b in zip(gcodes, codes)]
+    if sel is not None:
+        gcodes = [gcodes[i] for i in sel]
+    total = len(gcodes)
+
+    counts = Counter(gcodes)
+    acc: Dict[int, Dict[str, Any]] = {g: {"count": c} for g, c in counts.items()}
+    for field in dict.fromkeys(f for _, f in metrics if f):
+        fns = {fn for fn, f in metrics if f == field}
+        col, scale = cols.num(field)
+        vals = col if sel is None else [col[i] for i in sel]
+        s: Dict[int, int] = {}
+        lo: Dict[int, int] = {}
+        hi: Dict[int, int] = {}
+        for g, v in zip(gcodes, vals):
+            if v == _MISSING:
+                continue
+            if g in s:
+                s[g] += v
+                if v < lo[g]: lo[g] = v
+                if v > hi[g]: hi[g] = v
+            else:
+                s[g] = lo[g] = hi[g] = v
+        dec = lambda v: None if v is None else Decimal(v).scaleb(-scale)
+        for g, a in acc.items():
+            if "sum" in fns: a[f"sum_{field}"] = dec(s.get(g, 0))
+            if "min" in fns: a[f"min_{field}"] = dec(lo.get(g))
+            if "max" in fns: a[f"max_{field}"] = dec(hi.get(g))
+
+    # decodifica del codice composto → valori delle chiavi
+    out: Dict[tuple, Dict[str, Any]] = {}
+    for g, a in acc.items():
+        parts = []
+        for codes, values in reversed(keycols):
+            g, c = divmod(g, len(values))
+            parts.append(values[c])
+        out[tuple(reversed(parts))] = a
+    return total, out
+
+def _merge(into: Dict[tuple, Dict[str, Any]], part: Dict[tuple, Dict[str, Any]]) -> None:
+    for k, a in part.items():
+        b = into.get(k)
+        if b is None:
+            into[k] = dict(a)
+            continue
+        for name, v in a.items():
+            if v is None:
+                continue
+            w = b.get(name)
+            if w is None:
+                b[name] = v
+            elif name.startswith("min_"):
+                b[name] = min(v, w)
+            elif name.startswith("max_"):
+                b[name] = max(v, w)
+            else:
+                b[name] = v + w
+
+def _result(group_by: Sequence[str], total: int, groups: Dict[tuple, Dict[str, Any]]) -> Dict[str, Any]:
+    def order(k: tuple) -> tuple:
+        return tuple((v is None, str(v) if v is not None else "") for v in k)
+    items = []
+    for k in sorted(groups, key=order):
+        row = dict(zip(group_by, k))
+        for name, v in groups[k].items():
+            row[name] = str(v) if isinstance(v, Decimal) else v  # importi come stringhe, come nei modelli
+        items.append(row)
+    return {"group_by": list(group_by), "total": total, "groups": items}
+
+def _entity_groups(user_id: str, entity_id: str, spec: AggSpec, group_by: Sequence[str],
+                   filters: Dict[str, List[str]], metrics: List[Tuple[str, Optional[str]]]
+                   ) -> Optional[Tuple[int, Dict[tuple, Dict[str, Any]]]]:
+    if load_view(user_id, entity_id, spec.view) is None:  # crea la vista se manca
+        return None
+    for _ in range(_RETRIES):
+        try:
+            return _aggregate(_Columns(user_id, entity_id, spec.view), group_by, filters, metrics)
+        except FileNotFoundError:
+            return None
+        except _Stale:
+            continue
+    raise HTTPException(status_code=503, detail="Vista in aggiornamento, riprovare.")
+
+def aggregate_entity_view(user_id: str, entity_id: str, spec: AggSpec, group_by: List[str],
+                          filters: Dict[str, List[str]], metrics: List[Tuple[str, Optional[str]]]) -> Dict[str, Any]:
+    res = _entity_groups(user_id, entity_id, spec, group_by, filters, metrics)
+    return _result(group_by, *(res or (0, {})))
+
+def aggregate_user_views(user_id: str, entity_ids: List[str], spec: AggSpec, group_by: List[str],
+                         filters: Dict[str, List[str]], metrics: List[Tuple[str, Optional[str]]]) -> Dict[str, Any]:
+    """Come aggregate_entity_view su tutte le entità; group_by può includere entity_id."""
+    eids = set(filters.get("entity_id") or ())
+    per_entity = "entity_id" in group_by
+    keys = [k for k in group_by if k != "entity_id"]
+    flt = {k: v for k, v in filters.items() if k != "entity_id"}
+    total, merged = 0, {}
+    for eid in entity_ids:
+        if eids and eid not in eids:
+            continue
+        res = _entity_groups(user_id, eid, spec, keys, flt, metrics)
+        if res is None:
+            continue
+        n, groups = res
+        total += n
+        if per_entity:
+            i = group_by.index("entity_id")
+            groups = {k[:i] + (eid,) + k[i:]: a for k, a in groups.items()}
+        _merge(merged, groups)
+    return _result(group_by, total, merged)
@@ -0,0 +1,135 @@
+from __future__ import annotations
+import base64
+import binascii
+import json
+from bisect import bisect_right
+from functools import cmp_to_key
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from fastapi import HTTPException
+
+# =============================================================================
+# Query sulle viste per entità (titles_index / claims_index)
+#   filtri      → uguaglianza (più valori = OR) + intervallo di date ISO
+#   ordinamento → "campo,-campo" (None in coda), a parità (contract_id, id)
+#   paginazione → cursore keyset opaco = chiave di ordinamento dell'ultima riga:
+#                 stabile anche se fra una pagina e l'altra si inseriscono righe
+#   proiezione  → solo i campi richiesti, applicata alla sola pagina
+# Le righe sono quelle della vista materializzata in cache (load_view): qui non
+# si modificano mai, si costruiscono solo dict nuovi per la proiezione.
+# =============================================================================
+VIEW_QUERY_MAX_LIMIT = 1000
+
+class ViewSpec:
+    """Chiave di riga, filtri ammessi e campo data di una vista."""
+
+    def __init__(self, id_key: str, filters: Sequence[str], date_field: str):
+        self.id_key = id_key
+        self.filters = tuple(filters)
+        self.date_field = date_field
+
+TITLES_SPEC = ViewSpec("title_id", ("stato", "compagnia", "rischio", "contract_id", "numero_polizza"), "scadenza_titolo")
+CLAIMS_SPEC = ViewSpec("claim_id", ("stato", "compagnia", "rischio", "contract_id", "esercizio"), "data_accadimento")
+
+def split_csv(values: Optional[Iterable[str]]) -> List[str]:
+    """?k=a,b&k=c → [a, b, c] (accetta sia valori ripetuti che separati da virgola)."""
+    return [p.strip() for v in (values or ()) for p in v.split(",") if p.strip()]
+
+def _norm(v: Any) -> Tuple[int, Any]:
+    # numeri (anche stringhe numeriche, es. Decimal salvati come "120.50") prima
+    # del testo; confronto sempre fra tipi omogenei
+    if isinstance(v, (int, float)) and not isinstance(v, bool):
+        return (0, v)
+    if isinstance(v, str):
+        try:
+            return (0, float(v))
+        except ValueError:
+            return (1, v)
+    return (1, str(v))
+
+def _compare(a: List[Any], b: List[Any], desc: List[bool]) -> int:
+    n = len(desc)
+    for x, y, d in zip(a[:n], b[:n], desc):
+        if x == y:
+            continue
+        if x is None or y is None:  # None sempre in coda, in entrambe le direzioni
+            return 1 if x is None else -1
+        nx, ny = _norm(x), _norm(y)
+        if nx == ny:
+            continue
+        r = -1 if nx < ny else 1
+        return -r if d else r
+    # parità: (contract_id, id) come stringhe
+    ta, tb = [str(v) for v in a[n:]], [str(v) for v in b[n:]]
+    return (ta > tb) - (ta < tb)
+
+def _encode_cursor(key: List[Any]) -> str:
+    return base64.urlsafe_b64encode(json.dumps(key, separators=(",", ":"), default=str).encode()).decode().rstrip("=")
+
+def _decode_cursor(cursor: str, n: int) -> List[Any]:
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (binascii.Error, ValueError):
+        key = None
+    if not isinstance(key, list) or len(key) != n:
+        raise HTTPException(status_code=400, detail="Cursore non valido (o ordinamento cambiato).")
+    return key
+
+def query_view(rows: List[Dict[str, Any]], spec: ViewSpec, filters: Dict[str, List[str]],
+               date_from: Optional[str] = None, date_to: Optional[str] = None,
+               sort: Sequence[str] = (), fields: Sequence[str] = (),
+               limit: Optional[int] = None, cursor: Optional[str] = None) -> Dict[str, Any]:
+    """Ritorna {"items", "total" (righe filtrate), "next_cursor"}."""
+    wanted = {k: set(v) for k, v in filters.items() if v}
+    if set(wanted) - set(spec.filters):
+        raise HTTPException(status_code=422, detail=f"Filtri ammessi: {', '.join(spec.filters)}")
+    df = spec.date_field
+
+    def match(r: Dict[str, Any]) -> bool:
+        for k, vals in wanted.items():
+            v = r.get(k)
+            if v is None or str(v) not in vals:
+                return False
+        if date_from or date_to:
+            d = r.get(df)
+            if not d:
+                return False
+            d = str(d)[:10]
+            if (date_from and d < date_from) or (date_to and d > date_to):
+                return False
+        return True
+
+    hits = [r for r in rows if match(r)] if (wanted or date_from or date_to) else list(rows)
+
+    sort_keys = [s[1:] if s.startswith("-") else s for s in sort]
+    desc = [s.startswith("-") for s in sort]
+    key_of = lambda r: [r.get(k) for k in sort_keys] + [r.get("contract_id"), r.get(spec.id_key)]
+    cmp = lambda a, b: _compare(a, b, desc)
+    if sort_keys or limit is not None or cursor:
+        # sort stabili a più passate con chiavi native (dall'ultima chiave alla
+        # prima): stesso ordine di _compare senza chiamate Python per confronto
+        hits.sort(key=lambda r: (str(r.get("contract_id")), str(r.get(spec.id_key))))
+        memo: Dict[Any, Tuple[int, Any]] = {}  # pochi valori distinti (stati, date, importi)
+        for k, d in reversed(list(zip(sort_keys, desc))):
+            def skey(r: Dict[str, Any], k: str = k, d: bool = d) -> tuple:
+                v = r.get(k)
+                if v is None:
+                    return (not d, (0, 0))
+                nv = memo.get(v) if type(v) in (str, int, float) else None
+                if nv is None:
+                    nv = _norm(v)
+                    if type(v) in (str, int, float):
+                        memo[v] = nv
+                return (d, nv)
+            hits.sort(key=skey, reverse=d)
+
+    start = 0
+    if cursor:
+        after = cmp_to_key(cmp)(_decode_cursor(cursor, len(sort_keys) + 2))
+        start = bisect_right(hits, after, key=lambda r: cmp_to_key(cmp)(key_of(r)))
+    end = len(hits) if limit is None else start + limit
+    page = hits[start:end]
+    next_cursor = _encode_cursor(key_of(page[-1])) if page and end < len(hits) else None
+    if fields:
+        page = [{k: r.get(k) for k in fields} for r in page]
+    return {"items": page, "total": len(hits), "next_cursor": next_cursor}
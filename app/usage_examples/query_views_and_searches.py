@@ -82,13 +82,20 @@ def main():
         if args.strict_checks:
             assert_equal(len(titles), expected_titles, f"Mismatch count titoli per {entity_id}")
 
-        # breakdown per stato / compagnia / rischio
-        stato_ctr = Counter(t.get("stato") for t in titles)
-        comp_ctr = Counter(t.get("compagnia") for t in titles)
-        rischio_ctr = Counter(t.get("rischio") for t in titles)
+        # breakdown per stato / compagnia / rischio (aggregazione lato server)
+        def agg(kind, key, **extra):
+            r = api(base_url, "GET", f"/users/{user_id}/entities/{entity_id}/{kind}/aggregate", params={"group_by": key, **extra})
+            return {g[key]: g for g in r.json()["groups"]}
+        stato_agg = agg("titles", "stato", metrics="count,sum:premio")
+        stato_ctr = Counter({k: g["count"] for k, g in stato_agg.items()})
+        comp_ctr = Counter({k: g["count"] for k, g in agg("titles", "compagnia").items()})
+        rischio_ctr = Counter({k: g["count"] for k, g in agg("titles", "rischio").items()})
         print("Per STATO:", stato_ctr)
+        print("Premi per STATO:", {k: g["sum_premio"] for k, g in stato_agg.items()})
         print("Per COMPAGNIA:", comp_ctr)
         print("Per RISCHIO:", rischio_ctr)
+        if args.strict_checks:
+            assert_equal(stato_ctr, Counter(t.get("stato") for t in titles), f"Aggregazione per stato {entity_id}")
 
         # Controllo copertura ID (tutti i title_id del manifest devono essere presenti nella vista)
         view_title_ids = {t["title_id"] for t in titles}
@@ -100,6 +107,13 @@ def main():
         if titles:
             print("Esempio record titolo:", pretty(titles[0]))
 
+        # stessa vista filtrata/ordinata/paginata lato server (header X-Total-Count / X-Next-Cursor)
+        params = {"stato": "DA_PAGARE", "sort": "scadenza_titolo", "fields": "title_id,scadenza_titolo,premio", "limit": 20}
+        r = api(base_url, "GET", f"/users/{user_id}/entities/{entity_id}/titles", params=params)
+        print(f"Titoli DA_PAGARE (server-side): {r.headers.get('X-Total-Count')} — prima pagina {len(r.json())}")
+        if args.strict_checks:
+            assert_equal(int(r.headers["X-Total-Count"]), stato_ctr.get("DA_PAGARE", 0), f"Filtro stato per {entity_id}")
+
         banner(f"VISTA SINISTRI — Entity {entity_id}")
         r = api(base_url, "GET", f"/users/{user_id}/entities/{entity_id}/claims")
         claims = r.json()
@@ -110,7 +124,7 @@ def main():
             assert_equal(len(claims), expected_claims, f"Mismatch count sinistri per {entity_id}")
 
         # breakdown per esercizio / stato compagnia
-        esercizio_ctr = Counter(c.get("esercizio") for c in claims)
+        esercizio_ctr = Counter({k: g["count"] for k, g in agg("claims", "esercizio").items()})
         stato_comp_ctr = Counter(c.get("stato_compagnia") for c in claims)
         print("Per ESERCIZIO:", esercizio_ctr)
         print("Per STATO_COMPAGNIA:", stato_comp_ctr)
@@ -57,8 +57,9 @@ def create_contract(base_url, user_id, entity_id, compagnia, numero_polizza, ris
     r = api(base_url, "POST", f"/users/{user_id}/entities/{entity_id}/contracts", json_body=payload)
     return r.json()["contract_id"]
 
-def create_title(base_url, user_id, entity_id, contract_id, tipo, effetto, scadenza, stato="DA_PAGARE"):
-    payload = {
+def create_titles_batch(base_url, user_id, entity_id, contract_id, specs):
+    """specs: [(tipo, effetto, scadenza), ...] → title_id nello stesso ordine (una sola richiesta)."""
+    payload = [{
         "tipo": tipo,
         "effetto_titolo": effetto.isoformat(),
         "scadenza_titolo": scadenza.isoformat(),
@@ -66,12 +67,13 @@ def create_title(base_url, user_id, entity_id, contract_id, tipo, effetto, scade
         "imponibile": "820.00",
         "imposte": "180.00",
         "frazionamento": "SEMESTRALE",
-        "stato": stato,
+        "stato": "DA_PAGARE",
         "pv": "PV-001",
         "pv2": "PV-002",
-    }
-    r = api(base_url, "POST", f"/users/{user_id}/entities/{entity_id}/contracts/{contract_id}/titles", json_body=payload)
-    return r.json()["title_id"]
+    } for tipo, effetto, scadenza in specs]
+    r = api(base_url, "POST", f"/users/{user_id}/entities/{entity_id}/contracts/{contract_id}/titles/batch",
+            json_body=payload, params={"all_or_nothing": True})
+    return [it["id"] for it in r.json()["items"]]
 
 def create_claim(base_url, user_id, entity_id, contract_id, esercizio, num):
     payload = {
@@ -163,10 +165,9 @@ def main():
             c_block = {"contract_id": contract_id, "numero_polizza": pol, "titles": [], "claims": [], "contract_docs": []}
 
             # Titoli
-            for t_idx in range(args.titles):
-                tipo = random.choice(["RATA", "QUIETANZA", "APPENDICE", "VARIAZIONE"])
-                scad = IN_3M if t_idx % 2 == 0 else IN_6M
-                title_id = create_title(base_url, user_id, entity_id, contract_id, tipo, TODAY, scad)
+            specs = [(random.choice(["RATA", "QUIETANZA", "APPENDICE", "VARIAZIONE"]), TODAY,
+                      IN_3M if t_idx % 2 == 0 else IN_6M) for t_idx in range(args.titles)]
+            for title_id in create_titles_batch(base_url, user_id, entity_id, contract_id, specs):
                 t_block = {"title_id": title_id, "title_docs": []}
                 # doc su titolo
                 doc_id = create_title_doc(base_url, user_id, entity_id, contract_id, title_id, f"title content {title_id}")
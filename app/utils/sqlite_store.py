@@ -0,0 +1,274 @@
+# app/utils/sqlite_store.py
+"""
+Backend SQLite per i documenti JSON (STORAGE_BACKEND = "sqlite").
+
+Mantiene la STESSA gerarchia logica dell'albero su filesystem: ogni file
+<bucket>/entities/<entity_id>/.../<name>.json è una riga di `nodes` con
+chiave = path relativo a ROOT_DATA_DIR (separatore '/'); le cartelle sono
+righe di `dirs` (create per tutti gli antenati in scrittura, come mkdir -p).
+
+Colonne indicizzate estratte in scrittura (kind, entity_id, contract_id,
+owner_id, scadenza, stato, hash), lette da select()/hash_counts() per il
+rebuild delle viste, la dashboard scadenze, i documenti per owner e il
+refcount dei blob.
+I blob restano su filesystem.
+"""
+from __future__ import annotations
+
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS nodes (
+    path        TEXT PRIMARY KEY,
+    parent      TEXT NOT NULL,
+    name        TEXT NOT NULL,
+    body        BLOB NOT NULL,
+    kind        TEXT,
+    bucket      TEXT,
+    entity_id   TEXT,
+    contract_id TEXT,
+    owner_id    TEXT,
+    scadenza    TEXT,
+    stato       TEXT,
+    hash        TEXT,
+    updated_at  REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS nodes_parent   ON nodes(parent);
+CREATE INDEX IF NOT EXISTS nodes_due      ON nodes(bucket, kind, scadenza);
+CREATE INDEX IF NOT EXISTS nodes_entity   ON nodes(bucket, entity_id, kind);
+CREATE INDEX IF NOT EXISTS nodes_owner    ON nodes(contract_id, kind, owner_id);
+CREATE INDEX IF NOT EXISTS nodes_hash     ON nodes(bucket, hash);
+CREATE TABLE IF NOT EXISTS dirs (
+    path   TEXT PRIMARY KEY,
+    parent TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS dirs_parent ON dirs(parent);
+"""
+
+# WRITE_DURABILITY → PRAGMA synchronous
+_SYNCHRONOUS = {"none": "OFF", "file": "NORMAL", "file+dir": "FULL"}
+
+
+def _parent(key: str) -> str:
+    return key.rpartition("/")[0]
+
+
+def _prefix_range(key: str) -> Tuple[str, str]:
+    # tutti i path sotto "<key>/": '/' + 1 == '0' ("" = radice, tutto il DB)
+    if not key:
+        return "", "\U0010ffff"
+    return key + "/", key + "0"
+
+
+def _glob_regex(pattern: str) -> "re.Pattern[str]":
+    """Glob relativo → regex ('**/' = zero o più cartelle, '*' = un segmento)."""
+    out, i = [], 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            out.append(r"(?:[^/]+/)*"); i += 3
+        elif pattern[i] == "*":
+            out.append(r"[^/]*"); i += 1
+        else:
+            out.append(re.escape(pattern[i])); i += 1
+    return re.compile("".join(out) + r"\Z")
+
+
+def _s(v: Any) -> Optional[str]:
+    return None if v in (None, "") else str(v)
+
+
+def extract_columns(key: str, obj: Any) -> Dict[str, Optional[str]]:
+    """Deduce tipo e campi indicizzati dal path logico e dal contenuto."""
+    segs = key.split("/")
+    name = segs[-1]
+    cols: Dict[str, Optional[str]] = {
+        "kind": None, "bucket": segs[0], "entity_id": None, "contract_id": None,
+        "owner_id": None, "scadenza": None, "stato": None, "hash": None,
+    }
+    if len(segs) > 2 and segs[1] == "entities":
+        cols["entity_id"] = segs[2]
+    if len(segs) > 4 and segs[3] == "contracts":
+        cols["contract_id"] = segs[4]
+    parent = segs[-2] if len(segs) > 1 else ""
+    d = obj if isinstance(obj, dict) else {}
+
+    if name == "entity.json" and len(segs) == 4:
+        cols["kind"] = "entity"
+    elif name == "contract.json":
+        cols["kind"] = "contract"
+        cols["scadenza"] = _s((d.get("Amministrativi") or {}).get("Scadenza"))
+    elif parent == "documents":
+        cols["kind"] = "document"
+        cols["hash"] = _s(d.get("hash"))
+        legacy_claim = segs[-3] if len(segs) > 3 and segs[-4] == "claims" else None
+        cols["owner_id"] = _s(d.get("claim_id") or d.get("title_id") or legacy_claim)
+    elif parent == "titles":
+        cols["kind"] = "title"
+        cols["scadenza"] = _s(d.get("scadenza_titolo"))
+        cols["stato"] = _s(d.get("stato"))
+        cols["owner_id"] = name[:-5]
+    elif name == "claim.json":
+        cols["kind"] = "claim"
+        cols["stato"] = _s(d.get("stato"))
+        cols["owner_id"] = parent
+    elif parent == "diary":
+        cols["kind"] = "diary"
+        cols["owner_id"] = segs[-3]
+    elif parent == "views":
+        cols["kind"] = "view"
+    elif len(segs) > 1 and segs[1] == "indexes":
+        cols["kind"] = "index"
+    return cols
+
+
+class SqliteStore:
+    """Store chiave→JSON con una connessione per thread (WAL)."""
+
+    def __init__(self, db_path: Path, durability: str = "none"):
+        self.db_path = Path(db_path)
+        self.synchronous = _SYNCHRONOUS.get(durability, "NORMAL")
+        self._local = threading.local()
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._conn() as conn:
+            conn.executescript(_SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.db_path), timeout=30.0, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"PRAGMA synchronous={self.synchronous}")
+            self._local.conn = conn
+        return conn
+
+    # ---- letture -------------------------------------------------------------
+    def read(self, key: str) -> bytes:
+        row = self._conn().execute("SELECT body FROM nodes WHERE path = ?", (key,)).fetchone()
+        if row is None:
+            raise FileNotFoundError(key)
+        return row[0]
+
+    def version(self, key: str) -> Tuple[Any, ...]:
+        """Identità della riga corrente (cambia a ogni scrittura, come mtime/inode su fs)."""
+        row = self._conn().execute(
+            "SELECT updated_at, length(body), rowid FROM nodes WHERE path = ?", (key,)).fetchone()
+        if row is None:
+            raise FileNotFoundError(key)
+        return tuple(row)
+
+    def exists(self, key: str) -> bool:
+        conn = self._conn()
+        if conn.execute("SELECT 1 FROM nodes WHERE path = ?", (key,)).fetchone():
+            return True
+        return conn.execute("SELECT 1 FROM dirs WHERE path = ?", (key,)).fetchone() is not None
+
+    def list_dirs(self, key: str) -> List[str]:
+        rows = self._conn().execute("SELECT path FROM dirs WHERE parent = ?", (key,))
+        return [r[0].rpartition("/")[2] for r in rows]
+
+    def list_files(self, key: str) -> List[str]:
+        rows = self._conn().execute("SELECT name FROM nodes WHERE parent = ?", (key,))
+        return [r[0] for r in rows]
+
+    def glob(self, key: str, pattern: str) -> List[str]:
+        lo, hi = _prefix_range(key)
+        rx = _glob_regex(pattern)
+        n = len(lo)
+        rows = self._conn().execute("SELECT path FROM nodes WHERE path >= ? AND path < ?", (lo, hi))
+        return [r[0] for r in rows if rx.match(r[0][n:])]
+
+    # ---- colonne indicizzate -----------------------------------------------
+    def select(self, bucket: str, kind: str, entity_id: Optional[str] = None, contract_id: Optional[str] = None,
+               owner_id: Optional[str] = None, scadenza: Optional[Tuple[str, str]] = None
+               ) -> Iterator[Tuple[str, Optional[str], Optional[str], Optional[str], bytes]]:
+        """
+        Nodi di un tipo per colonne indicizzate (scadenza = intervallo inclusivo,
+        in ordine di scadenza): yield (path, entity_id, contract_id, owner_id, body).
+        """
+        where, params = ["bucket = ?", "kind = ?"], [bucket, kind]
+        for col, v in (("entity_id", entity_id), ("contract_id", contract_id), ("owner_id", owner_id)):
+            if v is not None:
+                where.append(f"{col} = ?")
+                params.append(v)
+        order = ""
+        if scadenza is not None:
+            where.append("scadenza BETWEEN ? AND ?")
+            params.extend(scadenza)
+            order = " ORDER BY scadenza, path"
+        yield from self._conn().execute(
+            "SELECT path, entity_id, contract_id, owner_id, body FROM nodes WHERE "
+            + " AND ".join(where) + order, params)
+
+    def hash_counts(self, bucket: str) -> Dict[str, int]:
+        """hash → numero di metadati documento che lo referenziano."""
+        rows = self._conn().execute(
+            "SELECT hash, count(*) FROM nodes WHERE bucket = ? AND kind = 'document' AND hash IS NOT NULL"
+            " GROUP BY hash", (bucket,))
+        return dict(rows)
+
+    # ---- scritture -----------------------------------------------------------
+    def _mkdirs(self, conn: sqlite3.Connection, key: str) -> None:
+        while key:
+            parent = _parent(key)
+            conn.execute("INSERT OR IGNORE INTO dirs(path, parent) VALUES (?, ?)", (key, parent))
+            key = parent
+
+    def _insert(self, conn: sqlite3.Connection, key: str, body: bytes, obj: Any) -> None:
+        cols = extract_columns(key, obj)
+        self._mkdirs(conn, _parent(key))
+        conn.execute(
+            "INSERT OR REPLACE INTO nodes(path, parent, name, body, kind, bucket, entity_id, contract_id,"
+            " owner_id, scadenza, stato, hash, updated_at)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (key, _parent(key), key.rpartition("/")[2], body, cols["kind"], cols["bucket"],
+             cols["entity_id"], cols["contract_id"], cols["owner_id"], cols["scadenza"],
+             cols["stato"], cols["hash"], time.time()),
+        )
+
+    def write(self, key: str, body: bytes, obj: Any) -> None:
+        conn = self._conn()
+        with conn:
+            self._insert(conn, key, body, obj)
+
+    def write_many(self, items: Iterable[Tuple[str, bytes, Any]]) -> None:
+        """Più documenti in una sola transazione (import massivi)."""
+        conn = self._conn()
+        with conn:
+            for key, body, obj in items:
+                self._insert(conn, key, body, obj)
+
+    def apply(self, writes: Iterable[Tuple[str, bytes, Any]], deletes: Iterable[str]) -> None:
+        """Scritture + eliminazioni in una sola transazione (batch di operazioni)."""
+        conn = self._conn()
+        with conn:
+            for key, body, obj in writes:
+                self._insert(conn, key, body, obj)
+            for key in deletes:
+                conn.execute("DELETE FROM nodes WHERE path = ?", (key,))
+
+    def mkdirs(self, key: str) -> None:
+        conn = self._conn()
+        with conn:
+            self._mkdirs(conn, key)
+
+    def remove(self, key: str) -> None:
+        conn = self._conn()
+        with conn:
+            cur = conn.execute("DELETE FROM nodes WHERE path = ?", (key,))
+        if cur.rowcount == 0:
+            raise FileNotFoundError(key)
+
+    def remove_tree(self, key: str) -> None:
+        lo, hi = _prefix_range(key)
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM nodes WHERE path >= ? AND path < ?", (lo, hi))
+            conn.execute("DELETE FROM dirs WHERE path = ? OR (path >= ? AND path < ?)", (key, lo, hi))
+
+    def iter_all(self) -> Iterator[Tuple[str, bytes]]:
+        yield from self._conn().execute("SELECT path, body FROM nodes ORDER BY path")
@@ -4,16 +4,44 @@ from __future__ import annotations
 import os
 import json
 import re
+import shutil
 import hashlib
+import struct
 import tempfile
+import threading
+import time
+import uuid
+import weakref
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
 from pathlib import Path
-from typing import Any
+from typing import Any, Collection, Dict, Iterator, List, NamedTuple, Optional, Union
+try:
+    import fcntl  # lock del server in esecuzione (POSIX)
+except ImportError:  # Windows: nessun controllo sui comandi offline
+    fcntl = None
 from fastapi import HTTPException
+from fastapi.responses import FileResponse, Response
+from pydantic import ValidationError
 
 # =============================================================================
 # Config & modalità storage
 # =============================================================================
 from app.config import ALLOWED_ID_PATTERN, ROOT_DATA_DIR  # sempre richiesti
+from app.config import READ_CACHE_MAX_ENTRIES, READ_CACHE_MAX_BYTES
+from app.config import WRITE_DURABILITY, GROUP_COMMIT_WINDOW_MS
+from app.config import JSON_CODEC, JSON_FAST
+from app.config import STORAGE_BACKEND, SQLITE_PATH
+from app.config import RAW_JSON_RESPONSES
+from app.config import BLOB_COMPRESS_MIME, BLOB_COMPRESS_MIN_SIZE, BLOB_COMPRESS_LEVEL, BLOB_COMPRESS_MAX_RATIO
+from app.config import BLOB_PACK_MODE, BLOB_PACK_MAX_SIZE, BLOB_PACK_TARGET_SIZE
+
+try:  # encoder/decoder veloce opzionale
+    import orjson  # type: ignore
+except ImportError:  # pragma: no cover
+    orjson = None
 
 # Flag di modalità: prende da app.config.STORAGE_MODE se esiste,
 # altrimenti da env ENAC_STORAGE_MODE; default = "isolated".
@@ -33,6 +61,7 @@ _SHARED_BUCKET_NAME = "_shared"  # nome cartella usata in modalità condivisa
 # =============================================================================
 _ALLOWED_ID = re.compile(ALLOWED_ID_PATTERN)
 
+@lru_cache(maxsize=65536)
 def sanitize_id(raw: str, what: str) -> str:
     s = raw.strip().replace(" ", "_")
     if not _ALLOWED_ID.match(s):
@@ -46,20 +75,244 @@ def ensure_dir(p: Path) -> Path:
     p.mkdir(parents=True, exist_ok=True)
     return p
 
-def atomic_write_json(path: Path, obj: Any) -> None:
+# =============================================================================
+# Codec JSON su disco
+#   Ogni codec produce bytes UTF-8 e legge qualsiasi JSON valido: cambiare
+#   codec non richiede migrazioni (vedi `python -m app.manage compact-json`
+#   per riscrivere un albero esistente nel formato corrente).
+# =============================================================================
+class JsonCodec:
+    """Codec stdlib: `indent=None` → compatto con separatori minimi."""
+
+    def __init__(self, name: str, indent: Optional[int]):
+        self.name = name
+        self.indent = indent
+        self.separators = (",", ": ") if indent else (",", ":")
+
+    def dumps(self, obj: Any) -> bytes:
+        return json.dumps(obj, indent=self.indent, separators=self.separators,
+                          ensure_ascii=False, default=str).encode("utf-8")
+
+    def loads(self, data: bytes) -> Any:
+        return json.loads(data)
+
+class OrjsonCodec(JsonCodec):
+    """Stesso formato logico del codec stdlib (date/Decimal via str), ma in C."""
+
+    def __init__(self, name: str, indent: Optional[int]):
+        super().__init__(name, indent)
+        self.option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if indent:
+            self.option |= orjson.OPT_INDENT_2
+
+    def dumps(self, obj: Any) -> bytes:
+        return orjson.dumps(obj, default=str, option=self.option)
+
+    def loads(self, data: bytes) -> Any:
+        return orjson.loads(data)
+
+_CODEC_INDENT = {"compact": None, "pretty": 2}
+
+def get_codec(name: Optional[str] = None, fast: bool = JSON_FAST) -> JsonCodec:
+    name = (name or os.getenv("ENAC_JSON_CODEC") or JSON_CODEC).strip().lower()
+    if name not in _CODEC_INDENT:
+        raise ValueError(f"Codec JSON non valido {name!r}: usare {', '.join(_CODEC_INDENT)}")
+    cls = OrjsonCodec if fast and orjson is not None else JsonCodec
+    return cls(name, _CODEC_INDENT[name])
+
+_codec = get_codec()
+
+def json_codec() -> JsonCodec:
+    return _codec
+
+# =============================================================================
+# Durabilità: "none" | "file" | "file+dir" (+ group commit opzionale)
+# =============================================================================
+DURABILITY_MODES = ("none", "file", "file+dir")
+
+def _parse_durability(raw: str) -> str:
+    mode = (raw or "none").strip().lower()
+    if mode not in DURABILITY_MODES:
+        raise ValueError(f"Durabilità non valida {raw!r}: usare {', '.join(DURABILITY_MODES)}")
+    return mode
+
+_DURABILITY = _parse_durability(os.getenv("ENAC_WRITE_DURABILITY") or WRITE_DURABILITY)
+_GROUP_COMMIT_S = float(os.getenv("ENAC_GROUP_COMMIT_MS") or GROUP_COMMIT_WINDOW_MS) / 1000.0
+_durability_local = threading.local()
+
+@contextmanager
+def write_durability(mode: str):
+    """Override per-thread della durabilità (es. ingest massivo con "none")."""
+    prev = getattr(_durability_local, "mode", None)
+    _durability_local.mode = _parse_durability(mode)
+    try:
+        yield
+    finally:
+        _durability_local.mode = prev
+
+def current_durability() -> str:
+    return getattr(_durability_local, "mode", None) or _DURABILITY
+
+def fsync_dir(d: Path) -> None:
+    # su Windows le cartelle non si aprono con os.open: in quel caso si salta
+    try:
+        dfd = os.open(str(d), os.O_RDONLY | getattr(os, "O_DIRECTORY", 0))
+    except OSError:
+        return
+    try:
+        os.fsync(dfd)
+    finally:
+        os.close(dfd)
+
+class _GroupCommit:
+    """
+    Group commit "a leader": il primo writer di un batch attende la finestra,
+    poi esegue per tutti fsync(file) → os.replace → fsync(cartelle, una volta
+    per cartella). Gli altri writer attendono l'esito del proprio batch.
+    """
+
+    def __init__(self, window_s: float):
+        self.window_s = window_s
+        self._lock = threading.Lock()
+        self._batch: Optional[Dict[str, Any]] = None
+
+    def commit(self, tmp_path: str, path: Path, mode: str) -> None:
+        item = {"tmp": tmp_path, "path": path, "mode": mode, "error": None}
+        with self._lock:
+            batch = self._batch
+            leader = batch is None
+            if leader:
+                batch = self._batch = {"items": [], "done": threading.Event()}
+            batch["items"].append(item)
+        if leader:
+            time.sleep(self.window_s)
+            with self._lock:
+                self._batch = None
+            self._flush(batch["items"])
+            batch["done"].set()
+        else:
+            batch["done"].wait()
+        if item["error"] is not None:
+            raise item["error"]
+
+    @staticmethod
+    def _flush(items: list) -> None:
+        dirs: Dict[str, Path] = {}
+        for it in items:
+            try:
+                fd = os.open(it["tmp"], os.O_RDWR)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                os.replace(it["tmp"], it["path"])
+                _cache_invalidate(it["path"])
+                if it["mode"] == "file+dir":
+                    dirs[str(it["path"].parent)] = it["path"].parent
+            except Exception as e:
+                it["error"] = e
+        for d in dirs.values():
+            fsync_dir(d)
+
+_group_commit = _GroupCommit(_GROUP_COMMIT_S) if _GROUP_COMMIT_S > 0 else None
+
+# =============================================================================
+# Backend documenti: "fs" (albero di file) | "sqlite" (app/utils/sqlite_store.py)
+#   Router e servizi passano SEMPRE dalle funzioni qui sotto (mai Path.exists,
+#   unlink, iterdir, glob o shutil.rmtree diretti sui JSON), così funzionano
+#   invariati su entrambi i backend. I blob restano comunque su filesystem.
+# =============================================================================
+_BACKEND = (os.getenv("ENAC_STORAGE_BACKEND") or STORAGE_BACKEND).strip().lower()
+if _BACKEND not in ("fs", "sqlite"):
+    raise ValueError(f"STORAGE_BACKEND non valido {_BACKEND!r}: usare 'fs' o 'sqlite'")
+_store = None
+if _BACKEND == "sqlite":
+    from app.utils.sqlite_store import SqliteStore
+    _store = SqliteStore(Path(os.getenv("ENAC_SQLITE_PATH") or SQLITE_PATH), _DURABILITY)
+
+def storage_backend() -> str:
+    return _BACKEND
+
+def sqlite_store():
+    """Store SQLite attivo (None col backend "fs")."""
+    return _store
+
+def _key(p: Path) -> str:
+    k = Path(p).relative_to(ROOT_DATA_DIR).as_posix()
+    return "" if k == "." else k
+
+def path_exists(p: Path) -> bool:
+    """File o cartella esistente."""
+    return _store.exists(_key(p)) if _store else p.exists()
+
+def list_dirs(p: Path) -> List[str]:
+    """Nomi delle sottocartelle ([] se la cartella non esiste)."""
+    if _store:
+        return _store.list_dirs(_key(p))
+    return [c.name for c in p.iterdir() if c.is_dir()] if p.exists() else []
+
+def list_json(p: Path) -> List[str]:
+    """Stem dei file .json direttamente in `p` ([] se la cartella non esiste)."""
+    if _store:
+        return [n[:-5] for n in _store.list_files(_key(p)) if n.endswith(".json")]
+    return [c.stem for c in p.glob("*.json")]
+
+def glob_json(root: Path, pattern: str) -> List[Path]:
+    """Glob relativo a `root` (supporta '*' e '**/'), solo file JSON."""
+    if _store:
+        return [Path(ROOT_DATA_DIR) / k for k in _store.glob(_key(root), pattern)]
+    return [c for c in root.glob(pattern) if c.is_file()]
+
+def remove_file(p: Path) -> None:
+    if _store:
+        _store.remove(_key(p))
+    else:
+        p.unlink()
+    _cache_invalidate(p)
+
+def remove_tree(p: Path) -> None:
+    if _store:
+        _store.remove_tree(_key(p))
+    else:
+        shutil.rmtree(p)
+
+def read_json_bytes(p: Path) -> bytes:
+    """Bytes così come salvati (codec corrente)."""
+    return _store.read(_key(p)) if _store else p.read_bytes()
+
+def atomic_write_json(path: Path, obj: Any, durability: Optional[str] = None,
+                      codec: Optional[JsonCodec] = None) -> None:
     """
     Scrittura JSON atomica robusta:
     - garantisce l'esistenza della cartella del file finale
     - crea il tmp nella STESSA directory (ok anche su Windows)
     - sostituzione atomica con os.replace
+    - durabilità configurabile (WRITE_DURABILITY o parametro `durability`);
+      con group commit attivo le fsync vengono raggruppate fra richieste
+    - serializzazione col codec corrente (JSON_CODEC) salvo `codec` esplicito
     """
+    data = (codec or _codec).dumps(obj)
+    if _store:
+        _store.write(_key(path), data, obj)  # una transazione SQLite = scrittura atomica
+        return
+    mode = _parse_durability(durability) if durability else current_durability()
     parent = path.parent
     parent.mkdir(parents=True, exist_ok=True)
     fd, tmp_path = tempfile.mkstemp(dir=str(parent), suffix=".tmp")
     try:
-        with os.fdopen(fd, "w", encoding="utf-8") as fp:
-            json.dump(obj, fp, indent=2, ensure_ascii=False, default=str)
+        with os.fdopen(fd, "wb") as fp:
+            fp.write(data)
+            if mode != "none" and _group_commit is None:
+                fp.flush()
+                os.fsync(fp.fileno())
+        if mode != "none" and _group_commit is not None:
+            # fsync + replace (+ fsync cartella) eseguiti dal leader del batch
+            _group_commit.commit(tmp_path, path, mode)
+            return
         os.replace(tmp_path, path)
+        _cache_invalidate(path)
+        if mode == "file+dir":
+            fsync_dir(parent)
     except Exception:
         try:
             os.unlink(tmp_path)
@@ -67,8 +320,303 @@ def atomic_write_json(path: Path, obj: Any) -> None:
             pass
         raise
 
-def read_json(path: Path) -> Any:
-    return json.loads(path.read_text("utf-8"))
+def atomic_write_json_many(items: List[tuple[Path, Any]], durability: Optional[str] = None) -> None:
+    """
+    Come atomic_write_json per un lotto di file (import massivi): col backend
+    sqlite una sola transazione; su filesystem tutti i temporanei, poi fsync +
+    os.replace + fsync delle cartelle (una per cartella) come nel group commit.
+    """
+    encoded = [(path, obj, _codec.dumps(obj)) for path, obj in items]
+    if _store:
+        _store.write_many((_key(path), data, obj) for path, obj, data in encoded)
+        return
+    mode = _parse_durability(durability) if durability else current_durability()
+    pending: List[Dict[str, Any]] = []
+    try:
+        for path, _, data in encoded:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=str(path.parent), suffix=".tmp")
+            pending.append({"tmp": tmp_path, "path": path, "mode": mode, "error": None})
+            with os.fdopen(fd, "wb") as fp:
+                fp.write(data)
+        if mode == "none":
+            for it in pending:
+                os.replace(it["tmp"], it["path"])
+                _cache_invalidate(it["path"])
+                it["tmp"] = None
+        else:
+            _GroupCommit._flush(pending)
+            failed = [it["error"] for it in pending if it["error"] is not None]
+            if failed:
+                raise failed[0]
+    except Exception:
+        for it in pending:
+            if it["tmp"]:
+                try:
+                    os.unlink(it["tmp"])
+                except Exception:
+                    pass
+        raise
+
+# =============================================================================
+# Transazioni JSON multi-file (POST .../batch): tutto o niente
+#   sqlite → una sola transazione SQLite
+#   fs     → <entità>/.txn/<txid>/: prima i file in staging (stesso filesystem),
+#            poi manifest.json (= punto di commit), poi os.replace nelle
+#            posizioni finali e rimozione della cartella. Un crash prima del
+#            manifest lascia solo staging da buttare; dopo, recover_json_txns()
+#            completa il batch (roll-forward, idempotente).
+# =============================================================================
+_TXN_MANIFEST = "manifest.json"
+
+def txn_dir(user_id: str, entity_id: str) -> Path:
+    return entity_dir(user_id, entity_id) / ".txn"
+
+def _txn_apply(tdir: Path, manifest: Dict[str, Any], mode: str) -> None:
+    dirs: Dict[str, Path] = {}
+    for name, key in manifest["writes"]:
+        dst = Path(ROOT_DATA_DIR) / key
+        src = tdir / name
+        if src.exists():  # assente = già spostato prima di un'interruzione
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(src, dst)
+        _cache_invalidate(dst)
+        dirs[str(dst.parent)] = dst.parent
+    for key in manifest["deletes"]:
+        dst = Path(ROOT_DATA_DIR) / key
+        try:
+            dst.unlink()
+        except FileNotFoundError:
+            pass
+        _cache_invalidate(dst)
+        dirs[str(dst.parent)] = dst.parent
+    if mode == "file+dir":
+        for d in dirs.values():
+            fsync_dir(d)
+    shutil.rmtree(tdir, ignore_errors=True)
+
+def commit_json_txn(user_id: str, entity_id: str, writes: List[tuple[Path, Any]],
+                    deletes: List[Path], durability: Optional[str] = None) -> None:
+    """
+    Applica tutte le scritture e le eliminazioni o nessuna. Un path compare al
+    più una volta (in `writes` o in `deletes`); il chiamante tiene il lock
+    dell'entità, che serializza anche il recupero.
+    """
+    encoded = [(path, obj, _codec.dumps(obj)) for path, obj in writes]
+    if _store:
+        _store.apply(((_key(p), data, obj) for p, obj, data in encoded), [_key(p) for p in deletes])
+        return
+    mode = _parse_durability(durability) if durability else current_durability()
+    tdir = ensure_dir(txn_dir(user_id, entity_id) / uuid.uuid4().hex)
+    manifest: Dict[str, Any] = {"writes": [], "deletes": [_key(p) for p in deletes]}
+    try:
+        for i, (path, _, data) in enumerate(encoded):
+            name = f"{i:05d}.staged"
+            with open(tdir / name, "wb") as fp:
+                fp.write(data)
+                if mode != "none":
+                    fp.flush()
+                    os.fsync(fp.fileno())
+            manifest["writes"].append([name, _key(path)])
+        # punto di commit: il manifest compare atomicamente (tmp + replace)
+        tmp = tdir / (_TXN_MANIFEST + ".tmp")
+        with open(tmp, "wb") as fp:
+            fp.write(_codec.dumps(manifest))
+            if mode != "none":
+                fp.flush()
+                os.fsync(fp.fileno())
+        os.replace(tmp, tdir / _TXN_MANIFEST)
+        if mode != "none":
+            fsync_dir(tdir)
+    except Exception:
+        shutil.rmtree(tdir, ignore_errors=True)
+        raise
+    _txn_apply(tdir, manifest, mode)
+
+def recover_json_txns(user_id: str, entity_id: Optional[str] = None) -> List[str]:
+    """
+    Completa i batch con manifest rimasti a metà ed elimina gli staging senza
+    manifest (di una entità o, senza entity_id, di tutte); ritorna le entità
+    con batch completati (le loro viste vanno ricostruite). Solo backend "fs".
+    """
+    if _store:
+        return []
+    if entity_id is not None:
+        roots = [txn_dir(user_id, entity_id)]
+    else:
+        roots = list(entities_dir(user_id).glob("*/.txn"))
+    recovered: List[str] = []
+    for root in roots:
+        if not root.is_dir():
+            continue
+        for tdir in sorted(root.iterdir()):
+            mf = tdir / _TXN_MANIFEST
+            if mf.is_file():
+                _txn_apply(tdir, _codec.loads(mf.read_bytes()), current_durability())
+                recovered.append(root.parent.name)
+            else:
+                shutil.rmtree(tdir, ignore_errors=True)
+    return sorted(set(recovered))
+
+# =============================================================================
+# Cache di lettura: LRU dei JSON già parsati
+#   chiave = path, validata con json_version: su fs l'identità del file
+#   (mtime_ns, size, inode), con sqlite la versione della riga; una modifica
+#   esterna o un os.replace cambiano l'identità → miss.
+#   atomic_write_json invalida esplicitamente. Limite su n. voci e byte.
+# =============================================================================
+_CACHE: "OrderedDict[str, tuple]" = OrderedDict()   # path -> (ident, obj, size)
+_CACHE_LOCK = threading.Lock()
+_CACHE_BYTES = 0
+_CACHE_STATS = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+def _clone(obj: Any) -> Any:
+    # copia profonda per strutture JSON (molto più rapida di copy.deepcopy):
+    # i chiamanti possono mutare il risultato senza sporcare la cache
+    if isinstance(obj, dict):
+        return {k: _clone(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_clone(v) for v in obj]
+    return obj
+
+def _cache_invalidate(path: Path) -> None:
+    global _CACHE_BYTES
+    with _CACHE_LOCK:
+        hit = _CACHE.pop(str(path), None)
+        if hit is not None:
+            _CACHE_BYTES -= hit[2]
+            _CACHE_STATS["invalidations"] += 1
+
+def _cache_put(key: str, ident: tuple, obj: Any, size: int) -> None:
+    global _CACHE_BYTES
+    if READ_CACHE_MAX_ENTRIES <= 0 or size > READ_CACHE_MAX_BYTES:
+        return
+    with _CACHE_LOCK:
+        old = _CACHE.pop(key, None)
+        if old is not None:
+            _CACHE_BYTES -= old[2]
+        _CACHE[key] = (ident, obj, size)
+        _CACHE_BYTES += size
+        while len(_CACHE) > READ_CACHE_MAX_ENTRIES or _CACHE_BYTES > READ_CACHE_MAX_BYTES:
+            _, (_, _, sz) = _CACHE.popitem(last=False)
+            _CACHE_BYTES -= sz
+            _CACHE_STATS["evictions"] += 1
+
+def read_cache_stats() -> Dict[str, int]:
+    with _CACHE_LOCK:
+        return {**_CACHE_STATS, "entries": len(_CACHE), "bytes": _CACHE_BYTES,
+                "max_entries": READ_CACHE_MAX_ENTRIES, "max_bytes": READ_CACHE_MAX_BYTES}
+
+def read_json(path: Path, clone: bool = True) -> Any:
+    """JSON parsato (cache LRU). clone=False: oggetto della cache, da NON modificare."""
+    key = str(path)
+    ident = json_version(path)  # FileNotFoundError come prima
+    with _CACHE_LOCK:
+        hit = _CACHE.get(key)
+        if hit is not None and hit[0] == ident:
+            _CACHE.move_to_end(key)
+            _CACHE_STATS["hits"] += 1
+            obj = hit[1]
+        else:
+            _CACHE_STATS["misses"] += 1
+            obj = None
+    if obj is None:
+        # sqlite: versione letta prima del corpo; se nel frattempo cambia, la voce
+        # resta legata alla versione vecchia e non viene più trovata
+        obj = _codec.loads(read_json_bytes(path))
+        _cache_put(key, ident, obj, ident[1])
+    return _clone(obj) if clone else obj
+
+def json_version(path: Path) -> tuple:
+    """
+    Identità della versione corrente del JSON, cambia a ogni scrittura
+    (FileNotFoundError se assente). L'elemento [1] è la dimensione in byte.
+    """
+    if _store:
+        return _store.version(_key(path))
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+def cache_lookup(key: str, ident: tuple) -> Any:
+    """
+    Valore derivato (es. una vista materializzata, una colonna) salvato con
+    cache_store per la versione `ident`, altrimenti None. Da NON modificare.
+    Stessa LRU e stesso budget di byte di read_json.
+    """
+    with _CACHE_LOCK:
+        hit = _CACHE.get(key)
+        if hit is not None and hit[0] == ident:
+            _CACHE.move_to_end(key)
+            _CACHE_STATS["hits"] += 1
+            return hit[1]
+        _CACHE_STATS["misses"] += 1
+    return None
+
+def cache_store(key: str, ident: tuple, value: Any, size: int) -> None:
+    _cache_put(key, ident, value, size)
+
+# =============================================================================
+# Risposte "raw": i byte del JSON salvato vanno direttamente al client
+#   Nessun parse, nessuna validazione response_model, nessuna re-serializzazione.
+#   Opt-in (RAW_JSON_RESPONSES / env ENAC_RAW_JSON_RESPONSES): i dati restituiti
+#   sono quelli scritti, senza i default/compat applicati dai modelli in lettura.
+# =============================================================================
+_RAW_RESPONSES = os.getenv("ENAC_RAW_JSON_RESPONSES", str(RAW_JSON_RESPONSES)).strip().lower() in {"1", "true", "yes", "on"}
+
+def raw_json_responses() -> bool:
+    return _RAW_RESPONSES
+
+def stored_json_response(path: Path) -> Response:
+    """Risposta con il JSON così come è salvato (su fs in streaming dal file)."""
+    if _store:
+        return Response(content=_store.read(_key(path)), media_type="application/json")
+    return FileResponse(path, media_type="application/json")
+
+# =============================================================================
+# JSON Merge Patch (RFC 7396) per le rotte PATCH
+#   null rimuove la chiave (il modello rimette il default), gli oggetti si
+#   fondono ricorsivamente, tutto il resto (liste comprese) sostituisce.
+# =============================================================================
+MERGE_PATCH_MEDIA_TYPE = "application/merge-patch+json"
+
+def merge_patch(target: Any, patch: Any) -> Any:
+    """Ritorna `target` con `patch` applicata (nessuno dei due viene modificato)."""
+    if not isinstance(patch, dict):
+        return patch
+    out = dict(target) if isinstance(target, dict) else {}
+    for k, v in patch.items():
+        if v is None:
+            out.pop(k, None)
+        else:
+            out[k] = merge_patch(out.get(k), v)
+    return out
+
+def validate_merged(model, merged: Dict[str, Any]):
+    """Valida il documento risultante (non la patch): 422 con gli errori Pydantic."""
+    try:
+        return model(**merged)
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors(include_url=False, include_context=False))
+
+def same_as_stored(obj: Any, stored: Any) -> bool:
+    """Confronto nel formato su disco (date, enum, Decimal come dopo il codec)."""
+    return _codec.loads(_codec.dumps(obj)) == stored
+
+# Lock in-process indicizzati per path (in modalità 'shared' più utenti
+# condividono lo stesso bucket: la chiave è il path, non lo user_id).
+# Registro a riferimenti deboli: il lock vive finché qualcuno lo usa (il blocco
+# `with` ne tiene un riferimento), poi la voce sparisce, così la memoria non
+# cresce con i path distinti (es. uno per SHA1). Niente lock "a strisce":
+# chiavi diverse sulla stessa striscia potrebbero bloccarsi nei lock annidati.
+_LOCKS: "weakref.WeakValueDictionary[str, threading.RLock]" = weakref.WeakValueDictionary()
+_LOCKS_GUARD = threading.Lock()
+
+def path_lock(key: str) -> threading.RLock:
+    with _LOCKS_GUARD:
+        lock = _LOCKS.get(key)
+        if lock is None:
+            lock = _LOCKS[key] = threading.RLock()
+        return lock
 
 # =============================================================================
 # Risoluzione bucket per-utente vs condiviso
@@ -90,25 +638,58 @@ def storage_mode() -> str:
 #   dove <bucket> è:
 #     - sanitize(user_id)   in modalità 'isolated'
 #     - "_shared"           in modalità 'shared'
+#
+# Risoluzione PURA e memoizzata: le funzioni qui sotto non toccano il disco
+# (nessun mkdir), quindi GET ed existence-check non lasciano cartelle vuote.
+# Le cartelle vengono create solo in scrittura (atomic_write_json crea la
+# cartella del file; per il resto usare ensure_dir esplicitamente).
 # =============================================================================
+_PATH_CACHE_SIZE = 65536
+
+@lru_cache(maxsize=_PATH_CACHE_SIZE)
 def user_dir(user_id: str) -> Path:
-    return ensure_dir(Path(ROOT_DATA_DIR) / _tenant_bucket(user_id))
+    return Path(ROOT_DATA_DIR) / _tenant_bucket(user_id)
 
+# =============================================================================
+# Colonne indicizzate (solo backend sqlite)
+#   Con sqlite rebuild delle viste, scadenze, documenti per owner e refcount
+#   blob sono query sugli indici della tabella nodes; su fs queste funzioni
+#   ritornano None e il chiamante usa i propri indici JSON o la scansione.
+# =============================================================================
+def indexed_nodes(user_id: str, kind: str, entity_id: Optional[str] = None, contract_id: Optional[str] = None,
+                  owner_id: Optional[str] = None, scadenza: Optional[tuple[str, str]] = None
+                  ) -> Optional[List[tuple[Path, Optional[str], Optional[str], Optional[str], Any]]]:
+    """[(path, entity_id, contract_id, owner_id, oggetto)] del tipo `kind`; None su fs."""
+    if not _store:
+        return None
+    rows = _store.select(_tenant_bucket(user_id), kind, entity_id, contract_id, owner_id, scadenza)
+    return [(Path(ROOT_DATA_DIR) / k, e, c, o, _codec.loads(body)) for k, e, c, o, body in rows]
+
+def indexed_hash_counts(user_id: str) -> Optional[Dict[str, int]]:
+    """SHA1 → numero di metadati documento che lo referenziano; None su fs."""
+    return _store.hash_counts(_tenant_bucket(user_id)) if _store else None
+
+@lru_cache(maxsize=_PATH_CACHE_SIZE)
 def entities_dir(user_id: str) -> Path:
-    return ensure_dir(user_dir(user_id) / "entities")
+    return user_dir(user_id) / "entities"
 
+@lru_cache(maxsize=_PATH_CACHE_SIZE)
 def entity_dir(user_id: str, entity_id: str) -> Path:
-    return ensure_dir(entities_dir(user_id) / sanitize_id(entity_id, "entity_id"))
+    return entities_dir(user_id) / sanitize_id(entity_id, "entity_id")
 
+@lru_cache(maxsize=_PATH_CACHE_SIZE)
 def entity_file(user_id: str, entity_id: str) -> Path:
     return entity_dir(user_id, entity_id) / "entity.json"
 
+@lru_cache(maxsize=_PATH_CACHE_SIZE)
 def contracts_dir(user_id: str, entity_id: str) -> Path:
-    return ensure_dir(entity_dir(user_id, entity_id) / "contracts")
+    return entity_dir(user_id, entity_id) / "contracts"
 
+@lru_cache(maxsize=_PATH_CACHE_SIZE)
 def contract_dir(user_id: str, entity_id: str, contract_id: str) -> Path:
-    return ensure_dir(contracts_dir(user_id, entity_id) / sanitize_id(contract_id, "contract_id"))
+    return contracts_dir(user_id, entity_id) / sanitize_id(contract_id, "contract_id")
 
+@lru_cache(maxsize=_PATH_CACHE_SIZE)
 def contract_file(user_id: str, entity_id: str, contract_id: str) -> Path:
     return contract_dir(user_id, entity_id, contract_id) / "contract.json"
 
@@ -117,15 +698,18 @@ def contract_file(user_id: str, entity_id: str, contract_id: str) -> Path:
 #   - Ogni titolo è un FILE: titles/<title_id>.json
 #   - Documenti in cartella condivisa: titles/documents/<doc_id>.json
 # =============================================================================
+@lru_cache(maxsize=_PATH_CACHE_SIZE)
 def titles_dir(user_id: str, entity_id: str, contract_id: str) -> Path:
-    return ensure_dir(contract_dir(user_id, entity_id, contract_id) / "titles")
+    return contract_dir(user_id, entity_id, contract_id) / "titles"
 
+@lru_cache(maxsize=_PATH_CACHE_SIZE)
 def title_file(user_id: str, entity_id: str, contract_id: str, title_id: str) -> Path:
     return titles_dir(user_id, entity_id, contract_id) / f"{sanitize_id(title_id, 'title_id')}.json"
 
+@lru_cache(maxsize=_PATH_CACHE_SIZE)
 def title_docs_dir(user_id: str, entity_id: str, contract_id: str, title_id: str) -> Path:
     # cartella condivisa per TUTTI i titoli del contratto
-    return ensure_dir(titles_dir(user_id, entity_id, contract_id) / "documents")
+    return titles_dir(user_id, entity_id, contract_id) / "documents"
 
 # =============================================================================
 # Sinistri
@@ -133,71 +717,533 @@ def title_docs_dir(user_id: str, entity_id: str, contract_id: str, title_id: str
 #   - Documenti in cartella condivisa: claims/documents/<doc_id>.json
 #     (l'associazione avviene con meta["claim_id"])
 # =============================================================================
+@lru_cache(maxsize=_PATH_CACHE_SIZE)
 def claims_dir(user_id: str, entity_id: str, contract_id: str) -> Path:
-    return ensure_dir(contract_dir(user_id, entity_id, contract_id) / "claims")
+    return contract_dir(user_id, entity_id, contract_id) / "claims"
 
+@lru_cache(maxsize=_PATH_CACHE_SIZE)
 def claim_dir(user_id: str, entity_id: str, contract_id: str, claim_id: str) -> Path:
-    return ensure_dir(claims_dir(user_id, entity_id, contract_id) / sanitize_id(claim_id, "claim_id"))
+    return claims_dir(user_id, entity_id, contract_id) / sanitize_id(claim_id, "claim_id")
 
+@lru_cache(maxsize=_PATH_CACHE_SIZE)
 def claim_file(user_id: str, entity_id: str, contract_id: str, claim_id: str) -> Path:
     return claim_dir(user_id, entity_id, contract_id, claim_id) / "claim.json"
 
+@lru_cache(maxsize=_PATH_CACHE_SIZE)
 def diary_dir(user_id: str, entity_id: str, contract_id: str, claim_id: str) -> Path:
-    return ensure_dir(claim_dir(user_id, entity_id, contract_id, claim_id) / "diary")
+    return claim_dir(user_id, entity_id, contract_id, claim_id) / "diary"
 
+@lru_cache(maxsize=_PATH_CACHE_SIZE)
 def diary_file(user_id: str, entity_id: str, contract_id: str, claim_id: str, entry_id: str) -> Path:
     return diary_dir(user_id, entity_id, contract_id, claim_id) / f"{sanitize_id(entry_id, 'entry_id')}.json"
 
 # --- Documenti (contratti/sinistri/titoli) ----------------------------------
+@lru_cache(maxsize=_PATH_CACHE_SIZE)
 def contract_docs_dir(user_id: str, entity_id: str, contract_id: str) -> Path:
-    return ensure_dir(contract_dir(user_id, entity_id, contract_id) / "documents")
+    return contract_dir(user_id, entity_id, contract_id) / "documents"
 
+@lru_cache(maxsize=_PATH_CACHE_SIZE)
 def claim_docs_dir(user_id: str, entity_id: str, contract_id: str, claim_id: str) -> Path:
     """
     ⛳️ Cartella condivisa per TUTTI i claim del contratto (claim_id ignorato).
     Manteniamo la firma per compatibilità.
     """
-    return ensure_dir(claims_dir(user_id, entity_id, contract_id) / "documents")
+    return claims_dir(user_id, entity_id, contract_id) / "documents"
+
+@lru_cache(maxsize=_PATH_CACHE_SIZE)
+def doc_owners_file(user_id: str, entity_id: str, contract_id: str) -> Path:
+    """Indice owner→doc_id del contratto (claims/titles), fuori dalle cartelle documents/."""
+    return contract_dir(user_id, entity_id, contract_id) / "doc_owners.json"
 
+@lru_cache(maxsize=_PATH_CACHE_SIZE)
 def doc_meta_file(base_dir: Path, doc_id: str) -> Path:
-    return ensure_dir(base_dir) / f"{sanitize_id(doc_id, 'doc_id')}.json"
+    return base_dir / f"{sanitize_id(doc_id, 'doc_id')}.json"
 
 # =============================================================================
 # Viste & indici
 # =============================================================================
+@lru_cache(maxsize=_PATH_CACHE_SIZE)
 def views_dir_for_entity(user_id: str, entity_id: str) -> Path:
-    return ensure_dir(entity_dir(user_id, entity_id) / "views")
+    return entity_dir(user_id, entity_id) / "views"
 
+@lru_cache(maxsize=_PATH_CACHE_SIZE)
 def indexes_dir(user_id: str) -> Path:
-    return ensure_dir(user_dir(user_id) / "indexes")
+    return user_dir(user_id) / "indexes"
 
+@lru_cache(maxsize=_PATH_CACHE_SIZE)
 def by_policy_dir(user_id: str) -> Path:
-    return ensure_dir(indexes_dir(user_id) / "by_policy")
+    return indexes_dir(user_id) / "by_policy"
 
+@lru_cache(maxsize=_PATH_CACHE_SIZE)
 def due_dir(user_id: str) -> Path:
-    return ensure_dir(indexes_dir(user_id) / "due")
+    return indexes_dir(user_id) / "due"
+
+@lru_cache(maxsize=_PATH_CACHE_SIZE)
+def blob_refs_dir(user_id: str) -> Path:
+    return indexes_dir(user_id) / "blob_refs"
+
+@lru_cache(maxsize=_PATH_CACHE_SIZE)
+def blob_packs_dir(user_id: str) -> Path:
+    return indexes_dir(user_id) / "blob_packs"
+
+@lru_cache(maxsize=_PATH_CACHE_SIZE)
+def upload_sessions_dir(user_id: str) -> Path:
+    return indexes_dir(user_id) / "uploads"
 
 # =============================================================================
 # Blobstore deduplicato: <bucket>/blobs/ab/abcdef... (sha1)
 # =============================================================================
+@lru_cache(maxsize=_PATH_CACHE_SIZE)
 def blobs_dir(user_id: str) -> Path:
-    return ensure_dir(user_dir(user_id) / "blobs")
+    return user_dir(user_id) / "blobs"
 
+@lru_cache(maxsize=_PATH_CACHE_SIZE)
 def blob_path_for_hash(user_id: str, h: str) -> Path:
-    base = blobs_dir(user_id)
-    shard = h[:2]
-    return ensure_dir(base / shard) / h
+    return blobs_dir(user_id) / h[:2] / h
+
+@lru_cache(maxsize=_PATH_CACHE_SIZE)
+def packs_dir(user_id: str) -> Path:
+    return blobs_dir(user_id) / "packs"
+
+@lru_cache(maxsize=_PATH_CACHE_SIZE)
+def upload_parts_dir(user_id: str) -> Path:
+    return blobs_dir(user_id) / ".uploads"
+
+class BlobLoc(NamedTuple):
+    """Byte salvati di un blob: file sciolto (offset 0) o tratto di un pack file."""
+    path: Path
+    offset: int
+    length: int
+    packed: bool = False
+
+def _as_loc(src: Union[Path, BlobLoc]) -> BlobLoc:
+    if isinstance(src, BlobLoc):
+        return src
+    return BlobLoc(Path(src), 0, os.stat(src).st_size)
+
+# ---- pack file per i blob piccoli (BLOB_PACK_MODE) --------------------------
+#   <bucket>/blobs/packs/pack-<seq>.pack    byte dei blob concatenati, nello
+#                                           stesso formato dei file sciolti
+#   <bucket>/indexes/blob_packs/<ab>.json   { sha1: [pack, offset, length, ts] }
+#   ts = ultimo riferimento (per il periodo di grazia del GC). I blob oltre
+#   BLOB_PACK_MAX_SIZE restano sciolti; le voci rimosse lasciano spazio morto
+#   nel pack, recuperato da `python -m app.manage blob-repack`.
+_PACK_MODE = os.getenv("ENAC_BLOB_PACK_MODE", str(BLOB_PACK_MODE)).strip().lower() in {"1", "true", "yes", "on"}
+
+def _pack_shard(user_id: str, h: str) -> Path:
+    return blob_packs_dir(user_id) / f"{h[:2]}.json"
+
+def pack_entry(user_id: str, h: str) -> Optional[list]:
+    shard = _pack_shard(user_id, h)
+    if not path_exists(shard):
+        return None
+    return read_json(shard).get(h)
 
-def write_blob(user_id: str, content: bytes) -> tuple[str, str]:
+def pack_index_update(user_id: str, h: str, entry: Optional[list]) -> None:
+    """Imposta (o rimuove con entry=None) la voce di `h` nell'indice dei pack."""
+    shard = _pack_shard(user_id, h)
+    with path_lock(str(shard)):
+        idx = read_json(shard) if path_exists(shard) else {}
+        if entry is None:
+            if idx.pop(h, None) is None:
+                return
+        else:
+            idx[h] = entry
+        atomic_write_json(shard, idx)
+
+def iter_packed(user_id: str) -> Iterator[tuple[str, list]]:
+    """(sha1, [pack, offset, length, ts]) di tutti i blob impacchettati."""
+    for shard in glob_json(blob_packs_dir(user_id), "*.json"):
+        try:
+            yield from read_json(shard).items()
+        except FileNotFoundError:
+            continue
+
+def locate_blob(user_id: str, h: str) -> Optional[BlobLoc]:
+    """Posizione del blob: prima il file sciolto, poi l'indice dei pack."""
+    bp = blob_path_for_hash(user_id, h)
+    try:
+        return BlobLoc(bp, 0, bp.stat().st_size)
+    except FileNotFoundError:
+        pass
+    e = pack_entry(user_id, h)
+    return BlobLoc(packs_dir(user_id) / e[0], e[1], e[2], True) if e else None
+
+def touch_blob(user_id: str, h: str, loc: BlobLoc) -> None:
+    """Segna il blob come appena referenziato (mtime o ts dell'indice)."""
+    if not loc.packed:
+        os.utime(loc.path)
+    else:
+        e = pack_entry(user_id, h)
+        if e:
+            pack_index_update(user_id, h, [*e[:3], time.time()])
+
+def _current_pack(user_id: str, exclude: Collection[Path] = ()) -> Path:
+    pdir = ensure_dir(packs_dir(user_id))
+    packs = sorted(pdir.glob("pack-*.pack"))
+    if packs and packs[-1] not in exclude and packs[-1].stat().st_size < BLOB_PACK_TARGET_SIZE:
+        return packs[-1]
+    seq = int(packs[-1].stem[5:]) + 1 if packs else 1
+    return pdir / f"pack-{seq:06d}.pack"
+
+def pack_append(user_id: str, h: str, src: Union[Path, BlobLoc], durable: bool = True,
+                exclude: Collection[Path] = ()) -> BlobLoc:
+    """Accoda i byte salvati di `src` al pack corrente (mai uno di `exclude`) e aggiorna l'indice."""
+    src = _as_loc(src)
+    with path_lock(str(packs_dir(user_id))):
+        pack = _current_pack(user_id, exclude)
+        with open(pack, "ab") as out, open(src.path, "rb") as f:
+            offset = out.tell()
+            f.seek(src.offset)
+            left = src.length
+            while left > 0:
+                chunk = f.read(min(_BLOB_READ_CHUNK, left))
+                if not chunk:
+                    raise IOError(f"blob troncato: {src.path}")
+                out.write(chunk)
+                left -= len(chunk)
+            if durable:
+                out.flush()
+                os.fsync(out.fileno())
+        pack_index_update(user_id, h, [pack.name, offset, src.length, time.time()])
+    return BlobLoc(pack, offset, src.length, True)
+
+def delete_blob_content(user_id: str, h: str) -> int:
+    """
+    Elimina il contenuto del blob (file sciolto o voce di pack) e ritorna i
+    byte interessati. Chiamare sotto path_lock del blob.
+    """
+    bp = blob_path_for_hash(user_id, h)
+    try:
+        size = bp.stat().st_size
+        bp.unlink()
+        return size
+    except FileNotFoundError:
+        pass
+    e = pack_entry(user_id, h)
+    if not e:
+        return 0
+    pack_index_update(user_id, h, None)
+    return e[2]
+
+# ---- server in esecuzione vs comandi a server fermo ---------------------------
+#   Ogni processo server tiene un flock condiviso su ROOT_DATA_DIR/.server.lock
+#   finché è attivo. I comandi che spostano o eliminano file ancora leggibili
+#   dalle richieste (repack: sciolti → pack, pack compattati) chiedono il lock
+#   esclusivo senza attendere e si rifiutano di partire se un server è attivo:
+#   path_lock vale solo nel processo e un download già avviato (FileResponse)
+#   riapre il file per percorso.
+_SERVER_LOCK = ".server.lock"
+_server_lock_fd: Optional[int] = None
+
+def _open_server_lock(root: Optional[Path] = None) -> int:
+    root = Path(root or ROOT_DATA_DIR)
+    ensure_dir(root)
+    return os.open(root / _SERVER_LOCK, os.O_RDWR | os.O_CREAT, 0o644)
+
+def hold_server_lock() -> None:
+    """All'avvio del server: segnala ai comandi offline che un server è attivo."""
+    global _server_lock_fd
+    if fcntl is None or _server_lock_fd is not None:
+        return
+    fd = _open_server_lock()
+    fcntl.flock(fd, fcntl.LOCK_SH)
+    _server_lock_fd = fd
+
+def release_server_lock() -> None:
+    global _server_lock_fd
+    if _server_lock_fd is not None:
+        os.close(_server_lock_fd)  # chiude e rilascia il flock
+        _server_lock_fd = None
+
+@contextmanager
+def offline_lock(root: Optional[Path] = None) -> Iterator[None]:
+    """Lock esclusivo per i comandi a server fermo (radice dati `root`); RuntimeError se un server è attivo."""
+    if fcntl is None:
+        yield
+        return
+    fd = _open_server_lock(root)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock = Path(root or ROOT_DATA_DIR) / _SERVER_LOCK
+            raise RuntimeError(f"server in esecuzione ({lock} in uso): fermarlo prima del comando")
+        yield
+    finally:
+        os.close(fd)
+
+_SHA1_HEX = re.compile(r"^[0-9a-f]{40}$")
+
+# ---- compressione trasparente dei blob ------------------------------------
+#   Blob compresso: header di 17 byte  MAGIC(8) | codec(1) | size originale(8, BE)
+#   seguito dal flusso zlib. I blob senza header sono raw (formato storico).
+#   Un raw che inizia per caso con MAGIC viene salvato con header codec "r".
+#   SHA1, nome del file e meta.size descrivono SEMPRE il contenuto originale.
+_BLOB_MAGIC = b"\x00ENACBLB"
+_BLOB_HEADER = struct.Struct(">8scQ")
+_CODEC_ZLIB = b"z"
+_CODEC_RAW = b"r"
+_BLOB_READ_CHUNK = 64 * 1024
+
+def should_compress(mime: Optional[str]) -> bool:
+    """Politica per MIME (BLOB_COMPRESS_MIME: tipi esatti o prefissi che finiscono con '/')."""
+    if not mime or BLOB_COMPRESS_MIN_SIZE < 0:
+        return False
+    m = mime.split(";", 1)[0].strip().lower()
+    return any(m == p or (p.endswith("/") and m.startswith(p)) for p in BLOB_COMPRESS_MIME)
+
+def blob_header(src: Union[Path, BlobLoc]) -> tuple[str, int, int]:
+    """(codec "raw"|"zlib", size originale, offset dei dati) del blob (file o tratto di pack)."""
+    loc = _as_loc(src)
+    with open(loc.path, "rb") as f:
+        f.seek(loc.offset)
+        head = f.read(min(_BLOB_HEADER.size, loc.length))
+        if len(head) == _BLOB_HEADER.size and head[:8] == _BLOB_MAGIC:
+            _, codec, size = _BLOB_HEADER.unpack(head)
+            return ("zlib" if codec == _CODEC_ZLIB else "raw"), size, _BLOB_HEADER.size
+        return "raw", loc.length, 0
+
+def iter_blob(src: Union[Path, BlobLoc], start: int = 0, end: Optional[int] = None) -> Iterator[bytes]:
+    """Contenuto ORIGINALE del blob nell'intervallo [start, end), decompresso in streaming."""
+    loc = _as_loc(src)
+    codec, size, offset = blob_header(loc)
+    end = size if end is None else min(end, size)
+    with open(loc.path, "rb") as f:
+        f.seek(loc.offset + offset + (start if codec == "raw" else 0))
+        if codec == "raw":
+            left = end - start
+            while left > 0:
+                chunk = f.read(min(_BLOB_READ_CHUNK, left))
+                if not chunk:
+                    return
+                left -= len(chunk)
+                yield chunk
+            return
+        z = zlib.decompressobj()
+        pos = 0  # posizione nel contenuto originale
+        left = loc.length - offset  # mai oltre il tratto del blob (pack)
+        while pos < end:
+            data = f.read(min(_BLOB_READ_CHUNK, left))
+            left -= len(data)
+            out = z.decompress(data, _BLOB_READ_CHUNK) if data else z.flush()
+            while True:
+                if out:
+                    lo, hi = max(start - pos, 0), min(end - pos, len(out))
+                    if lo < hi:
+                        yield out[lo:hi]
+                    pos += len(out)
+                if not z.unconsumed_tail or pos >= end:
+                    break
+                out = z.decompress(z.unconsumed_tail, _BLOB_READ_CHUNK)
+            if not data:
+                return
+
+def blob_intact(loc: BlobLoc, h: str, size: int) -> bool:
+    """True se il blob decodificato ha la size attesa e SHA1 `h` (qualunque sia la compressione)."""
+    try:
+        if blob_header(loc)[1] != size:
+            return False
+        sha1 = hashlib.sha1()
+        for chunk in iter_blob(loc):
+            sha1.update(chunk)
+    except (OSError, zlib.error):
+        return False
+    return sha1.hexdigest() == h
+
+def blob_lookup(user_id: str, sha1: str, touch: bool = False) -> Optional[tuple[str, int]]:
+    """
+    (path_relativo, size originale) se il blob è già presente, altrimenti None.
+    Con touch=True aggiorna l'mtime: il blob sta per essere referenziato e il
+    GC non deve considerarlo orfano durante il periodo di grazia.
+    """
+    if not _SHA1_HEX.match(sha1 or ""):
+        raise HTTPException(status_code=400, detail="SHA1 non valido (40 caratteri esadecimali minuscoli).")
+    loc = locate_blob(user_id, sha1)
+    if loc is None:
+        return None
+    try:
+        size = blob_header(loc)[1]
+        if touch:
+            touch_blob(user_id, sha1, loc)
+    except FileNotFoundError:
+        return None
+    return str(blob_path_for_hash(user_id, sha1).relative_to(user_dir(user_id))), size
+
+class BlobWriter:
+    """
+    Scrittura atomica di un blob a blocchi:
+    - i dati vanno in un temporaneo sotto blobs/.tmp/ (stesso filesystem dei
+      blob) e lo SHA1 si calcola mentre si scrive
+    - con `compress=True` (vedi should_compress) il contenuto oltre
+      BLOB_COMPRESS_MIN_SIZE viene compresso al volo con zlib; se il guadagno
+      è sotto BLOB_COMPRESS_MAX_RATIO si conserva il raw
+    - commit() rinomina nella posizione definitiva con os.replace; se il blob
+      esiste già (stessa dimensione su disco) il temporaneo viene scartato
+      senza riscrivere nulla; un blob esistente troncato viene sostituito
+    - `expected_sha1` (dichiarato dal client) viene verificato al commit
+    - fsync secondo WRITE_DURABILITY, come atomic_write_json
+    """
+
+    def __init__(self, user_id: str, expected_sha1: Optional[str] = None, compress: bool = False):
+        self.user_id = user_id
+        self.expected_sha1 = expected_sha1
+        self.size = 0
+        self._sha1 = hashlib.sha1()
+        self._mode = current_durability()
+        self._pending: Optional[bytearray] = bytearray() if compress else None
+        self._z = None
+        self._tmp_dir = ensure_dir(blobs_dir(user_id) / ".tmp")
+        fd, self._tmp = tempfile.mkstemp(dir=str(self._tmp_dir), suffix=".part")
+        self._fp = os.fdopen(fd, "wb")
+
+    def write(self, chunk: bytes) -> None:
+        self._sha1.update(chunk)
+        self.size += len(chunk)
+        if self._z is not None:
+            self._fp.write(self._z.compress(chunk))
+        elif self._pending is not None:
+            # si decide se comprimere solo oltre la soglia minima
+            self._pending += chunk
+            if len(self._pending) >= BLOB_COMPRESS_MIN_SIZE:
+                self._z = zlib.compressobj(BLOB_COMPRESS_LEVEL)
+                self._fp.write(_BLOB_HEADER.pack(_BLOB_MAGIC, _CODEC_ZLIB, 0))
+                self._fp.write(self._z.compress(bytes(self._pending)))
+                self._pending = None
+        else:
+            self._fp.write(chunk)
+
+    def _finish(self) -> None:
+        if self._pending is not None:  # sotto soglia: raw
+            self._fp.write(self._pending)
+            self._pending = None
+        if self._z is not None:
+            self._fp.write(self._z.flush())
+            self._fp.seek(0)
+            self._fp.write(_BLOB_HEADER.pack(_BLOB_MAGIC, _CODEC_ZLIB, self.size))
+            self._fp.seek(0, os.SEEK_END)
+        stored = self._fp.tell()
+        self._fp.close()
+        if self._z is not None and stored >= self.size * BLOB_COMPRESS_MAX_RATIO:
+            self._rewrite(_CODEC_RAW if self._starts_with_magic(decompress=True) else None, decompress=True)
+        elif self._z is None and self._starts_with_magic():
+            self._rewrite(_CODEC_RAW, decompress=False)
+
+    def _starts_with_magic(self, decompress: bool = False) -> bool:
+        if decompress:
+            head = next(iter_blob(Path(self._tmp), 0, len(_BLOB_MAGIC)), b"")
+        else:
+            with open(self._tmp, "rb") as f:
+                head = f.read(len(_BLOB_MAGIC))
+        return head == _BLOB_MAGIC
+
+    def _rewrite(self, codec: Optional[bytes], decompress: bool) -> None:
+        """Riscrive il temporaneo come raw (con header se `codec`)."""
+        fd, tmp2 = tempfile.mkstemp(dir=str(self._tmp_dir), suffix=".part")
+        with os.fdopen(fd, "wb") as out:
+            if codec:
+                out.write(_BLOB_HEADER.pack(_BLOB_MAGIC, codec, self.size))
+            if decompress:
+                for chunk in iter_blob(Path(self._tmp)):
+                    out.write(chunk)
+            else:
+                with open(self._tmp, "rb") as src:
+                    shutil.copyfileobj(src, out)
+        os.replace(tmp2, self._tmp)
+
+    def commit(self) -> tuple[str, str, int]:
+        """Ritorna (sha1, path_relativo_dal_bucket, size originale)."""
+        self._finish()
+        if self._mode != "none":
+            fd = os.open(self._tmp, os.O_RDWR)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        sha1 = self._sha1.hexdigest()
+        if self.expected_sha1 and sha1 != self.expected_sha1:
+            self.abort()
+            raise HTTPException(status_code=422, detail="SHA1 dichiarato non corrispondente al contenuto.")
+        bp = blob_path_for_hash(self.user_id, sha1)
+        stored = os.stat(self._tmp).st_size
+        with path_lock(str(bp)):
+            loc = locate_blob(self.user_id, sha1)
+            # stessa codifica e stessa lunghezza: copia già presente; altrimenti
+            # (altra compressione, o copia forse troncata) si verifica il contenuto
+            if loc is not None and (loc.length == stored or blob_intact(loc, sha1, self.size)):
+                os.unlink(self._tmp)                   # dedup: contenuto già presente
+                touch_blob(self.user_id, sha1, loc)    # ri-referenziato: fuori dal periodo di grazia del GC
+            else:
+                # copia assente o verificata corrotta: la nuova la sostituisce senza
+                # finestre in cui il blob manca (i download in corso tengono la vecchia)
+                if _PACK_MODE and stored <= BLOB_PACK_MAX_SIZE:
+                    pack_append(self.user_id, sha1, Path(self._tmp), self._mode != "none")
+                    os.unlink(self._tmp)
+                    if loc is not None and not loc.packed:
+                        loc.path.unlink(missing_ok=True)  # il file sciolto avrebbe la precedenza
+                else:
+                    ensure_dir(bp.parent)
+                    os.replace(self._tmp, bp)
+                    if self._mode == "file+dir":
+                        fsync_dir(bp.parent)
+                    if loc is not None and loc.packed:
+                        pack_index_update(self.user_id, sha1, None)
+                blob_refs_adjust(self.user_id, sha1, 0)  # registra il blob (0 riferimenti finché un meta non lo usa)
+        return sha1, str(bp.relative_to(user_dir(self.user_id))), self.size
+
+    def abort(self) -> None:
+        self._fp.close()
+        try:
+            os.unlink(self._tmp)
+        except FileNotFoundError:
+            pass
+
+def write_blob(user_id: str, content: bytes, expected_sha1: Optional[str] = None,
+               mime: Optional[str] = None) -> tuple[str, str]:
     """
     Scrive il blob se assente. Ritorna (sha1, path_relativo_dal_bucket).
     In modalità 'shared' tutti gli utenti condividono lo stesso bucket.
+    Con `mime` comprimibile (should_compress) il blob viene salvato compresso.
     """
-    sha1 = hashlib.sha1(content).hexdigest()
-    bp = blob_path_for_hash(user_id, sha1)
-    if not bp.exists():
-        ensure_dir(bp.parent)
-        with bp.open("wb") as fp:
-            fp.write(content)
-    rel = str(bp.relative_to(user_dir(user_id)))
+    w = BlobWriter(user_id, expected_sha1, compress=should_compress(mime))
+    try:
+        w.write(content)
+        sha1, rel, _ = w.commit()
+    except BaseException:
+        w.abort()
+        raise
     return sha1, rel
+
+# =============================================================================
+# Refcount blob: <bucket>/indexes/blob_refs/<ab>.json → { sha1: n_riferimenti }
+#   Shard per prefisso (come i blob): ogni aggiornamento riscrive un solo shard.
+# =============================================================================
+def _blob_refs_shard(user_id: str, h: str) -> Path:
+    return blob_refs_dir(user_id) / f"{h[:2]}.json"
+
+def blob_refs_get(user_id: str, h: str) -> Optional[int]:
+    shard = _blob_refs_shard(user_id, h)
+    if not path_exists(shard):
+        return None
+    return read_json(shard).get(h)
+
+def blob_refs_adjust(user_id: str, h: str, delta: int) -> int:
+    """Somma `delta` al contatore di `h` (mai sotto zero) e ritorna il nuovo valore."""
+    shard = _blob_refs_shard(user_id, h)
+    with path_lock(str(shard)):
+        counts = read_json(shard) if path_exists(shard) else {}
+        n = max(0, counts.get(h, 0) + delta)
+        if counts.get(h) != n:
+            counts[h] = n
+            atomic_write_json(shard, counts)
+        return n
+
+def blob_refs_forget(user_id: str, h: str) -> None:
+    """Rimuove `h` dalla tabella (blob eliminato dal disco)."""
+    shard = _blob_refs_shard(user_id, h)
+    with path_lock(str(shard)):
+        if not path_exists(shard):
+            return
+        counts = read_json(shard)
+        if counts.pop(h, None) is not None:
+            atomic_write_json(shard, counts)